@@ -0,0 +1,108 @@
+'''
+Micro-benchmark: st_common.MessageReceiver (recv_into/memoryview buffer) vs. the
+original bytes-concatenating version.
+
+Bytes are fed from an in-memory "socket" in chunks the size of a typical recv()
+so only the framing/decoding work is measured.
+
+    $ python examples/bench_msgrec.py
+'''
+import os
+import sys
+import json
+import struct
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from st_common import MessageReceiver
+
+CHUNK = 1024
+
+class OldMessageReceiver:
+    '''MessageReceiver as it was before the recv_into version (processor only)'''
+    def __init__(self, name, conn, fn_processor):
+        self.conn = conn
+        self.name = name
+        self.processor = fn_processor
+        self.remaining_sz_bytes = 4
+        self.sz_bytes = b''
+        self.sz = 0
+        self.msg = b''
+        self.message = None
+
+    def recv(self):
+        b = self.conn.recv(CHUNK)
+        self.add_bytes(b)
+        return len(b)
+
+    def add_bytes(self, b):
+        while b:
+            if self.remaining_sz_bytes > 0:
+                self.sz_bytes += b[0:self.remaining_sz_bytes]
+                b = b[self.remaining_sz_bytes:]
+                self.remaining_sz_bytes = 4 - len(self.sz_bytes)
+                if len(self.sz_bytes) == 4:
+                    self.sz = struct.unpack('I', self.sz_bytes)[0]
+            if b:
+                if len(b) + len(self.msg) < self.sz:
+                    self.msg += b
+                    b = b''
+                else:
+                    required_bytes = self.sz - len(self.msg)
+                    self.msg += b[0:required_bytes]
+                    self.message = json.loads(self.msg.decode('utf-8'))
+                    self.processor(self.message)
+                    b = b[required_bytes:]
+                    self.sz_bytes = b''
+                    self.remaining_sz_bytes = 4
+                    self.msg = b''
+                    self.sz = 0
+                    self.message = None
+
+class FakeConn:
+    '''Hands out a prepared byte stream CHUNK bytes at a time'''
+    def __init__(self, data):
+        self.data = memoryview(data)
+        self.pos = 0
+
+    def recv(self, n):
+        b = self.data[self.pos:self.pos+min(n, CHUNK)].tobytes()
+        self.pos += len(b)
+        return b
+
+    def recv_into(self, buf):
+        n = min(len(buf), CHUNK, len(self.data) - self.pos)
+        buf[:n] = self.data[self.pos:self.pos+n]
+        self.pos += n
+        return n
+
+def frame(mtype, data):
+    msgbytes = json.dumps({'TYPE': mtype, 'DATA': data}).encode('utf-8')
+    return struct.pack('I', len(msgbytes)) + msgbytes
+
+def run(cls, stream, expected):
+    received = []
+    msgrec = cls('bench', FakeConn(stream), received.append)
+    t0 = time.perf_counter()
+    while msgrec.recv():
+        pass
+    elapsed = time.perf_counter() - t0
+    if len(received) != expected:
+        raise RuntimeError(f'{cls.__name__} got {len(received)} messages, expected {expected}')
+    return elapsed
+
+def bench(label, stream, expected, repeat=3):
+    old = min(run(OldMessageReceiver, stream, expected) for i in range(repeat))
+    new = min(run(MessageReceiver, stream, expected) for i in range(repeat))
+    print(f'{label:<36} old: {old*1000:9.2f} ms   new: {new*1000:9.2f} ms   x{old/new:6.1f}')
+
+if __name__ == '__main__':
+    n_small = 20000
+    tick = {'stock': 3, 'amount': 10, 'newprice': 115, 'div': True}
+    bench(f'{n_small} markettick messages', frame('markettick', tick) * n_small, n_small)
+
+    for n_players in (1000, 10000, 50000):
+        info = [{'name': f'player{i}', 'cash': 5000, 'networth': 6250, 'portfolio': [0, 500, 0, 1000, 0, 0]}
+                for i in range(n_players)]
+        big = frame('gameover', {'winner': ['player0'], 'winner-networth': 6250, 'player-info': info})
+        bench(f'1 gameover message ({len(big)//1024} KiB)', big, 1, repeat=1)
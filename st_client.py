@@ -20,7 +20,7 @@ import struct
 import datetime
 import types # SimpleNamespace for stock enum-ish construct?
 from st_gameboard import GameBoard
-from st_common import MessageReceiver
+from st_common import MessageReceiver, CAP_BINARY
 
 default_args = {
     'port': 8089,
@@ -94,6 +94,7 @@ def dbg_check_sync():
 def process_message(msgobj):
     global running
     global gameboard
+    global leaders
     #msgobj = oClient.message
     mtype = msgobj['TYPE']
     mdata = msgobj['DATA']
@@ -181,6 +182,14 @@ def process_message(msgobj):
         for p in mdata['player-info']:
             str_portfolio = ', '.join(f'{stock_names[i]}: {p["portfolio"][i]}' for i in range(len(stock_names)))
             gameboard.add_system_msg(f'{p["name"]}: ${p["networth"]} net worth, ${p["cash"]} cash, {str_portfolio}')
+    elif mtype == 'leaderboard':
+        # {top: [[name, networth],...], players: n}  (best first)
+        # only mention it when the top 3 change, it arrives every few rolls
+        top3 = [ name for (name, networth) in mdata['top'][:3] ]
+        if top3 != leaders:
+            leaders = top3
+            str_top = ', '.join(f'{name} ${networth}' for (name, networth) in mdata['top'][:3])
+            gameboard.add_system_msg(f'Leaders: {str_top}')
     elif mtype == 'servermsg':
         gameboard.add_system_msg(str(mdata))
     elif mtype == 'div':
@@ -198,6 +207,7 @@ player = None # NOTE/TODO: not sure how necessary it is to keep client copies of
 market = None # [ (stockval, bln_dividend), (stockval, bln_dividend), etc ]
 gameboard = None
 clientsocket = None
+leaders = None # names of the top 3 players in the last leaderboard message
 
 # TODO: clientsocket is global. probably not great
 # NOTE: since select() is hard/impossible to interrupt without timeout, maybe the solution
@@ -301,7 +311,7 @@ def main(stdscr):
     # MessageReceiver is duplicate of that found in chat_server_v3.py, so just give name 'server'
     # msgrec is attached to selector and will simply process messages from the server
     msgrec = MessageReceiver('server', clientsocket, process_message)
-    clientsocket.send(bmsg('initconn',args.name))
+    clientsocket.send(bmsg('initconn', {'name': args.name, 'caps': [CAP_BINARY]}))
 
     sel = selectors.DefaultSelector()
     sel.register(clientsocket, selectors.EVENT_READ, None)
@@ -338,10 +348,7 @@ def main(stdscr):
             for key, mask in events:
                 conn = key.fileobj
                 if mask & selectors.EVENT_READ:
-                    b = conn.recv(1024)
-                    if b:
-                        msgrec.add_bytes(b)
-                    else:
+                    if not msgrec.recv():
                         # disconnect?
                         print ('Server disconnected')
                         msgrec.conn.close()
@@ -3,22 +3,169 @@ import struct
 import json
 import queue
 
+# every message on the wire starts with a 4 byte int indicating size of the message body
+FRAME_HEADER = struct.Struct('I')
+
+# ------------------------------------------------------------------------------
+#                              MESSAGE ENCODING
+# ------------------------------------------------------------------------------
+# Messages are json {'TYPE': str, 'DATA': x} by default.  A client that includes
+# CAP_BINARY in the capabilities of its initconn message can also be sent the
+# frequent game messages (BINARY_LAYOUTS) as fixed struct layouts: a one byte
+# type id followed by the packed DATA fields.  A json message body always starts
+# with '{' so the receiver can tell the two apart by the first byte.
+CAP_BINARY = 'bin1'
+JSON_START = ord('{')
+
+ROLL_ACTIONS = ('UP', 'DOWN', 'DIV') # roll 'action' is sent as index into this
+
+class BinaryLayout:
+    def __init__(self, type_id, mtype, fmt, fields, converters=None):
+        '''
+        type_id: first byte of message body, must not be JSON_START
+        mtype: message TYPE this layout encodes
+        fmt: struct format of the fields (little endian, type id byte is added)
+        fields: names of the keys in DATA, in the order they are packed
+        converters: optional {field: (fn_to_wire, fn_from_wire)} for non-numeric fields
+        '''
+        self.type_id = type_id
+        self.mtype = mtype
+        self.struct = struct.Struct('<B' + fmt)
+        self.fields = fields
+        self.converters = converters or {}
+
+    def pack(self, data):
+        vals = [ data[f] for f in self.fields ]
+        for i, f in enumerate(self.fields):
+            if f in self.converters:
+                vals[i] = self.converters[f][0](vals[i])
+        return self.struct.pack(self.type_id, *vals)
+
+    def unpack(self, msgview):
+        data = dict(zip(self.fields, self.struct.unpack(msgview)[1:]))
+        for f, (to_wire, from_wire) in self.converters.items():
+            data[f] = from_wire(data[f])
+        return {'TYPE': self.mtype, 'DATA': data}
+
+BINARY_LAYOUTS = { layout.mtype: layout for layout in (
+    BinaryLayout(1, 'roll', 'BBH', ('stock', 'action', 'amount'),
+        {'action': (ROLL_ACTIONS.index, ROLL_ACTIONS.__getitem__)}),
+    BinaryLayout(2, 'markettick', 'BHh?', ('stock', 'amount', 'newprice', 'div')),
+    BinaryLayout(3, 'div', 'BHqq', ('stock', 'amount', 'divpaid', 'playercash')),
+    BinaryLayout(4, 'split', 'Bh?qqqq', ('stock', 'newprice', 'div', 'shares', 'gained', 'divpaid', 'playercash')),
+    BinaryLayout(5, 'offmarket', 'Bh?qq', ('stock', 'newprice', 'div', 'shares', 'lost')),
+)}
+BINARY_LAYOUTS_BY_ID = { layout.type_id: layout for layout in BINARY_LAYOUTS.values() }
+
+def encode_message(mtype, data, binary=False):
+    '''
+    bytes of a message including the 4 byte size. result can go right into socket.send(...)
+    binary: True to use the binary layout for mtype if there is one
+    '''
+    if binary and mtype in BINARY_LAYOUTS:
+        msgbytes = BINARY_LAYOUTS[mtype].pack(data)
+    else:
+        msgbytes = json.dumps({'TYPE': mtype, 'DATA': data}).encode('utf-8')
+    return FRAME_HEADER.pack(len(msgbytes)) + msgbytes
+
+def decode_message(msgview):
+    '''message object from the bytes (bytes/memoryview) of one message body'''
+    if msgview[0] == JSON_START:
+        return json.loads(str(msgview, 'utf-8'))
+    return BINARY_LAYOUTS_BY_ID[msgview[0]].unpack(msgview)
+
+class OutMessage:
+    '''
+    A message to be sent to one or more connections. The bytes are only
+    produced when first needed, and at most once for each encoding, so one
+    OutMessage can go to json and binary clients alike.
+    '''
+    __slots__ = ('mtype', 'data', '_json', '_binary')
+
+    def __init__(self, mtype, data):
+        self.mtype = mtype
+        self.data = data
+        self._json = None
+        self._binary = None
+
+    def frame(self, binary=False):
+        if binary and self.mtype in BINARY_LAYOUTS:
+            if self._binary is None:
+                self._binary = encode_message(self.mtype, self.data, True)
+            return self._binary
+        if self._json is None:
+            self._json = encode_message(self.mtype, self.data)
+        return self._json
+
+def parse_initconn(init_msg):
+    '''(client name, capabilities) from the initconn message of a new connection'''
+    if init_msg['TYPE'] != 'initconn':
+        raise ValueError(f'Bad message type [{init_msg["TYPE"]}], expected initconn')
+    # older clients send just the name, newer send {name: str, caps: [str,...]}
+    client_name, client_caps = init_msg['DATA'], ()
+    if isinstance(client_name, dict):
+        client_name, client_caps = client_name['name'], client_name.get('caps', ())
+    return client_name, client_caps
+
+# ------------------------------------------------------------------------------
+#                              GATEWAY LINK
+# ------------------------------------------------------------------------------
+# st_gateway.py holds the client connections and talks to the server over one
+# link. A link packet is framed like a message (4 byte size) and the body starts
+# with a kind byte and a connection id:
+#   LINK_OPEN       gateway -> server: new connection, followed by its initconn message body
+#                   server -> gateway: connection accepted, include it in broadcasts
+#   LINK_DATA       gateway -> server: body of one message from the connection
+#                   server -> gateway: framed message(s) to send to the connection
+#   LINK_CLOSE      either way: the connection is gone / close it once its data is sent
+#   LINK_MULTICAST  server -> gateway: the id is a count of connection ids (4 bytes
+#                   each) that follow, then framed message(s) to send to each of them
+#   LINK_BROADCAST  server -> gateway: framed message(s) for every accepted connection
+LINK_OPEN, LINK_DATA, LINK_CLOSE, LINK_MULTICAST, LINK_BROADCAST = range(1, 6)
+LINK_HEADER = struct.Struct('<BI') # kind, connection id (count for LINK_MULTICAST)
+
+def link_header(kind, conn_id, payload_len):
+    '''frame size and link header of a packet, payload_len bytes of payload to follow'''
+    return FRAME_HEADER.pack(LINK_HEADER.size + payload_len) + LINK_HEADER.pack(kind, conn_id)
+
+def encode_link(kind, conn_id, payload=b''):
+    return link_header(kind, conn_id, len(payload)) + payload
+
+def multicast_header(conn_ids, payload_len):
+    '''frame size, link header and connection ids of a LINK_MULTICAST packet'''
+    ids = struct.pack(f'<{len(conn_ids)}I', *conn_ids)
+    return link_header(LINK_MULTICAST, len(conn_ids), len(ids) + payload_len) + ids
+
 # MessageReceiver objects just receive bytes over a network connection and form them into
 # messages.  Actions by these objects are triggered by selector events
 # NOTE: this was called 'ChatClient' which is/was a terrible name...
-# TODO: update st_server.py to import and use
+SMALL_MESSAGE = 2048 # MessageReceiver decodes messages up to this size from a bytes copy
+
 class MessageReceiver:
-    def __init__(self, name, conn, fn_processor=None):
+    BUFSIZE = 65536 # initial receive buffer size. Grows if a single message won't fit
+    MAX_MESSAGE = 1 << 24 # larger messages are refused (a gameover of 50000 players is ~5 MiB)
+
+    def __init__(self, name, conn, fn_processor=None, bufsize=None):
         '''
         name: just a string - currently not used
         conn: tcp/ip connection
         fn_processor: callable for processing messages once received
+        bufsize: initial size of the receive buffer (default MessageReceiver.BUFSIZE)
 
         If fn_processor is not provided, the MessageReceiver will store the messages in queue
         that can be accessed with get_message() which blocks until a message becomes available
 
         It's not intended that you should be able to add fn_processor after initialization. I would
         not recommend you do that.
+
+        Bytes are received straight into a preallocated buffer (socket.recv_into) and messages
+        are decoded from memoryview slices of it, so nothing gets copied on the way in.  When the
+        write position reaches the end of the buffer, the unprocessed bytes (at most one partial
+        message) wrap around to the front.  A message that won't fit makes the buffer grow (at most
+        doubling) as its bytes arrive, never just on the size its header claims, and a header over
+        MAX_MESSAGE raises ValueError: the connection should be dropped.  Messages up to
+        SMALL_MESSAGE bytes (market ticks, orders, chat) are decoded from a bytes copy instead: for
+        them, making the memoryview slice costs more than the copy saves (see examples/bench_msgrec.py).
         '''
         self.conn = conn
         self.name = name
@@ -26,51 +173,129 @@ class MessageReceiver:
         if fn_processor is None:
             self.queue = queue.SimpleQueue()
 
-        self.remaining_sz_bytes = 4
-        self.sz_bytes = b''
-        self.sz = 0                  # size of message in bytes
-        self.msg = b''               # bytes of message being received
+        self._buf = bytearray(bufsize or MessageReceiver.BUFSIZE)
+        self._view = memoryview(self._buf)
+        self._start = 0              # offset of first byte not yet processed
+        self._end = 0                # offset just past the last byte received
         self.message = None          # completed message object once all received
         self.data = None             # optionally send this as extra arg to fn_processor
 
+    def recv(self):
+        '''
+        Read whatever is available on conn into the buffer and process any messages
+        that are completed. Returns the number of bytes read (0 means the other side
+        closed the connection). Socket errors are not caught here.
+        '''
+        n = self.conn.recv_into(self.get_buffer())
+        if n:
+            self.buffer_updated(n)
+        return n
+
+    # get_buffer/buffer_updated match asyncio.BufferedProtocol so a protocol can
+    # have the event loop receive directly into this MessageReceiver's buffer
+    def get_buffer(self, sizehint=-1):
+        '''writable memoryview of the free space at the end of the buffer'''
+        if self._end == len(self._buf):
+            self._make_room()
+        return self._view[self._end:]
+
+    def buffer_updated(self, nbytes):
+        '''nbytes have been written into the buffer from get_buffer()'''
+        self._end += nbytes
+        self._process()
+
     # called when bytes received over connection conn.  When a message is completed, process it
     # message starts with 4 byte int indicating size, then that # of bytes for
-    # message body
+    # message body.
+    # NOTE: recv() should be preferred. This is here for bytes that were read some other way
     def add_bytes(self, b):
-        while b: # always substract from byte array as its processed
-            if self.remaining_sz_bytes > 0:
-                self.sz_bytes += b[0:self.remaining_sz_bytes]
-                b = b[self.remaining_sz_bytes:]
-                self.remaining_sz_bytes = 4 - len(self.sz_bytes)
-                if len(self.sz_bytes) == 4:
-                    self.sz = struct.unpack('I', self.sz_bytes)[0]
-            if b:
-                if len(b) + len(self.msg) < self.sz:
-                    # not enough data in b to complete message
-                    self.msg += b
-                    b = b'' # stop loop
+        b = memoryview(b)
+        while b:
+            if self._end == len(self._buf):
+                self._make_room()
+            n = min(len(b), len(self._buf) - self._end)
+            self._buf[self._end:self._end+n] = b[:n]
+            self._end += n
+            b = b[n:]
+            self._process()
+
+    def _make_room(self):
+        '''
+        Buffer is full up to the end. Move the partial message at the front of the
+        buffer, growing the buffer first if that message can't fit in it
+        '''
+        pending = self._end - self._start
+        needed = pending
+        if pending >= FRAME_HEADER.size:
+            needed = FRAME_HEADER.size + FRAME_HEADER.unpack_from(self._buf, self._start)[0]
+        if needed > len(self._buf):
+            # the size is from the other side: only grow as far as the bytes received justify
+            newbuf = bytearray(min(needed, 2 * len(self._buf)))
+        else:
+            newbuf = self._buf
+        # the slice copies just the partial message, so overlapping is not a concern
+        newbuf[0:pending] = self._buf[self._start:self._end]
+        if newbuf is not self._buf:
+            self._view.release()
+            self._buf = newbuf
+            self._view = memoryview(newbuf)
+        self._start = 0
+        self._end = pending
+
+    def _process(self):
+        '''process every complete message currently in the buffer'''
+        buf, view = self._buf, self._view
+        start, end = self._start, self._end
+        unpack_from, header_size = FRAME_HEADER.unpack_from, FRAME_HEADER.size
+        decode, processor, data = self.decode, self.processor, self.data
+        while end - start >= header_size:
+            sz = unpack_from(buf, start)[0]
+            if sz > self.MAX_MESSAGE:
+                raise ValueError(f'{self.name}: message of {sz} bytes, more than MAX_MESSAGE')
+            msg_start = start + header_size
+            if end - msg_start < sz:
+                break # not enough data to complete message
+            start = msg_start + sz
+            self._start = start
+            # copying a small message out is cheaper than making a memoryview slice of it
+            self.message = decode(buf[msg_start:start] if sz <= SMALL_MESSAGE else view[msg_start:start])
+            if processor is not None:
+                if data:
+                    processor(self.message, data)
                 else:
-                    # exactly enough or extra
-                    required_bytes = self.sz - len(self.msg)
-                    self.msg += b[0:required_bytes]
-                    # TODO: process message
-                    self.message = json.loads(self.msg.decode('utf-8'))
-                    #process_message(self)
-                    if self.processor is not None:
-                        if self.data:
-                            self.processor(self.message, self.data)
-                        else:
-                            self.processor(self.message)
-                    else:
-                        self.queue.put(self.message)
-                    b = b[required_bytes:]
-                    self.sz_bytes = b''
-                    self.remaining_sz_bytes = 4
-                    self.msg = b''
-                    self.sz = 0
-                    self.message = None
+                    processor(self.message)
+            else:
+                self.queue.put(self.message)
+            self.message = None
+        if start == end:
+            # everything processed, next recv can start at the front of the buffer
+            self._start = self._end = 0
+
+    def unprocessed(self):
+        '''
+        bytes received but not processed yet. Called from fn_processor, that's
+        everything after the message being processed
+        '''
+        return bytes(self._buf[self._start:self._end])
+
+    def decode(self, msgview):
+        '''Turn the bytes of one message body (a memoryview) into a message object'''
+        return decode_message(msgview)
 
     def get_message(self):
         if self.processor is not None:
             raise ValueError("MessageReciever not set up as queue")
         return self.queue.get(block=True)
+
+class LinkReceiver(MessageReceiver):
+    '''
+    MessageReceiver for a gateway link. Messages are (kind, connection id, payload
+    bytes) of the link packets, with a tuple of ids for LINK_MULTICAST
+    '''
+    def decode(self, msgview):
+        kind, conn_id = LINK_HEADER.unpack_from(msgview)
+        start = LINK_HEADER.size
+        if kind == LINK_MULTICAST:
+            conn_id = struct.unpack_from(f'<{conn_id}I', msgview, start)
+            start += 4 * len(conn_id)
+        return kind, conn_id, bytes(msgview[start:])
@@ -0,0 +1,234 @@
+'''st_gateway.py
+Edge gateway for st_server.py. Clients connect to the gateway instead of the
+server. The gateway does the message framing and the initconn handshake of
+every connection and passes their messages to the server over a single link
+(see GATEWAY LINK in st_common.py), each prefixed with its connection id. The
+server only sees one socket per gateway, and a message for many players (a die
+roll, chat) is one packet on the link that the gateway sends on to each of them.
+
+    $ python st_server.py --gateway-port 8090
+    $ python st_gateway.py --port 8089 --server-port 8090
+
+Clients connect to the gateway's --port exactly as they would to the server.
+'''
+
+import argparse
+import itertools
+import selectors
+import socket
+import time
+import traceback
+from st_common import MessageReceiver, LinkReceiver, decode_message, encode_link, parse_initconn
+from st_common import LINK_OPEN, LINK_DATA, LINK_CLOSE, LINK_MULTICAST, LINK_BROADCAST
+
+parser = argparse.ArgumentParser()
+parser.add_argument("-p", "--port", type=int, default=8089, help="TCP/IP port to listen for client connections")
+parser.add_argument("-s", "--server", default='localhost', help="IP/URL of the stock ticker game server")
+parser.add_argument("--server-port", type=int, default=8090, help="Gateway port of the server (st_server.py --gateway-port)")
+parser.add_argument("--handshake-sec", type=float, default=10, help="Seconds a new connection has to send its initconn message")
+parser.add_argument("--backlog", type=int, default=128, help="Connections the OS will queue for the gateway to accept")
+parser.add_argument("--outbuf-max", type=int, default=4*1024*1024, metavar='BYTES',
+        help="A connection with more than this waiting to be sent to it is closed (it isn't reading)")
+
+sel = selectors.DefaultSelector()
+
+class BodyReceiver(MessageReceiver):
+    '''MessageReceiver that leaves message bodies as bytes, the server decodes them'''
+    BUFSIZE = 4096 # client messages are small, grows if one isn't
+
+    def decode(self, msgview):
+        return bytes(msgview)
+
+class Connection:
+    '''
+    A client connection. Once its initconn has arrived it is opened on the server,
+    and its messages are passed on over the link from then on
+    '''
+    outbuf_max = parser.get_default('outbuf_max')
+
+    def __init__(self, gateway, conn, addr, conn_id, deadline):
+        self.gateway = gateway
+        self.conn = conn
+        self.addr = addr
+        self.conn_id = conn_id
+        self.deadline = deadline # for initconn, time.monotonic() value
+        self.opened = False      # LINK_OPEN sent to the server
+        self.accepted = False    # server accepted it, it gets broadcasts
+        self.closing = False     # server closed it, close once the outbound buffer is sent
+        self.closed = False
+        self._outbuf = bytearray()
+        self._events = selectors.EVENT_READ
+        self.message_receiver = BodyReceiver(f'conn-{conn_id}', conn, self.message_received, BodyReceiver.BUFSIZE)
+
+    def message_received(self, body):
+        if self.closed or self.closing:
+            return
+        if self.opened:
+            self.gateway.to_server(encode_link(LINK_DATA, self.conn_id, body))
+            return
+        try:
+            parse_initconn(decode_message(body))
+        except Exception:
+            print (f'Handshake from [{self.addr}] failed')
+            print(traceback.format_exc())
+            self.close()
+            return
+        self.opened = True
+        self.gateway.to_server(encode_link(LINK_OPEN, self.conn_id, body))
+
+    def send(self, data):
+        if self.closed:
+            return
+        self._outbuf += data
+        self.flush()
+        if len(self._outbuf) > self.outbuf_max and not self.closed:
+            print (f'Connection from [{self.addr}] closed, {len(self._outbuf)} bytes not sent')
+            self.close()
+
+    def flush(self):
+        '''send what the socket will take, and close it if it is closing and all has been sent'''
+        if self._outbuf and not self.closed:
+            try:
+                del self._outbuf[:self.conn.send(self._outbuf)]
+            except BlockingIOError:
+                pass
+            except OSError:
+                self._outbuf.clear()
+        if self.closing and not self._outbuf:
+            self.close(notify=False)
+            return
+        events = selectors.EVENT_READ | (selectors.EVENT_WRITE if self._outbuf else 0)
+        if not self.closed and events != self._events:
+            self._events = events
+            sel.modify(self.conn, events, self)
+
+    def close(self, notify=True):
+        '''notify: tell the server the connection is gone'''
+        if self.closed:
+            return
+        self.closed = True
+        if notify and self.opened:
+            self.gateway.to_server(encode_link(LINK_CLOSE, self.conn_id))
+        del self.gateway.connections[self.conn_id]
+        sel.unregister(self.conn)
+        self.conn.close()
+
+class Gateway:
+    '''The link to the server and the client connections it carries'''
+    def __init__(self, server, port):
+        self.link = socket.create_connection((server, port))
+        self.link.setblocking(False)
+        self.link.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.link_receiver = LinkReceiver('link', self.link, self.packet_received)
+        self.connections = dict() # connection id: Connection
+        self._ids = itertools.count(1)
+        self._outbuf = bytearray() # to the server, sent once per loop pass
+        self._link_events = selectors.EVENT_READ
+        sel.register(self.link, selectors.EVENT_READ, self)
+
+    def new_connection(self, conn, addr, deadline):
+        conn_id = next(self._ids)
+        self.connections[conn_id] = Connection(self, conn, addr, conn_id, deadline)
+        sel.register(conn, selectors.EVENT_READ, self.connections[conn_id])
+
+    def packet_received(self, packet):
+        kind, conn_id, payload = packet
+        if kind == LINK_BROADCAST:
+            for c in list(self.connections.values()):
+                if c.accepted:
+                    c.send(payload)
+        elif kind == LINK_MULTICAST:
+            for i in conn_id:
+                if c := self.connections.get(i):
+                    c.send(payload)
+        elif c := self.connections.get(conn_id):
+            if kind == LINK_DATA:
+                c.send(payload)
+            elif kind == LINK_OPEN:
+                c.accepted = True
+            elif kind == LINK_CLOSE:
+                c.closing = True
+                c.flush()
+
+    def to_server(self, packet):
+        self._outbuf += packet
+
+    def flush_link(self):
+        '''send what the link will take of everything passed on since the last call'''
+        if self._outbuf:
+            try:
+                del self._outbuf[:self.link.send(self._outbuf)]
+            except BlockingIOError:
+                pass
+        events = selectors.EVENT_READ | (selectors.EVENT_WRITE if self._outbuf else 0)
+        if events != self._link_events:
+            self._link_events = events
+            sel.modify(self.link, events, self)
+
+    def close(self):
+        for c in list(self.connections.values()):
+            c.flush() # best effort, e.g. server-exit
+            c.close(notify=False)
+        sel.unregister(self.link)
+        self.link.close()
+
+def serve(args):
+    Connection.outbuf_max = args.outbuf_max
+    gateway = Gateway(args.server, args.server_port)
+    serversocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    serversocket.bind(('localhost', args.port))
+    serversocket.listen(args.backlog)
+    sel.register(serversocket, selectors.EVENT_READ, "listen-new")
+    print (f'gateway on port {args.port}, linked to {args.server}:{args.server_port}')
+
+    running = True
+    while running:
+        try:
+            for key, mask in sel.select(timeout=1.0):
+                if key.data == "listen-new":
+                    conn, addr = key.fileobj.accept()
+                    conn.setblocking(False)
+                    gateway.new_connection(conn, addr, time.monotonic() + args.handshake_sec)
+                elif key.data is gateway:
+                    if mask & selectors.EVENT_READ:
+                        try:
+                            n = gateway.link_receiver.recv() # packets are passed on in here
+                        except (OSError, ValueError) as e:
+                            print (f'link recv Exc: {e}')
+                            n = 0
+                        if not n:
+                            print ('server closed the link')
+                            running = False
+                            break
+                else:
+                    c = key.data
+                    if mask & selectors.EVENT_WRITE:
+                        c.flush()
+                    if mask & selectors.EVENT_READ and not c.closed:
+                        try:
+                            n = c.message_receiver.recv()
+                        except (OSError, ValueError) as e:
+                            print (f'Connection from [{c.addr}] dropped: {e}')
+                            n = 0
+                        if not n:
+                            c.close()
+            gateway.flush_link()
+            now = time.monotonic()
+            for c in [ c for c in gateway.connections.values() if not c.opened and c.deadline < now ]:
+                print (f'Connection from [{c.addr}] dropped, no initconn received')
+                c.close()
+        except KeyboardInterrupt:
+            print ('#keyboard interrupt')
+            running = False
+        except Exception as e:
+            print (f'ERROR in gateway loop: {e}')
+            print (traceback.format_exc())
+    serversocket.close()
+    gateway.close()
+
+def main():
+    args = parser.parse_args()
+    serve(args)
+
+if __name__ == '__main__':
+    main()
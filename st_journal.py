@@ -0,0 +1,213 @@
+'''st_journal.py
+Append-only binary journal of a StockTickerGame, and a replay tool that rebuilds
+the final state of a game from its journal.
+
+Every record is the same size (RECORD) so a whole journal can be decoded with
+struct.iter_unpack.  Fields: record type, slot (uint32 player slot or roll
+action), stock, amount, value, and six int32s (share counts etc.), used as follows:
+
+    J_HEADER  value: start time (unix ms)  ints: INIT_VAL, OFF_MARKET_VAL, SPLIT_VAL, DIV_VAL, INIT_CASH, # stocks
+    J_JOIN    slot: player slot            value/ints: player name (utf-8, cut to 32 bytes)
+    J_LEAVE   slot
+    J_START   value: start time (unix ms)
+    J_ROLL    slot: action (index into ROLL_ACTIONS), stock, amount
+    J_ORDER   slot, value: cost in dollars, ints: shares bought(+)/sold(-) of each stock (approved orders only)
+    J_SPLIT   stock                        (result of a roll, for auditing. replay recalculates it)
+    J_BUST    stock                        (same)
+    J_DIV     stock, amount                (same)
+    J_END     value: end time (unix ms)
+
+Replay only needs the rule values from the header plus joins, leaves, rolls
+and orders. Splits, busts and dividends follow from the rolls.
+
+    $ python st_journal.py replay journals/default-game-xxxx.stj
+'''
+
+import argparse
+import struct
+import threading
+import queue
+import time
+from st_common import ROLL_ACTIONS
+
+RECORD = struct.Struct('<BIhiq6i')
+NAME_RECORD = struct.Struct('<BIhi32s') # J_JOIN: name in place of value and ints
+
+(J_HEADER, J_JOIN, J_LEAVE, J_START, J_ROLL, J_ORDER,
+    J_SPLIT, J_BUST, J_DIV, J_END) = range(10)
+
+NO_SHARES = (0, 0, 0, 0, 0, 0)
+
+def unix_ms():
+    return int(time.time() * 1000)
+
+class GameJournal:
+    '''
+    Writes the journal of one game. Calls only pack the record and put it on a
+    queue, the file writes happen on the journal's own thread so the game tick
+    never waits on the disk.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self._queue = queue.SimpleQueue()
+        self._thread = threading.Thread(target=self._write_records, name=f'journal-{path}', daemon=True)
+        self._thread.start()
+
+    def _write_records(self):
+        with open(self.path, 'ab', buffering=1<<16) as f:
+            while True:
+                rec = self._queue.get()
+                if rec is None:
+                    break
+                f.write(rec)
+                if self._queue.empty():
+                    f.flush()
+
+    def _append(self, rtype, slot=0, stock=0, amount=0, value=0, ints=NO_SHARES):
+        self._queue.put(RECORD.pack(rtype, slot, stock, amount, value, *ints))
+
+    def header(self, game):
+        self._append(J_HEADER, value=unix_ms(), ints=(game.INIT_VAL, game.OFF_MARKET_VAL,
+                game.SPLIT_VAL, game.DIV_VAL, game.INIT_CASH, len(game.market)))
+
+    def join(self, slot, name):
+        # cut to 32 bytes on a character boundary, so replay can decode it
+        name = name.encode('utf-8')[:32].decode('utf-8', 'ignore').encode('utf-8')
+        self._queue.put(NAME_RECORD.pack(J_JOIN, slot, 0, 0, name))
+
+    def leave(self, slot):
+        self._append(J_LEAVE, slot)
+
+    def start(self):
+        self._append(J_START, value=unix_ms())
+
+    def roll(self, roll):
+        self._append(J_ROLL, ROLL_ACTIONS.index(roll['action']), roll['stock'], roll['amount'])
+
+    def order(self, slot, cost, share_changes):
+        self._append(J_ORDER, slot, value=cost, ints=share_changes)
+
+    def split(self, i_stock):
+        self._append(J_SPLIT, stock=i_stock)
+
+    def bust(self, i_stock):
+        self._append(J_BUST, stock=i_stock)
+
+    def div(self, i_stock, amount):
+        self._append(J_DIV, stock=i_stock, amount=amount)
+
+    def end(self):
+        self._append(J_END, value=unix_ms())
+
+    def close(self):
+        '''finish writing everything queued and close the file'''
+        self._queue.put(None)
+        self._thread.join()
+
+class ReplayedGame:
+    '''Final state of a game rebuilt from its journal'''
+    def __init__(self):
+        self.market = None
+        self.players = dict()  # slot: [name, cash, [shares,...]]
+        self.left = dict()     # slot: [name, cash, [shares,...]] of players that left
+        self.rolls = 0
+        self.splits = 0
+        self.busts = 0
+        self.divs = 0
+        self.records = 0
+        self.started = None
+        self.ended = None
+
+def replay(data):
+    '''ReplayedGame from the bytes of a journal'''
+    game = ReplayedGame()
+    players = game.players
+    init_val = off_val = split_val = div_val = init_cash = None
+    market = None
+    n_splits = n_busts = n_divs = n_rolls = 0
+    i_rec = -1
+    for i_rec, (rtype, slot, stock, amount, value, s0, s1, s2, s3, s4, s5) in enumerate(RECORD.iter_unpack(data)):
+        if rtype == J_ROLL:
+            n_rolls += 1
+            if slot == 2: # DIV
+                if market[stock] >= div_val:
+                    for p in players.values():
+                        p[1] += int(p[2][stock] * amount / 100)
+                continue
+            price = market[stock] + (amount if slot == 0 else -amount)
+            if price >= split_val:
+                n_splits += 1
+                for p in players.values():
+                    shares = p[2][stock]
+                    p[1] += int(shares * 0.2)
+                    p[2][stock] = shares * 2
+                price = init_val
+            elif price <= off_val:
+                n_busts += 1
+                for p in players.values():
+                    p[2][stock] = 0
+                price = init_val
+            market[stock] = price
+        elif rtype == J_ORDER:
+            p = players[slot]
+            p[1] -= value
+            shares = p[2]
+            shares[0] += s0; shares[1] += s1; shares[2] += s2
+            shares[3] += s3; shares[4] += s4; shares[5] += s5
+        elif rtype == J_DIV:
+            n_divs += 1
+        elif rtype in (J_SPLIT, J_BUST):
+            pass # counted when the roll is replayed
+        elif rtype == J_JOIN:
+            name = NAME_RECORD.unpack_from(data, i_rec * RECORD.size)[4].rstrip(b'\0').decode('utf-8')
+            players[slot] = [name, init_cash, [0] * len(market)]
+        elif rtype == J_LEAVE:
+            game.left[slot] = players.pop(slot)
+        elif rtype == J_HEADER:
+            init_val, off_val, split_val, div_val, init_cash, n_stocks = s0, s1, s2, s3, s4, s5
+            market = [init_val] * n_stocks
+            game.started = value
+        elif rtype == J_START:
+            game.started = value
+        elif rtype == J_END:
+            game.ended = value
+        else:
+            raise ValueError(f'bad journal record type {rtype} (record #{i_rec})')
+    game.market = market
+    game.rolls, game.splits, game.busts, game.divs = n_rolls, n_splits, n_busts, n_divs
+    game.records = i_rec + 1
+    return game
+
+def networth(player, market):
+    name, cash, shares = player
+    return cash + int(sum(s * price for s, price in zip(shares, market)) / 100)
+
+def main():
+    parser = argparse.ArgumentParser()
+    sub = parser.add_subparsers(dest='command', required=True)
+    p_replay = sub.add_parser('replay', help="Rebuild and print the final state of a game")
+    p_replay.add_argument('journal', help="journal file")
+    p_replay.add_argument('--repeat', type=int, default=1, help="Replay this many times (for timing)")
+    args = parser.parse_args()
+
+    with open(args.journal, 'rb') as f:
+        data = f.read()
+    if len(data) % RECORD.size:
+        print (f'WARNING: journal ends with a partial record, ignoring {len(data) % RECORD.size} bytes')
+        data = data[:len(data) - len(data) % RECORD.size]
+    t0 = time.perf_counter()
+    for i in range(args.repeat):
+        game = replay(data)
+    elapsed = (time.perf_counter() - t0) / args.repeat
+
+    print (f'{game.records} records replayed in {elapsed*1000:.2f} ms ({game.records/elapsed:,.0f} records/s)')
+    print (f'{game.rolls} rolls, {game.splits} splits, {game.busts} busts, {game.divs} dividends paid'
+            + ('' if game.ended else '  (NO END RECORD - game did not finish)'))
+    print (f'market: {game.market}')
+    for p in sorted(game.players.values(), key=lambda p: networth(p, game.market), reverse=True):
+        print (f'  {p[0]:<20} net worth ${networth(p, game.market):<8} cash ${p[1]:<8} portfolio {p[2]}')
+    for p in game.left.values():
+        print (f'  {p[0]:<20} (left the game)')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+'''st_leaderboard.py
+Live ranking of the players in a game by net worth.
+
+Net worth (cash + int(portfolio value / 100)) is kept up to date from the
+changes the game reports (cash, holdings, prices) instead of being
+recalculated for every player. A price change only touches the players that
+hold the stock. Players are kept in a list sorted by net worth, so top-N is
+a slice and a player's rank is a bisect. Moving a player in the list is a
+bisect plus a memmove of the pointers after it: O(n), but a few microseconds
+for 10000 players, and it keeps top-N and rank simple.
+
+Changes are collected as they are reported and re-ranked in one go by
+commit(), which re-sorts the whole list instead when a large share of the
+players changed (e.g. a price move of a stock everybody holds).
+'''
+
+import bisect
+
+class Leaderboard:
+    def __init__(self, n_stocks, prices):
+        self._prices = list(prices)
+        self._cash = dict()          # slot: cash
+        self._value = dict()         # slot: portfolio value in cents
+        self._holdings = [ dict() for i in range(n_stocks) ] # per stock, slot: shares (holders only)
+        self._networth = dict()      # slot: net worth as ranked in _ranking
+        self._ranking = []           # sorted (-networth, slot)
+        self._dirty = set()          # slots changed since last commit()
+
+    def add(self, slot, cash):
+        self._cash[slot] = cash
+        self._value[slot] = 0
+        self._networth[slot] = cash
+        bisect.insort(self._ranking, (-cash, slot))
+
+    def remove(self, slot):
+        if slot not in self._networth:
+            return
+        self._unrank(self._networth.pop(slot), slot)
+        del self._cash[slot]
+        del self._value[slot]
+        for holders in self._holdings:
+            holders.pop(slot, None)
+        self._dirty.discard(slot)
+
+    def _unrank(self, networth, slot):
+        ranking = self._ranking
+        del ranking[bisect.bisect_left(ranking, (-networth, slot))]
+
+    def set_cash(self, slot, cash):
+        '''slot's cash. Like set_shares, ignored for a slot that isn't on the board (a player that has left)'''
+        if slot not in self._cash:
+            return
+        self._cash[slot] = cash
+        self._dirty.add(slot)
+
+    def set_shares(self, slot, stock, shares):
+        if slot not in self._value:
+            return
+        holders = self._holdings[stock]
+        self._value[slot] += (shares - holders.get(slot, 0)) * self._prices[stock]
+        if shares:
+            holders[slot] = shares
+        else:
+            holders.pop(slot, None)
+        self._dirty.add(slot)
+
+    def set_price(self, stock, price):
+        delta = price - self._prices[stock]
+        if not delta:
+            return
+        self._prices[stock] = price
+        value = self._value
+        for slot, shares in self._holdings[stock].items():
+            value[slot] += shares * delta
+        self._dirty.update(self._holdings[stock])
+
+    def commit(self):
+        '''re-rank the players changed since the last commit'''
+        dirty, self._dirty = self._dirty, set()
+        networth, ranking = self._networth, self._ranking
+        changed = []
+        for slot in dirty:
+            if slot not in networth:
+                continue
+            nw = self._cash[slot] + self._value[slot] // 100
+            if nw != networth[slot]:
+                changed.append((slot, networth[slot], nw))
+        if len(changed) * 8 > len(ranking):
+            for slot, old, nw in changed:
+                networth[slot] = nw
+            self._ranking = sorted((-nw, slot) for slot, nw in networth.items())
+        else:
+            for slot, old, nw in changed:
+                self._unrank(old, slot)
+                networth[slot] = nw
+                bisect.insort(ranking, (-nw, slot))
+
+    def networth(self, slot):
+        return self._networth[slot]
+
+    def rank(self, slot):
+        '''1 for the leader. Players with the same net worth share a rank'''
+        return bisect.bisect_left(self._ranking, (-self._networth[slot], -1)) + 1
+
+    def top(self, n=None):
+        '''[(slot, networth), ...] best first'''
+        return [ (slot, -nw) for (nw, slot) in self._ranking[:n] ]
+
+    def leaders(self):
+        '''(slots, networth) of the player(s) with the highest net worth'''
+        if not self._ranking:
+            return [], -1
+        best = self._ranking[0][0]
+        end = bisect.bisect_left(self._ranking, (best + 1, -1))
+        return [ slot for (nw, slot) in self._ranking[:end] ], -best
+
+    def __len__(self):
+        return len(self._ranking)
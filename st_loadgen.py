@@ -0,0 +1,387 @@
+'''st_loadgen.py
+Headless load generator for st_server.py. Opens N simulated players over the
+real wire protocol. They join a game, mark ready once everyone has joined, then
+place random buy/sell orders and chat at the given rates. At the end it reports
+messages/sec, tick fan-out latency, order round trip latency and server memory.
+--spectators adds connections that only watch the game (spectate messages).
+--throttle makes some of the players slow consumers that stop reading at full
+speed once the game starts, to see the server's --slow-policy at work: the
+report shows what the server queued, conflated, dropped and disconnected
+(queuestats), and the latencies of the other players, which should not change.
+
+    $ python st_loadgen.py --players 200 --duration 30 --spawn "-t 1"
+
+Tick fan-out latency for a die roll is how much later each player received it
+than the first player in the same game did. All players run on one thread in
+this process, so at high loads the numbers include the load generator's own
+delays (check the "loadgen busy" figure).
+'''
+
+import argparse
+import selectors
+import socket
+import subprocess
+import random
+import heapq
+import time
+import uuid
+import sys
+import os
+from st_common import MessageReceiver, encode_message, CAP_BINARY
+
+parser = argparse.ArgumentParser()
+parser.add_argument("-n", "--players", type=int, default=10, help="Number of simulated players")
+parser.add_argument("-s", "--server", default='localhost', help="IP/URL of stock ticker game server")
+parser.add_argument("-p", "--port", type=int, default=8089, help="Port of stock ticker game server")
+parser.add_argument("-d", "--duration", type=float, default=30, help="Seconds to run once all players are ready")
+parser.add_argument("--spectators", type=int, default=0, help="Number of simulated spectators, watching the game(s) of the players")
+parser.add_argument("--throttle", type=int, default=0, metavar='N',
+        help="Number of the players that read slowly once the game starts (slow consumers)")
+parser.add_argument("--throttle-bps", type=int, default=2048, help="Bytes per second a throttled player reads (0: none)")
+parser.add_argument("--order-rate", type=float, default=0.5, help="Average buy/sell orders per second, per player")
+parser.add_argument("--chat-rate", type=float, default=0.05, help="Average chat messages per second, per player")
+parser.add_argument("--json", action='store_true', help="Don't ask the server for binary game messages")
+parser.add_argument("--spread", action='store_true', help="Spread players over all games the server lists (default: first game only)")
+parser.add_argument("--spawn", metavar='SERVER_ARGS', default=None,
+        help="Start st_server.py on --port with these extra arguments (e.g. \"-t 1 -e asyncio\") and stop it at the end")
+parser.add_argument("--server-pid", type=int, default=None, help="pid of an already running server, to report its memory")
+
+def percentiles(values, pcts=(50, 90, 99)):
+    '''{pct: value} plus 'max', for a list of numbers'''
+    if not values:
+        return None
+    values = sorted(values)
+    result = { p: values[min(len(values)-1, int(len(values) * p / 100))] for p in pcts }
+    result['max'] = values[-1]
+    return result
+
+def fmt_ms(pcts):
+    if pcts is None:
+        return 'n/a'
+    return '  '.join(f'{"p"+str(k) if k != "max" else k}={v*1000:.2f}ms' for k, v in pcts.items())
+
+def rss_kb(pid):
+    '''resident memory of process pid in KiB (Linux only, None elsewhere)'''
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except OSError:
+        return None
+
+class Stats:
+    def __init__(self):
+        self.msg_count = 0
+        self.msg_types = dict()
+        self.errors = 0
+        self.roll_arrivals = dict() # (gamename, roll#): [arrival times]
+        self.order_latency = []     # seconds from buysell sent to approve received
+        self.orders_approved = 0
+        self.orders_rejected = 0
+        self.spectate_gaps = []     # seconds between a spectator's spectate messages
+        self.throttled_read = 0     # bytes read by throttled players
+        self.throttled_dropped = 0  # throttled players the server disconnected
+        self.queuestats = None      # latest queuestats from the server
+
+class Bot:
+    '''One simulated player'''
+    def __init__(self, loadgen, index, name, conn, spectator=False):
+        self.loadgen = loadgen
+        self.spectator = spectator # only watches: no ready, orders or chat
+        self.throttled = False     # slow consumer: reads --throttle-bps, no orders or chat
+        self.gone = False          # throttled player disconnected by the server
+        self.index = index
+        self.stats = loadgen.stats
+        self.name = name
+        self.conn = conn
+        self.msgrec = MessageReceiver(name, conn, self.message_received)
+        self.outbuf = bytearray()
+        self.gamename = None
+        self.joined = False
+        self.rolls = 0
+        self.market = [ 100 for i in range(6) ]
+        self.portfolio = [ 0 for i in range(6) ]
+        self.cash = 0
+        self.orders = dict() # reqid: time sent
+        self.last_spectate = None
+
+    def send(self, mtype, data):
+        self.outbuf += encode_message(mtype, data)
+        self.flush()
+
+    def flush(self):
+        if self.outbuf:
+            try:
+                sent = self.conn.send(self.outbuf)
+                del self.outbuf[:sent]
+            except BlockingIOError:
+                pass
+        self.loadgen.want_write(self, bool(self.outbuf))
+
+    def message_received(self, message):
+        now = time.perf_counter()
+        mtype, mdata = message['TYPE'], message['DATA']
+        stats = self.stats
+        stats.msg_count += 1
+        stats.msg_types[mtype] = stats.msg_types.get(mtype, 0) + 1
+        if mtype == 'roll':
+            self.rolls += 1
+            if self.throttled:
+                return
+            stats.roll_arrivals.setdefault((self.gamename, self.rolls), []).append(now)
+        elif mtype in ('markettick', 'split', 'offmarket'):
+            self.market[mdata['stock']] = mdata['newprice']
+            if mtype != 'markettick':
+                self.portfolio[mdata['stock']] = mdata['shares']
+            if 'playercash' in mdata:
+                self.cash = mdata['playercash']
+        elif mtype == 'div':
+            self.cash = mdata['playercash']
+        elif mtype == 'approve':
+            sent = self.orders.pop(mdata['reqid'], None)
+            if sent is not None:
+                stats.order_latency.append(now - sent)
+            if mdata['approved']:
+                stats.orders_approved += 1
+                self.cash = mdata['cash']
+                self.portfolio = list(mdata['portfolio'])
+            else:
+                stats.orders_rejected += 1
+        elif mtype == 'conn-accept':
+            games = mdata
+            if self.loadgen.spread:
+                self.gamename, gid = games[self.index % len(games)]
+            else:
+                self.gamename, gid = games[0]
+            self.send('spectate' if self.spectator else 'join-game', (self.gamename, gid))
+        elif mtype == 'spectate':
+            if self.last_spectate is None:
+                self.joined = True
+                self.loadgen.bot_joined(self)
+            else:
+                stats.spectate_gaps.append(now - self.last_spectate)
+            self.last_spectate = now
+        elif mtype == 'initgame':
+            self.cash = mdata['cash']
+            self.portfolio = list(mdata['portfolio'])
+            self.market = [ price for (price, div) in mdata['market'] ]
+            self.joined = True
+            self.loadgen.bot_joined(self)
+        elif mtype == 'queuestats':
+            stats.queuestats = mdata
+        elif mtype in ('error', 'joinfail'):
+            stats.errors += 1
+
+    def place_order(self):
+        i_stock = random.randrange(6)
+        price = self.market[i_stock]
+        order = [ (0, p) for p in self.market ]
+        if self.portfolio[i_stock] and random.random() < 0.5:
+            shares = -min(self.portfolio[i_stock], random.choice((100, 500, 1000)))
+        else:
+            affordable = int(self.cash * 100 / price) // 100 * 100 if price > 0 else 0
+            shares = min(affordable, random.choice((100, 500, 1000)))
+        if not shares:
+            return
+        order[i_stock] = (shares, price)
+        reqid = str(uuid.uuid4())
+        self.orders[reqid] = time.perf_counter()
+        self.send('buysell', {'reqid': reqid, 'data': order})
+
+    def chat(self):
+        self.send('msg', f'{self.name} says hello #{random.randrange(1000)}')
+
+    def read_some(self, nbytes):
+        '''throttled player: read at most nbytes of what the server sent'''
+        if self.gone or nbytes <= 0:
+            return
+        try:
+            n = self.conn.recv_into(self.msgrec.get_buffer()[:nbytes])
+        except BlockingIOError:
+            return
+        except OSError:
+            n = 0
+        if not n:
+            self.gone = True
+            self.stats.throttled_dropped += 1
+            self.loadgen.want_write(self, False)
+            return
+        self.stats.throttled_read += n
+        self.msgrec.buffer_updated(n)
+
+class LoadGen:
+    def __init__(self, args):
+        self.args = args
+        self.spread = args.spread
+        self.stats = Stats()
+        self.sel = selectors.DefaultSelector()
+        self.bots = []
+        self.n_joined = 0
+        self.timers = [] # heap of (time, seq, bot, action)
+        self.seq = 0
+        self.busy = 0.0  # seconds spent handling events (vs. waiting in select)
+
+    def want_write(self, bot, bln_write):
+        '''update the selector registration of bot (throttled players aren't read from here)'''
+        events = (selectors.EVENT_READ if not bot.throttled else 0) | (selectors.EVENT_WRITE if bln_write and not bot.gone else 0)
+        key = self.sel.get_map().get(bot.conn)
+        if not events:
+            if key is not None:
+                self.sel.unregister(bot.conn)
+        elif key is None:
+            self.sel.register(bot.conn, events, bot)
+        elif key.events != events:
+            self.sel.modify(bot.conn, events, bot)
+
+    def bot_joined(self, bot):
+        self.n_joined += 1
+
+    def schedule(self, when, bot, action, rate):
+        if rate > 0:
+            self.seq += 1
+            heapq.heappush(self.timers, (when + random.expovariate(rate), self.seq, bot, action))
+
+    def connect(self):
+        for i in range(self.args.players + self.args.spectators):
+            spectator = i >= self.args.players
+            if self.args.players - self.args.throttle <= i < self.args.players:
+                # small receive window, so what it doesn't read backs up on the server quickly
+                conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                conn.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 8192)
+                conn.connect((self.args.server, self.args.port))
+            else:
+                conn = socket.create_connection((self.args.server, self.args.port))
+            conn.setblocking(False)
+            bot = Bot(self, i, f'{"spec" if spectator else "bot"}{i}-{os.getpid()}', conn, spectator)
+            self.bots.append(bot)
+            self.sel.register(conn, selectors.EVENT_READ, bot)
+            bot.send('initconn', {'name': bot.name, 'caps': [] if self.args.json else [CAP_BINARY]})
+
+    def poll(self, timeout):
+        events = self.sel.select(timeout)
+        t0 = time.perf_counter()
+        for key, mask in events:
+            bot = key.data
+            if mask & selectors.EVENT_WRITE:
+                bot.flush()
+            if mask & selectors.EVENT_READ:
+                if not bot.msgrec.recv():
+                    raise RuntimeError(f'server closed connection of {bot.name}')
+        self.busy += time.perf_counter() - t0
+
+    def run(self):
+        self.connect()
+        print (f'{len(self.bots)} players connected')
+        while self.n_joined < len(self.bots):
+            self.poll(1.0)
+        print (f'{len(self.bots)} players joined, all ready')
+        players = [ bot for bot in self.bots if not bot.spectator ]
+        for bot in players:
+            bot.send('readystart', None)
+        throttled = players[len(players)-self.args.throttle:] if self.args.throttle else []
+        for bot in throttled:
+            bot.throttled = True
+            self.want_write(bot, bool(bot.outbuf))
+        players = players[:len(players)-len(throttled)]
+
+        self.stats = Stats()
+        for bot in self.bots:
+            bot.stats = self.stats
+        t_start = time.perf_counter()
+        t_stop = t_start + self.args.duration
+        self.busy = 0.0
+        for bot in players:
+            self.schedule(t_start, bot, Bot.place_order, self.args.order_rate)
+            self.schedule(t_start, bot, Bot.chat, self.args.chat_rate)
+        max_rss = None
+        t_report = t_start + 1
+        t_throttle = t_start
+        n_last = 0
+        while (now := time.perf_counter()) < t_stop:
+            if throttled and now >= t_throttle:
+                for bot in throttled:
+                    bot.read_some(self.args.throttle_bps // 10)
+                t_throttle += 0.1
+            while self.timers and self.timers[0][0] <= now:
+                when, seq, bot, action = heapq.heappop(self.timers)
+                action(bot)
+                self.schedule(now, bot, action, self.args.order_rate if action is Bot.place_order else self.args.chat_rate)
+            timeout = min(t_report, t_throttle if throttled else t_report, self.timers[0][0] if self.timers else t_report) - now
+            self.poll(max(0, timeout))
+            if now >= t_report:
+                rss = rss_kb(self.args.server_pid) if self.args.server_pid else None
+                if rss is not None:
+                    max_rss = max(rss, max_rss or 0)
+                qs = self.stats.queuestats
+                print (f'{now - t_start:5.0f}s  {self.stats.msg_count - n_last:8d} msgs/s'
+                        + (f'  server rss {rss/1024:.1f} MiB' if rss is not None else '')
+                        + (f'  queued {qs["queued"]/1024:.0f} KiB (max {qs["max-queued"]/1024:.0f}), {qs["slow-now"]} slow' if qs else ''))
+                n_last = self.stats.msg_count
+                t_report += 1
+                players[0].send('queuestats', None)
+        self.report(time.perf_counter() - t_start, max_rss)
+
+    def report(self, elapsed, max_rss):
+        stats = self.stats
+        fanout = []
+        for arrivals in stats.roll_arrivals.values():
+            first = min(arrivals)
+            fanout.extend(t - first for t in arrivals)
+        print ()
+        print (f'players:              {self.args.players}' + (f' (+{self.args.spectators} spectators)' if self.args.spectators else ''))
+        print (f'elapsed:              {elapsed:.1f}s (loadgen busy {100*self.busy/elapsed:.0f}%)')
+        print (f'messages received:    {stats.msg_count} ({stats.msg_count/elapsed:.0f}/s)')
+        print (f'  by type:            ' + ', '.join(f'{k}={v}' for k, v in sorted(stats.msg_types.items())))
+        print (f'die rolls:            {len(stats.roll_arrivals)}')
+        print (f'tick fan-out latency: {fmt_ms(percentiles(fanout))}')
+        print (f'orders:               {stats.orders_approved} approved, {stats.orders_rejected} rejected')
+        print (f'order round trip:     {fmt_ms(percentiles(stats.order_latency))}')
+        if self.args.spectators:
+            print (f'spectator updates:    {len(stats.spectate_gaps)/self.args.spectators/elapsed:.2f}/s per spectator,'
+                    f' interval {fmt_ms(percentiles(stats.spectate_gaps))}')
+        if self.args.throttle:
+            print (f'throttled players:    {self.args.throttle}, read {stats.throttled_read} bytes, '
+                    f'{stats.throttled_dropped} saw their connection closed')
+        if qs := stats.queuestats:
+            print (f'server queues:        {qs["queued"]} bytes queued (max {qs["max-queued"]}), {qs["slow-now"]} slow now, '
+                    f'{qs["went-slow"]} went slow, {qs["conflated"]} conflated, {qs["chat-dropped"]} chat dropped, '
+                    f'{qs["disconnected"]} disconnected')
+            if 'lanes' in qs:
+                print (f'server queue delay:   ' + '  '.join(f'{name} {d["queued"]} avg={d["avg-ms"]:.2f}ms max={d["max-ms"]:.2f}ms'
+                                                          for name, d in qs['lanes'].items()))
+        print (f'errors from server:   {stats.errors}')
+        if self.args.server_pid:
+            rss = rss_kb(self.args.server_pid)
+            if rss is not None:
+                print (f'server rss:           {rss/1024:.1f} MiB (max seen {(max_rss or rss)/1024:.1f} MiB)')
+
+def spawn_server(port, server_args):
+    cmd = [ sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'st_server.py'),
+            '-p', str(port) ] + server_args.split()
+    proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL)
+    for i in range(50):
+        try:
+            socket.create_connection(('localhost', port)).close()
+            return proc
+        except ConnectionRefusedError:
+            time.sleep(0.1)
+    proc.kill()
+    raise RuntimeError('spawned server did not start listening')
+
+def main():
+    args = parser.parse_args()
+    proc = None
+    if args.spawn is not None:
+        proc = spawn_server(args.port, args.spawn)
+        args.server = 'localhost'
+        args.server_pid = proc.pid
+    try:
+        LoadGen(args).run()
+    finally:
+        if proc:
+            proc.terminate()
+            proc.wait()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,162 @@
+'''st_marketfeed.py
+A game's market in shared memory, for bots and dashboards running on the same
+machine as the server (st_server.py --marketfeed PREFIX). Readers map the
+segment and read the prices straight out of it: no connection, no decoding of
+markettick messages, and nothing for the server to do per reader.
+
+The segment (named PREFIX-<game name>) is laid out as:
+
+    HEADER  magic b'STMF', layout version, number of stocks, seq
+    BODY    tick (die rolls so far), time of the tick (unix seconds), game status,
+            last roll (stock, action index into ROLL_ACTIONS, amount; action
+            NO_ROLL before the first roll), bitmask of the stocks paying dividends,
+            then the price of each stock
+
+The server is the only writer and updates the body under a seqlock: seq is
+made odd before the body is written and even again after. A reader reads seq,
+the body, then seq again and keeps the body only if seq was even and didn't
+change, so neither side ever waits on the other. Every write and read of the
+segment is a single struct call (one copy in CPython).
+
+    feed = MarketFeedReader('st-default-game')
+    feed.read()   # {'seq', 'tick', 'time', 'status', 'roll', 'market': [(price, pays dividend),...]}
+    feed.seq()    # cheap check for a new tick
+
+    $ python st_marketfeed.py st-default-game
+'''
+
+import argparse
+import struct
+import time
+from multiprocessing import shared_memory
+from multiprocessing import resource_tracker
+from st_common import ROLL_ACTIONS
+
+MAGIC = b'STMF'
+VERSION = 1
+HEADER = struct.Struct('<4sBBxxQ') # magic, version, stocks, seq
+SEQ = struct.Struct('<Q')
+SEQ_OFFSET = HEADER.size - SEQ.size
+NO_ROLL = 255
+
+# game status, same values as StockTickerGame.STATUS_*
+STATUS_NAMES = ('WAITING-START', 'RUNNING', 'ENDED')
+
+def body_struct(n_stocks):
+    return struct.Struct(f'<QdBBBBH{n_stocks}h')
+
+class MarketFeed:
+    '''
+    Writer side, owned by one game. publish() must only be called by one thread
+    at a time (the game calls it with its game_lock on)
+    '''
+    def __init__(self, name, n_stocks):
+        self.name = name
+        self.n_stocks = n_stocks
+        self._body = body_struct(n_stocks)
+        size = HEADER.size + self._body.size
+        try:
+            self._shm = shared_memory.SharedMemory(name, create=True, size=size)
+        except FileExistsError:
+            # left behind by a server that didn't shut down cleanly
+            print (f'market feed {name} already exists, taking it over')
+            stale = shared_memory.SharedMemory(name)
+            stale.close()
+            stale.unlink()
+            self._shm = shared_memory.SharedMemory(name, create=True, size=size)
+        self._buf = self._shm.buf
+        self._seq = 0
+        HEADER.pack_into(self._buf, 0, MAGIC, VERSION, n_stocks, self._seq)
+
+    def publish(self, tick, status, roll, market, divmask):
+        '''
+        tick: number of die rolls so far. roll: (stock, action, amount) of the last roll
+        or None. market: prices. divmask: bit i set if stock i pays dividends
+        '''
+        stock, action, amount = roll if roll else (0, NO_ROLL, 0)
+        if isinstance(action, str):
+            action = ROLL_ACTIONS.index(action)
+        buf = self._buf
+        self._seq += 1
+        SEQ.pack_into(buf, SEQ_OFFSET, self._seq) # odd: body being written
+        self._body.pack_into(buf, HEADER.size, tick, time.time(), status, stock, action, divmask, amount, *market)
+        self._seq += 1
+        SEQ.pack_into(buf, SEQ_OFFSET, self._seq)
+
+    def close(self):
+        '''remove the segment. Readers that still have it mapped keep the last market'''
+        self._buf = None
+        self._shm.close()
+        self._shm.unlink()
+
+class MarketFeedReader:
+    '''Reader side. Any number of processes can read the same feed'''
+    def __init__(self, name):
+        self.name = name
+        try:
+            self._shm = shared_memory.SharedMemory(name, track=False)
+        except TypeError:
+            # before python 3.13 every process that opens a segment registers it, and
+            # unlinks it when it exits. Only the server should
+            self._shm = shared_memory.SharedMemory(name)
+            resource_tracker.unregister(self._shm._name, 'shared_memory')
+        self._buf = self._shm.buf
+        magic, version, self.n_stocks, seq = HEADER.unpack_from(self._buf)
+        if magic != MAGIC or version != VERSION:
+            self.close()
+            raise ValueError(f'{name} is not a version {VERSION} market feed')
+        self._body = body_struct(self.n_stocks)
+
+    def seq(self):
+        '''changes with every tick published. Odd while one is being written'''
+        return SEQ.unpack_from(self._buf, SEQ_OFFSET)[0]
+
+    def read(self):
+        '''consistent copy of the current market (retries while a tick is being written)'''
+        buf, body = self._buf, self._body
+        while True:
+            seq = SEQ.unpack_from(buf, SEQ_OFFSET)[0]
+            if seq & 1:
+                continue
+            vals = body.unpack_from(buf, HEADER.size)
+            if SEQ.unpack_from(buf, SEQ_OFFSET)[0] == seq:
+                break
+        tick, t, status, stock, action, divmask, amount = vals[:7]
+        return {'seq': seq,
+                'tick': tick,
+                'time': t,
+                'status': STATUS_NAMES[status],
+                'roll': None if action == NO_ROLL else {'stock': stock, 'action': ROLL_ACTIONS[action], 'amount': amount},
+                'market': [ (price, bool(divmask & (1 << i))) for i, price in enumerate(vals[7:]) ]}
+
+    def close(self):
+        self._buf = None
+        self._shm.close()
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("name", help="Market feed to read, PREFIX-<game name> (see st_server.py --marketfeed)")
+    parser.add_argument("--interval", type=float, default=0.05, help="Seconds between checks for a new tick")
+    args = parser.parse_args()
+
+    feed = MarketFeedReader(args.name)
+    last = None
+    try:
+        while True:
+            seq = feed.seq()
+            if seq != last and not seq & 1:
+                m = feed.read()
+                last = m['seq']
+                prices = '  '.join(f'{p:4d}{"*" if div else " "}' for (p, div) in m['market'])
+                roll = m['roll']
+                roll = f'{roll["stock"]} {roll["action"]:<4} {roll["amount"]:2d}' if roll else '-'
+                print (f'{m["tick"]:5d} {m["status"]:<13} {roll:<10} {prices}')
+                if m['status'] == 'ENDED':
+                    break
+            time.sleep(args.interval)
+    except KeyboardInterrupt:
+        pass
+    feed.close()
+
+if __name__ == '__main__':
+    main()
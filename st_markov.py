@@ -0,0 +1,242 @@
+'''st_markov.py
+Exact odds for a single stock, from the Markov chain of its price.
+
+A stock's price only moves in steps of the amount die, between OFF_MARKET_VAL
+and SPLIT_VAL, and goes back to INIT_VAL after a split or a bust. That makes
+it a small Markov chain (39 prices with the standard rules) whose transition
+matrix comes straight from the die definitions of StockTickerGame. Matrix
+powers and per-roll tables are computed once, cached to disk, and after that
+every query is a table lookup:
+
+    odds = MarketOdds.load()
+    odds.prob_split_within(150, 10)    # chance of a split in the next 10 rolls
+    odds.expected_dividend(110, 50)    # $ per share held now, over 50 rolls
+    odds.price_distribution(100, 20)   # {price: probability} after 20 rolls
+
+A roll means one die roll of the game (any stock). With
+option_ignore_nopay_divrolls, whether a roll lands on this stock depends on
+how many *other* stocks don't pay dividends (those DIV rolls are re-rolled).
+That is modelled by treating the other stocks as independent copies of this
+chain in its long run distribution (mean field), so the tables are exact
+without the option and a close approximation with it.
+
+    $ python st_markov.py --price 150 --rolls 10
+'''
+
+import argparse
+import math
+import os
+import pickle
+import time
+
+import st_server
+
+CACHE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.st_markov_cache.pkl')
+SPLIT_DIV_CENTS = 20 # dividend per share paid on a split ($0.20, see _process_split)
+
+def rules_key(rules, max_rolls):
+    '''everything the tables depend on. Cached tables are only used if this matches'''
+    return (rules.INIT_VAL, rules.OFF_MARKET_VAL, rules.SPLIT_VAL, rules.DIV_VAL,
+            tuple(rules.STOCK_DIE), tuple(rules.ACTION_DIE), tuple(rules.AMOUNT_DIE),
+            rules.option_ignore_nopay_divrolls, max_rolls)
+
+def mat_mult(a, b):
+    cols = list(zip(*b))
+    return [ [ sum(x*y for x, y in zip(row, col)) for col in cols ] for row in a ]
+
+def mat_vec(a, v):
+    return [ sum(x*y for x, y in zip(row, v)) for row in a ]
+
+def binomial_pmf(n, q):
+    return [ math.comb(n, m) * q**m * (1-q)**(n-m) for m in range(n+1) ]
+
+class MarketOdds:
+    def __init__(self, rules, max_rolls=300):
+        '''
+        Build all tables for rules (a StockTickerGame) for up to max_rolls rolls.
+        Use MarketOdds.load() to get cached tables instead of rebuilding.
+        '''
+        self.key = rules_key(rules, max_rolls)
+        self.max_rolls = max_rolls
+        self.init_val = rules.INIT_VAL
+        step = math.gcd(rules.INIT_VAL, *rules.AMOUNT_DIE)
+        first = rules.OFF_MARKET_VAL + step - (rules.OFF_MARKET_VAL - rules.INIT_VAL) % step
+        self.prices = list(range(first if first > rules.OFF_MARKET_VAL else first + step, rules.SPLIT_VAL, step))
+        self.index = { p: i for i, p in enumerate(self.prices) }
+        self._build(rules)
+
+    def _stock_odds(self, rules, pays, q_others):
+        '''
+        Probability that a roll is (UP, amount), (DOWN, amount) or (DIV, amount)
+        for this stock. pays: whether this stock pays dividends now. q_others:
+        probability each other stock doesn't pay (only matters when no-pay DIV
+        rolls are re-rolled)
+        '''
+        n_stocks, n_actions, n_amounts = len(rules.STOCK_DIE), len(rules.ACTION_DIE), len(rules.AMOUNT_DIE)
+        n_outcomes = n_stocks * n_actions * n_amounts
+        if not rules.option_ignore_nopay_divrolls:
+            p_outcome = 1 / n_outcomes
+            return p_outcome, (p_outcome if pays else 0)
+        # each non-paying stock removes its DIV outcomes from the rolls that count
+        p_outcome = 0
+        for m, p_m in enumerate(binomial_pmf(n_stocks - 1, q_others)):
+            nopay = m + (0 if pays else 1)
+            p_outcome += p_m / (n_outcomes - nopay * n_amounts)
+        return p_outcome, (p_outcome if pays else 0)
+
+    def _transitions(self, rules, q_others):
+        '''
+        one roll transition matrix, plus per price: probability of split,
+        probability of bust, expected dividend cents per share
+        '''
+        n = len(self.prices)
+        init = self.index[rules.INIT_VAL]
+        trans = [ [0.0] * n for i in range(n) ]
+        split = [0.0] * n
+        bust = [0.0] * n
+        divs = [0.0] * n
+        # share multiplier weighted transitions: split doubles a share, bust wipes it out
+        share_trans = [ [0.0] * n for i in range(n) ]
+        for i, price in enumerate(self.prices):
+            pays = price >= rules.DIV_VAL
+            p_move, p_div = self._stock_odds(rules, pays, q_others)
+            p_stay = 1.0
+            for amount in rules.AMOUNT_DIE:
+                for newprice in (price + amount, price - amount):
+                    p_stay -= p_move
+                    if newprice >= rules.SPLIT_VAL:
+                        trans[i][init] += p_move
+                        share_trans[i][init] += 2 * p_move
+                        split[i] += p_move
+                        divs[i] += p_move * SPLIT_DIV_CENTS
+                    elif newprice <= rules.OFF_MARKET_VAL:
+                        trans[i][init] += p_move
+                        bust[i] += p_move
+                    else:
+                        trans[i][self.index[newprice]] += p_move
+                        share_trans[i][self.index[newprice]] += p_move
+                divs[i] += p_div * amount # dividend of amount cents per share
+            trans[i][i] += p_stay # other stocks rolled, or a DIV roll for this one
+            share_trans[i][i] += p_stay
+        return trans, split, bust, divs, share_trans
+
+    def _stationary(self, trans):
+        dist = [ 1.0 / len(trans) ] * len(trans)
+        for i in range(10000):
+            new = [ sum(dist[i] * trans[i][j] for i in range(len(dist))) for j in range(len(dist)) ]
+            if max(abs(a-b) for a, b in zip(new, dist)) < 1e-13:
+                break
+            dist = new
+        return new
+
+    def _build(self, rules):
+        # mean field: q = long run chance another stock doesn't pay dividends
+        q = 0.5
+        for i in range(100):
+            trans = self._transitions(rules, q)[0]
+            pi = self._stationary(trans)
+            new_q = sum(p for price, p in zip(self.prices, pi) if price < rules.DIV_VAL)
+            if abs(new_q - q) < 1e-12:
+                break
+            q = new_q
+        self.q_nopay = q
+        trans, split, bust, divs, share_trans = self._transitions(rules, q)
+        self.transition = trans
+        n = len(self.prices)
+
+        # no_split[i][j]: transitions that don't split (for first passage to a split), same for busts
+        init = self.index[rules.INIT_VAL]
+        no_split = [ row[:] for row in trans ]
+        no_bust = [ row[:] for row in trans ]
+        for i in range(n):
+            no_split[i][init] -= split[i]
+            no_bust[i][init] -= bust[i]
+
+        # tables[k][i] for k = 0..max_rolls rolls, starting from price index i
+        self.powers = [ [ [ 1.0 if i == j else 0.0 for j in range(n) ] for i in range(n) ] ]
+        self.split_within = [ [0.0] * n ]
+        self.bust_within = [ [0.0] * n ]
+        self.dividend = [ [0.0] * n ]   # expected dividend cents per share held now
+        self.share_value = [ self.prices[:] ] # expected value (cents) of a share held now, incl. splits/busts
+        for k in range(1, self.max_rolls + 1):
+            self.powers.append(mat_mult(self.powers[-1], trans))
+            self.split_within.append([ s + x for s, x in zip(split, mat_vec(no_split, self.split_within[-1])) ])
+            self.bust_within.append([ b + x for b, x in zip(bust, mat_vec(no_bust, self.bust_within[-1])) ])
+            self.dividend.append([ d + x for d, x in zip(divs, mat_vec(share_trans, self.dividend[-1])) ])
+            self.share_value.append(mat_vec(share_trans, self.share_value[-1]))
+
+    @classmethod
+    def load(cls, rules=None, max_rolls=300, cache_file=CACHE_FILE):
+        '''
+        MarketOdds for rules (default: a new StockTickerGame's rules) from the
+        cache file, building and saving the tables if they aren't cached yet
+        '''
+        if rules is None:
+            rules = st_server.StockTickerGame('markov')
+        key = rules_key(rules, max_rolls)
+        try:
+            with open(cache_file, 'rb') as f:
+                odds = pickle.load(f)
+            if isinstance(odds, cls) and odds.key == key:
+                return odds
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError):
+            pass
+        odds = cls(rules, max_rolls)
+        with open(cache_file, 'wb') as f:
+            pickle.dump(odds, f)
+        return odds
+
+    def _i(self, price):
+        try:
+            return self.index[price]
+        except KeyError:
+            raise ValueError(f'{price} is not a possible stock price') from None
+
+    def _k(self, rolls):
+        if not 0 <= rolls <= self.max_rolls:
+            raise ValueError(f'rolls must be 0-{self.max_rolls}')
+        return rolls
+
+    def prob_split_within(self, price, rolls):
+        '''probability a stock at price splits at least once in the next rolls'''
+        return self.split_within[self._k(rolls)][self._i(price)]
+
+    def prob_bust_within(self, price, rolls):
+        '''probability a stock at price goes off market at least once in the next rolls'''
+        return self.bust_within[self._k(rolls)][self._i(price)]
+
+    def expected_dividend(self, price, rolls):
+        '''expected dividends ($) earned in the next rolls by one share held now (and its splits)'''
+        return self.dividend[self._k(rolls)][self._i(price)] / 100
+
+    def expected_share_value(self, price, rolls):
+        '''expected value ($) after rolls of one share held now, counting splits and busts'''
+        return self.share_value[self._k(rolls)][self._i(price)] / 100
+
+    def price_distribution(self, price, rolls):
+        '''{price: probability} of the stock's price after rolls'''
+        row = self.powers[self._k(rolls)][self._i(price)]
+        return { p: x for p, x in zip(self.prices, row) if x > 0 }
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--price", type=int, default=100, help="Current stock price (cents)")
+    parser.add_argument("--rolls", type=int, default=10, help="Number of rolls to look ahead")
+    parser.add_argument("--max-rolls", type=int, default=300, help="Build tables for up to this many rolls")
+    parser.add_argument("--cache", default=CACHE_FILE, help="Cache file for the tables")
+    args = parser.parse_args()
+
+    t0 = time.perf_counter()
+    odds = MarketOdds.load(max_rolls=args.max_rolls, cache_file=args.cache)
+    print (f'tables ready in {time.perf_counter()-t0:.2f}s ({len(odds.prices)} prices, {odds.max_rolls} rolls)')
+    p, k = args.price, args.rolls
+    print (f'stock at {p}, next {k} rolls:')
+    print (f'  split:              {odds.prob_split_within(p, k):.4f}')
+    print (f'  off market:         {odds.prob_bust_within(p, k):.4f}')
+    print (f'  dividend per share: ${odds.expected_dividend(p, k):.4f}')
+    print (f'  value of a share:   ${odds.expected_share_value(p, k):.4f} (now ${p/100:.2f})')
+    dist = odds.price_distribution(p, k)
+    print (f'  expected price:     {sum(price*x for price, x in dist.items()):.2f}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,167 @@
+'''st_montecarlo.py
+Monte Carlo simulation of the stock market of many Stock Ticker games at once,
+for studying rule variants. The rules (prices, dice, options) are read from a
+StockTickerGame, then thousands of independent markets are advanced together as
+NumPy arrays, one die roll per step. Splits, busts and dividends are applied to
+all markets with masks.
+
+Each simulated market tracks what happens to one share of each stock held
+from the start of the game: splits double it, busts wipe it out, dividends
+(including the split dividend) are added up.
+
+    $ python st_montecarlo.py --games 1000000
+    $ python st_montecarlo.py --games 100000 --split-val 250 --amount-die 5,10,20,30
+'''
+
+import argparse
+import time
+
+try:
+    import numpy as np
+except ModuleNotFoundError:
+    print ("[numpy] library not installed.")
+    print ("try > pip install numpy")
+    exit (1)
+
+import st_server
+
+parser = argparse.ArgumentParser()
+parser.add_argument("-n", "--games", type=int, default=100000, help="Number of games to simulate")
+parser.add_argument("-r", "--rolls", type=int, default=None,
+        help="Die rolls per game (default: game length / seconds between rolls, from st_server defaults)")
+parser.add_argument("-b", "--batch", type=int, default=100000, help="Games simulated together in one set of arrays")
+parser.add_argument("--seed", type=int, default=None, help="Seed for reproducible results")
+# rule variants. Default values come from StockTickerGame
+parser.add_argument("--init-val", type=int, default=None, help="Price of every stock at the start and after a split/bust")
+parser.add_argument("--split-val", type=int, default=None, help="Stock splits at or above this price")
+parser.add_argument("--off-market-val", type=int, default=None, help="Stock goes off market at or below this price")
+parser.add_argument("--div-val", type=int, default=None, help="Minimum price for a stock to pay dividends")
+parser.add_argument("--amount-die", default=None, help="Faces of the amount die, e.g. 5,10,20")
+parser.add_argument("--pay-nopay-divrolls", action='store_true',
+        help="Count DIV rolls for stocks that don't pay (turns off option_ignore_nopay_divrolls)")
+
+UP, DOWN, DIV = 0, 1, 2 # index into StockTickerGame.ACTION_DIE
+SPLIT_DIV_CENTS = 20    # dividend per share paid on a split ($0.20, see _process_split)
+MAX_REROLLS = 100       # same limit as market_action
+
+class MarketSimulator:
+    def __init__(self, rules, rng):
+        '''
+        rules: StockTickerGame (or anything with the same rule attributes)
+        rng: numpy Generator
+        '''
+        self.rng = rng
+        self.INIT_VAL = rules.INIT_VAL
+        self.OFF_MARKET_VAL = rules.OFF_MARKET_VAL
+        self.SPLIT_VAL = rules.SPLIT_VAL
+        self.DIV_VAL = rules.DIV_VAL
+        self.n_stocks = len(rules.STOCK_DIE)
+        self.stock_die = np.array(rules.STOCK_DIE)
+        self.amount_die = np.array(rules.AMOUNT_DIE)
+        if tuple(rules.ACTION_DIE) != ('UP', 'DOWN', 'DIV'):
+            raise ValueError(f'unsupported action die {rules.ACTION_DIE}')
+        self.ignore_nopay_divrolls = rules.option_ignore_nopay_divrolls
+
+    def roll(self, n):
+        '''one roll of the 3 dice for each of n markets'''
+        rng = self.rng
+        return (self.stock_die[rng.integers(0, len(self.stock_die), n)],
+                rng.integers(0, 3, n),
+                self.amount_die[rng.integers(0, len(self.amount_die), n)])
+
+    def run(self, n_games, n_rolls):
+        '''simulate n_games markets for n_rolls rolls each. Returns dictionary of result arrays'''
+        rows = np.arange(n_games)
+        prices = np.full((n_games, self.n_stocks), self.INIT_VAL, dtype=np.int64)
+        shares = np.ones((n_games, self.n_stocks), dtype=np.int64)       # of one share held at start
+        div_cents = np.zeros((n_games, self.n_stocks), dtype=np.int64)   # dividends earned by it
+        splits = np.zeros((n_games, self.n_stocks), dtype=np.int32)
+        busts = np.zeros((n_games, self.n_stocks), dtype=np.int32)
+
+        for i in range(n_rolls):
+            stock, action, amount = self.roll(n_games)
+            if self.ignore_nopay_divrolls:
+                for attempt in range(1, MAX_REROLLS):
+                    reroll = (action == DIV) & (prices[rows, stock] < self.DIV_VAL)
+                    n_reroll = np.count_nonzero(reroll)
+                    if not n_reroll:
+                        break
+                    stock[reroll], action[reroll], amount[reroll] = self.roll(n_reroll)
+            price = prices[rows, stock]
+            held = shares[rows, stock]
+
+            # dividend rolls
+            pays = (action == DIV) & (price >= self.DIV_VAL)
+            div_cents[rows[pays], stock[pays]] += held[pays] * amount[pays]
+
+            # price moves, then splits/busts
+            move = np.where(action == UP, amount, np.where(action == DOWN, -amount, 0))
+            newprice = price + move
+            split = (action != DIV) & (newprice >= self.SPLIT_VAL)
+            bust = (action != DIV) & (newprice <= self.OFF_MARKET_VAL)
+            r, s = rows[split], stock[split]
+            div_cents[r, s] += held[split] * SPLIT_DIV_CENTS
+            shares[r, s] *= 2
+            splits[r, s] += 1
+            r, s = rows[bust], stock[bust]
+            shares[r, s] = 0
+            busts[r, s] += 1
+            newprice[split | bust] = self.INIT_VAL
+            prices[rows, stock] = newprice
+
+        return {
+            'prices': prices,
+            'splits': splits,
+            'busts': busts,
+            'div_yield': div_cents / self.INIT_VAL, # dividends / price paid for the share
+            'final_value': shares * prices / self.INIT_VAL, # value of the share at the end / price paid
+        }
+
+def describe(label, values):
+    pct = np.percentile(values, (5, 50, 95))
+    print (f'  {label:<30} mean {values.mean():9.3f}   p5 {pct[0]:9.3f}   median {pct[1]:9.3f}   p95 {pct[2]:9.3f}')
+
+def main():
+    args = parser.parse_args()
+    rules = st_server.StockTickerGame('montecarlo')
+    if args.init_val is not None:
+        rules.INIT_VAL = args.init_val
+    if args.split_val is not None:
+        rules.SPLIT_VAL = args.split_val
+    if args.off_market_val is not None:
+        rules.OFF_MARKET_VAL = args.off_market_val
+    if args.div_val is not None:
+        rules.DIV_VAL = args.div_val
+    if args.amount_die is not None:
+        rules.AMOUNT_DIE = tuple(int(x) for x in args.amount_die.split(','))
+    if args.pay_nopay_divrolls:
+        rules.option_ignore_nopay_divrolls = False
+    n_rolls = args.rolls
+    if n_rolls is None:
+        n_rolls = int(rules.option_gamelen * 60 / rules.option_timer_seconds)
+
+    sim = MarketSimulator(rules, np.random.default_rng(args.seed))
+    t0 = time.perf_counter()
+    results = []
+    for start in range(0, args.games, args.batch):
+        results.append(sim.run(min(args.batch, args.games - start), n_rolls))
+    elapsed = time.perf_counter() - t0
+    result = { k: np.concatenate([r[k] for r in results]) for k in results[0] }
+
+    print (f'{args.games} games x {n_rolls} rolls in {elapsed:.2f}s ({args.games*n_rolls/elapsed:,.0f} rolls/s)')
+    print (f'rules: INIT_VAL={rules.INIT_VAL} OFF_MARKET_VAL={rules.OFF_MARKET_VAL} SPLIT_VAL={rules.SPLIT_VAL} '
+            f'DIV_VAL={rules.DIV_VAL} AMOUNT_DIE={rules.AMOUNT_DIE} '
+            f'ignore_nopay_divrolls={rules.option_ignore_nopay_divrolls}')
+    print ('per game (all stocks):')
+    describe('splits', result['splits'].sum(axis=1))
+    describe('busts', result['busts'].sum(axis=1))
+    print ('per stock:')
+    describe('splits', result['splits'].ravel())
+    describe('busts', result['busts'].ravel())
+    describe('dividend yield', result['div_yield'].ravel())
+    describe('final price', result['prices'].ravel())
+    describe('final value / price paid', result['final_value'].ravel())
+    describe('total return', (result['final_value'] + result['div_yield'] - 1).ravel())
+
+if __name__ == '__main__':
+    main()
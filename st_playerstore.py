@@ -0,0 +1,146 @@
+'''st_playerstore.py
+Cash and portfolios of all players in a game, kept in flat arrays indexed by
+player slot instead of one list per Player object. A split, bust or dividend
+then updates every player with one operation on a stock's column, which keeps
+events fast in games with thousands of players (st_server.py --playerstore arrays).
+
+Uses NumPy when it is installed. Without it the same layout is kept in
+array.array buffers and updated with plain loops (no per-player method calls).
+
+Rows of players that left the game are zeroed, so they take part in column
+operations harmlessly, but they are not reported in results.
+'''
+
+import array
+
+try:
+    import numpy as np
+except ModuleNotFoundError:
+    np = None # fall back to array.array
+
+class PlayerStore:
+    def __init__(self, n_stocks, capacity=64):
+        self.n_stocks = n_stocks
+        self.players = [] # Player (or None after leaving) by slot
+        self._active = [] # slots of players in the game, ascending
+        self._capacity = capacity
+        if np is not None:
+            self._cash = np.zeros(capacity, dtype=np.int64)
+            self._shares = np.zeros((n_stocks, capacity), dtype=np.int64) # one row per stock
+            self._active_idx = np.zeros(0, dtype=np.intp)
+        else:
+            self._cash = array.array('q')
+            self._shares = [ array.array('q') for i in range(n_stocks) ]
+
+    def _grow(self):
+        self._capacity *= 2
+        cash = np.zeros(self._capacity, dtype=np.int64)
+        cash[:len(self._cash)] = self._cash
+        shares = np.zeros((self.n_stocks, self._capacity), dtype=np.int64)
+        shares[:, :self._shares.shape[1]] = self._shares
+        self._cash, self._shares = cash, shares
+
+    def _active_changed(self):
+        if np is not None:
+            self._active_idx = np.array(self._active, dtype=np.intp)
+
+    def add(self, slot, player):
+        '''new row (no cash, no shares) for player. Slots are given out in increasing order'''
+        if slot != len(self.players):
+            raise ValueError(f'expected slot {len(self.players)}, got {slot}')
+        if np is not None:
+            if slot >= self._capacity:
+                self._grow()
+        else:
+            self._cash.append(0)
+            for col in self._shares:
+                col.append(0)
+        self.players.append(player)
+        self._active.append(slot)
+        self._active_changed()
+
+    def remove(self, slot):
+        self.players[slot] = None
+        self._active.remove(slot)
+        self._active_changed()
+        self._cash[slot] = 0
+        for i in range(self.n_stocks):
+            self._shares[i][slot] = 0
+
+    def get_cash(self, slot):
+        return int(self._cash[slot])
+
+    def set_cash(self, slot, cash):
+        self._cash[slot] = cash
+
+    def get_shares(self, slot, stock):
+        return int(self._shares[stock][slot])
+
+    def set_shares(self, slot, stock, shares):
+        self._shares[stock][slot] = shares
+
+    def get_portfolio(self, slot):
+        return tuple(int(self._shares[i][slot]) for i in range(self.n_stocks))
+
+    def set_portfolio(self, slot, portfolio):
+        for i, shares in enumerate(portfolio):
+            self._shares[i][slot] = shares
+
+    def split(self, stock):
+        '''
+        Pay the split dividend ($0.20 a share) and double everyone's shares of stock.
+        Returns lists, one entry per player in slot order:
+        (slots, shares gained, dividend paid, shares now, cash now)
+        '''
+        if np is not None:
+            n = len(self.players)
+            col = self._shares[stock, :n]
+            gained = col.copy()
+            divpaid = (col * 0.2).astype(np.int64) # same truncation as int(shares * 0.2)
+            self._cash[:n] += divpaid
+            col *= 2
+            idx = self._active_idx
+            return (self._active, gained[idx].tolist(), divpaid[idx].tolist(),
+                    col[idx].tolist(), self._cash[idx].tolist())
+        col, cash = self._shares[stock], self._cash
+        gained, divpaid, shares, cashes = [], [], [], []
+        for slot in self._active:
+            s = col[slot]
+            div = int(s * 0.2)
+            cash[slot] += div
+            col[slot] = s * 2
+            gained.append(s); divpaid.append(div); shares.append(s * 2); cashes.append(cash[slot])
+        return self._active, gained, divpaid, shares, cashes
+
+    def bust(self, stock):
+        '''Wipe out everyone's shares of stock. Returns (slots, shares lost) in slot order'''
+        if np is not None:
+            col = self._shares[stock, :len(self.players)]
+            lost = col[self._active_idx].tolist()
+            col[:] = 0
+            return self._active, lost
+        col = self._shares[stock]
+        lost = [ col[slot] for slot in self._active ]
+        for slot in self._active:
+            col[slot] = 0
+        return self._active, lost
+
+    def dividend(self, stock, amount):
+        '''
+        Pay amount cents a share of stock. Returns (slots, dividend paid, cash now)
+        for the players that got a dividend, in slot order
+        '''
+        if np is not None:
+            n = len(self.players)
+            divpaid = (self._shares[stock, :n] * amount / 100).astype(np.int64)
+            self._cash[:n] += divpaid
+            idx = np.flatnonzero(divpaid)
+            return idx.tolist(), divpaid[idx].tolist(), self._cash[idx].tolist()
+        col, cash = self._shares[stock], self._cash
+        slots, divpaid, cashes = [], [], []
+        for slot in self._active:
+            div = int(col[slot] * amount / 100)
+            if div:
+                cash[slot] += div
+                slots.append(slot); divpaid.append(div); cashes.append(cash[slot])
+        return slots, divpaid, cashes
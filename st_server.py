@@ -4,6 +4,7 @@
 # TODO: handle mutliple rooms, for now just one room for all
 
 import argparse
+import asyncio
 import socket
 #import threading
 import selectors
@@ -16,17 +17,111 @@ import datetime
 import time
 import uuid
 import types # SimpleNamespace for stock enum-ish construct?
-from st_common import MessageReceiver
+import os
+import collections
+import heapq
+import itertools
+import queue
+import multiprocessing
+import signal
+from st_common import MessageReceiver, OutMessage, CAP_BINARY, BINARY_LAYOUTS, parse_initconn, decode_message
+from st_common import LinkReceiver, LINK_OPEN, LINK_DATA, LINK_CLOSE, LINK_BROADCAST, link_header, encode_link, multicast_header
+from st_journal import GameJournal
+from st_playerstore import PlayerStore
+from st_leaderboard import Leaderboard
+from st_marketfeed import MarketFeed
+from st_tickfeed import TickFeed, parse_group
 
 parser = argparse.ArgumentParser()
 parser.add_argument("-t", "--timersec", type=int, required=False, default=3, help="Default seconds between die rolls")
 parser.add_argument("-l", "--gamelen", type=float, required=False, default=15, help="Length of game in minutes")
 parser.add_argument("-p", "--port", type=int, required=False, default=8089, help="TCP/IP port to listen for connections")
-args = parser.parse_args() 
-
+parser.add_argument("-e", "--engine", choices=('selectors', 'asyncio'), default='selectors',
+        help="selectors: selector loop plus a DiceRollTimer thread per game. asyncio: one event loop for all connections and games")
+parser.add_argument("--rolltimer", choices=('shared', 'thread'), default='shared',
+        help="(selectors engine) shared: one scheduler thread rolls the dice for every game. thread: a DiceRollTimer thread per game")
+parser.add_argument("--handshake-sec", type=float, required=False, default=10,
+        help="Seconds a new connection has to send its initconn message")
+parser.add_argument("--seed", required=False, default=None,
+        help="Seed for the dice. Each game's rolls are then reproducible (seeded with seed and game name)")
+parser.add_argument("--fastforward", action='store_true',
+        help="Once a game starts, play it to the end at full speed instead of rolling every --timersec seconds")
+parser.add_argument("-j", "--journal", metavar='DIR', required=False, default=None,
+        help="Write a journal of each game to DIR (replay with st_journal.py)")
+parser.add_argument("--playerstore", choices=('objects', 'arrays'), default='objects',
+        help="objects: cash and portfolio kept on each Player. arrays: kept in flat arrays per game "
+             "so splits/busts/dividends update all players at once (faster with many players, uses numpy if installed)")
+parser.add_argument("--leaderboard-rolls", type=int, required=False, default=5,
+        help="Send the game's top players every this many die rolls (0: never)")
+parser.add_argument("--encoder", choices=('inline', 'thread'), default='inline',
+        help="inline: game messages are made and sent by the thread that ran the game action. "
+             "thread: (selectors engine) handed to one encoder thread so the game moves on straight away")
+parser.add_argument("--gameworkers", type=int, required=False, default=0, metavar='N',
+        help="(selectors engine) Run orders, ready signals and die rolls of each game on a pool of N "
+             "worker threads, one command at a time per game, instead of on the selector/timer threads")
+parser.add_argument("--shards", type=int, required=False, default=0, metavar='N',
+        help="(selectors engine) Run the games in N worker processes. This process accepts connections "
+             "and hands each client to the process hosting the game it joins")
+parser.add_argument("--workers", type=int, required=False, default=0, metavar='N',
+        help="(selectors engine) Run N server processes all listening on --port (SO_REUSEPORT). Each hosts "
+             "some of the games and passes clients on to the worker hosting the game they join")
+parser.add_argument("--gateway-port", type=int, required=False, default=None, metavar='PORT',
+        help="(selectors engine) Also accept links from gateways (st_gateway.py) on this port. "
+             "A gateway holds client connections and passes them all to the server over one link")
+parser.add_argument("--marketfeed", metavar='PREFIX', required=False, default=None,
+        help="Publish each game's market in shared memory (segment PREFIX-<game name>) for "
+             "local readers, see st_marketfeed.py")
+parser.add_argument("--tickfeed", metavar='GROUP:PORT', required=False, default=None,
+        help="Send each game's rolls, price changes and splits/busts as sequenced UDP multicast "
+             "datagrams to GROUP:PORT (e.g. 239.255.42.1:8095), see st_tickfeed.py")
+parser.add_argument("--tickfeed-ttl", type=int, required=False, default=1,
+        help="Multicast TTL of the tick feed (1: local network only)")
+parser.add_argument("--tickfeed-if", metavar='ADDR', required=False, default=None,
+        help="Address of the interface to send the tick feed on (default: chosen by the OS)")
+parser.add_argument("--spectator-sec", type=float, required=False, default=1.0,
+        help="Spectators get the latest market and leaderboard of their game at most every this many seconds")
+parser.add_argument("--outbuf-high", type=int, required=False, default=256*1024, metavar='BYTES',
+        help="A client with more than this queued for it is a slow consumer (see --slow-policy)")
+parser.add_argument("--outbuf-low", type=int, required=False, default=64*1024, metavar='BYTES',
+        help="A slow consumer is back to normal once its queue is down to this")
+parser.add_argument("--outbuf-max", type=int, required=False, default=4*1024*1024, metavar='BYTES',
+        help="A client with more than this queued for it is disconnected, whatever the policy")
+parser.add_argument("--slow-policy", required=False, default='conflate,dropchat,disconnect',
+        help="What to do with a slow consumer, any of (comma separated): conflate: keep only the latest "
+             "price of each stock, roll, countdown and leaderboard for it. dropchat: don't send it chat. "
+             "disconnect: disconnect it if it is still slow after --slow-grace seconds")
+parser.add_argument("--slow-grace", type=float, required=False, default=10,
+        help="Seconds a slow consumer has to catch up before it is disconnected (--slow-policy disconnect)")
+parser.add_argument("--lane-max-wait", type=float, required=False, default=0.25, metavar='SEC',
+        help="A queued message in a lower priority lane (game state, chat) that has waited this long "
+             "is sent before more urgent ones, so chat is only ever delayed this much by a busy game")
+parser.add_argument("--sndbuf", type=int, required=False, default=0, metavar='BYTES',
+        help="Kernel send buffer of client sockets (0: the OS default, which can grow to megabytes before "
+             "anything queues up in the server and the --outbuf watermarks see it)")
+parser.add_argument("--backlog", type=int, required=False, default=128,
+        help="Connections the OS will queue for the server to accept")
+parser.add_argument("-g", "--games", type=int, required=False, default=1, help="Number of games to host")
+
+# set from the command line in main()
 SERVER_OPT = {
-    'timersec': args.timersec,
-    'gamelen': args.gamelen
+    'timersec': parser.get_default('timersec'),
+    'gamelen': parser.get_default('gamelen'),
+    'handshake_sec': parser.get_default('handshake_sec'),
+    'seed': parser.get_default('seed'),
+    'fastforward': parser.get_default('fastforward'),
+    'journal_dir': parser.get_default('journal'),
+    'playerstore': parser.get_default('playerstore'),
+    'leaderboard_rolls': parser.get_default('leaderboard_rolls'),
+    'marketfeed': parser.get_default('marketfeed'),
+    'spectator_sec': parser.get_default('spectator_sec'),
+    'outbuf_high': parser.get_default('outbuf_high'),
+    'outbuf_low': parser.get_default('outbuf_low'),
+    'outbuf_max': parser.get_default('outbuf_max'),
+    'slow_policy': frozenset(parser.get_default('slow_policy').split(',')),
+    'slow_grace': parser.get_default('slow_grace'),
+    'sndbuf': parser.get_default('sndbuf'),
+    'lane_max_wait': parser.get_default('lane_max_wait'),
+    'backlog': parser.get_default('backlog')
 }
 
 # ------------------------------------------------------------------------------
@@ -47,26 +142,400 @@ SERVER_OPT = {
 # It needs to be guaranteed that no game action initiated by the server can be
 # started before the previous game action is complete.  A DiceRollTimer tick does
 # not run its action on a separate thread so this happens naturally.
+#
+# With --engine asyncio, connections and roll timers all run on one event loop
+# thread, so game state is only ever touched from that thread and games get a
+# LoopLock instead of a threading.Lock (see serve_asyncio)
+#
+# Game actions only record events (plain tuples) while holding the game_lock.
+# Messages are made from them, encoded and sent after the lock is released
+# (StockTickerGame.publish), or on the EncoderThread with --encoder thread, so
+# orders don't wait behind message encoding.
+#
+# With --gameworkers N each game is an actor (see GameWorkers): orders, ready
+# signals and die rolls are queued in the game's inbox and run one at a time on a
+# worker thread, so they never contend for the game_lock. Joins and leaves still
+# come straight from the selector loop and rely on the game_lock.
+#
+# Spectators are only sent a copy of their game's state (spectator_state), which
+# game actions replace under the game_lock. The SpectatorFanout thread reads it
+# and the game's spectators (under spectator_lock) without taking the game_lock.
 
 stock = types.SimpleNamespace(GOLD=1,SILVER=2,OIL=3,BONDS=4,INDUSTRIAL=5,GRAIN=6)
 stock_names = [ 'GOLD', 'SILVER', 'OIL', 'BONDS', 'INDUSTRIAL', 'GRAIN' ]
 
 sel = selectors.DefaultSelector()
 
-serversocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-serversocket.bind(('localhost', args.port))
-serversocket.listen(5) # become a server socket, maximum 5 connections
-#serversocket.settimeout(5) # .accept() blocks and ctrl-c doesn't break out of it.  this allows us to quit easier, but requires us to handle the except during accept
+# Other threads (e.g. DiceRollTimer) can't safely change selector registrations
+# while the main loop is in select(), so clients that need EVENT_WRITE are put
+# on write_requests and the main loop is woken up through this socket pair.
+wakeup_recv, wakeup_send = socket.socketpair()
+wakeup_recv.setblocking(False)
+wakeup_send.setblocking(False)
+write_requests = queue.SimpleQueue()
+
+# sendmsg (writev) lets a client's queued messages go out in one system call.
+# Not available on Windows, where they are sent one at a time
+HAVE_SENDMSG = hasattr(socket.socket, 'sendmsg')
+SENDMSG_MAX_BUFFERS = 512 # stay under IOV_MAX
+
+def request_write(client):
+    write_requests.put(client)
+    try:
+        wakeup_send.send(b'\0')
+    except BlockingIOError:
+        pass # already plenty of wake ups pending
+
+# ------------------------------------------------------------------------------
+#                               PRIORITY LANES
+# ------------------------------------------------------------------------------
+# A client's outbound queue has three lanes, so a burst of chat can't hold up
+# the price a player needs before the next roll:
+#   critical    order approvals, the messages of a die roll, and the messages
+#               the others must not overtake (initgame, gamestart, gameover...)
+#   state       everything else: game status, countdown, leaderboard, players
+#   chat        chatmsg and servermsg
+# Messages only go in the lanes when the socket won't take them right away.
+# They keep their order within a lane. Whenever the socket can take more, the
+# most urgent lane goes first, but messages that have waited --lane-max-wait
+# seconds get up to a quarter of what is sent at a time ahead of the others
+# (starvation guard). How long the messages that
+# had to wait were queued is measured per lane (queuestats).
+
+LANE_CRITICAL, LANE_STATE, LANE_CHAT = range(3)
+LANE_NAMES = ('critical', 'state', 'chat')
+LANE_OF = dict.fromkeys(('approve', 'roll', 'markettick', 'div', 'split', 'offmarket',
+                         'conn-accept', 'initgame', 'joinfail', 'gamestart', 'gameover', 'server-exit'), LANE_CRITICAL)
+LANE_OF.update(dict.fromkeys(('chatmsg', 'servermsg'), LANE_CHAT))
+WIRE_BATCH_BYTES = 32 * 1024 # taken from the lanes at a time, so an urgent message waits behind at most this much
+OVERDUE_BATCH_BYTES = WIRE_BATCH_BYTES // 4 # of it for messages that waited --lane-max-wait
+
+lane_delays = [ [0, 0.0, 0.0] for lane in LANE_NAMES ] # [messages queued, total seconds queued, max] (approximate, not locked)
+
+def lane_metrics():
+    return { name: {'queued': n, 'avg-ms': round(total * 1000 / n, 3) if n else 0, 'max-ms': round(longest * 1000, 3)}
+             for name, (n, total, longest) in zip(LANE_NAMES, lane_delays) }
+
+# ------------------------------------------------------------------------------
+#                               SLOW CONSUMERS
+# ------------------------------------------------------------------------------
+# A client that doesn't read as fast as messages are sent to it has them pile
+# up in its outbound queue. Once more than --outbuf-high bytes are queued it is
+# a slow consumer: messages for it are held back instead, and with
+# --slow-policy:
+#   conflate    a newer price of a stock (markettick), roll, countdown
+#               (actiontime) or leaderboard replaces the one held, so held
+#               market data never grows beyond one of each
+#   dropchat    chat isn't held at all
+#   disconnect  it is disconnected if it is still slow --slow-grace seconds later
+# When its queue is down to --outbuf-low the held messages are queued, in
+# order. A client with more than --outbuf-max bytes queued and held is
+# disconnected whatever the policy, so a stalled client can only take so much
+# memory. Player messages (orders, dividends, splits) are never dropped.
+
+JSON_TYPE_PREFIX = b'{"TYPE": "' # how bmsg bytes start, after the frame header
+CONFLATED_TYPES = frozenset(('markettick', 'roll', 'actiontime', 'leaderboard'))
+
+slow_clients = set() # clients holding messages back, checked by expire_slow
+queue_stats = collections.Counter() # slow, conflated, chat-dropped, disconnected (approximate, not locked)
+
+def message_type(msg):
+    '''TYPE of an OutMessage or of the bytes of a json message (bmsg)'''
+    if isinstance(msg, OutMessage):
+        return msg.mtype
+    start = 4 + len(JSON_TYPE_PREFIX)
+    if msg[4:start] == JSON_TYPE_PREFIX:
+        return str(msg[start:msg.find(b'"', start)], 'utf-8')
+    return None
+
+def expire_slow():
+    '''disconnect slow consumers that are over --outbuf-max, or out of grace time'''
+    now = time.monotonic()
+    for client in list(slow_clients):
+        if client.closed or not client.holding():
+            slow_clients.discard(client)
+        elif reason := client.too_slow(now):
+            print (f'Disconnecting slow consumer {client.get_name()}: {reason}')
+            queue_stats['disconnected'] += 1
+            slow_clients.discard(client)
+            disconnect_client(client)
+
+def queue_metrics():
+    '''outbound queue depths of all clients, for a queuestats message'''
+    depths = [ c.queued_bytes() for c in list(clients.values()) ]
+    return {'clients': len(depths),
+            'queued': sum(depths),
+            'max-queued': max(depths, default=0),
+            'slow-now': len(slow_clients),
+            'went-slow': queue_stats['slow'],
+            'conflated': queue_stats['conflated'],
+            'chat-dropped': queue_stats['chat-dropped'],
+            'disconnected': queue_stats['disconnected'],
+            'lanes': lane_metrics()}
 
 class Client:
-    '''Client objects represent a client connected to the server'''
-    def __init__(self, name, conn):
+    '''
+    Client objects represent a client connected to the server
+
+    Messages to the client go through send(), which never blocks. Whatever
+    the (non-blocking) socket won't take right away waits in the outbound
+    buffer and the selector loop sends it once the socket is writable. The
+    outbound buffer is split in priority lanes (see PRIORITY LANES).
+    '''
+    link = None # GatewayLink of a client connected through a gateway
+
+    def __init__(self, name, conn, caps=(), message_receiver=None):
         self._name = name
         self.conn = conn
-        self.message_receiver = MessageReceiver(f'msgrec-{name}', conn, process_message)
-        self.message_receiver.data = name
+        self.binary = CAP_BINARY in caps # client can take binary game messages
+        if message_receiver is None:
+            message_receiver = MessageReceiver(f'msgrec-{name}', conn, process_message)
+            message_receiver.data = name
+        self.message_receiver = message_receiver
         self._player = None
         self._game = None
+        self.spectating = None             # game watched as a spectator
+        self.spectated_version = 0         # version of the spectator state last sent
+        self.channels = set()              # Channels the client is subscribed to
+        self._lanes = tuple(collections.deque() for lane in LANE_NAMES) # (frame, time queued) per lane
+        self._outbuf = collections.deque() # message bytes taken from the lanes, being sent in this order
+        self._outmeta = collections.deque() # (time queued, lane) of each _outbuf frame
+        self._queued = 0                   # bytes in _lanes and _outbuf
+        self._held = None                  # slow consumer: messages held back, key: (lane, frame, time) (see SLOW CONSUMERS)
+        self._held_bytes = 0
+        self._held_seq = 0                 # keys of held messages that aren't conflated
+        self.slow_since = None             # time.monotonic() it became a slow consumer
+        self._out_lock = threading.Lock()  # sends can come from any thread
+        self._want_write = False           # True while registered for EVENT_WRITE
+        self.handoff = None                # (control, handoff data, raw) while draining before a handoff (--workers)
+        self.closed = False
+
+    def send(self, msg):
+        '''
+        Send a message to this client. msg is an OutMessage or the bytes
+        of a message (e.g. from bmsg)
+        '''
+        with self._out_lock:
+            if self.closed:
+                return
+            if self._held is not None:
+                self._hold_locked((msg,))
+                return
+            frame = msg.frame(self.binary) if isinstance(msg, OutMessage) else msg
+            if not self._queued:
+                # nothing waiting, no lanes needed unless the socket won't take it all
+                try:
+                    sent = self.conn.send(frame)
+                except OSError:
+                    sent = 0 # full, or the connection is gone (the flush will see it)
+                if sent == len(frame):
+                    return
+                if sent:
+                    self._queue_rest_locked(frame, sent, msg)
+                    self._queued_locked()
+                    return
+            self._lanes[self._lane(msg)].append((frame, time.monotonic()))
+            self._queued += len(frame)
+            self._queued_locked()
+
+    def send_many(self, msgs):
+        '''
+        Send several messages (e.g. everything from one market action) so they
+        can go out together in a single sendmsg call
+        '''
+        with self._out_lock:
+            if self.closed or not msgs:
+                return
+            if self._held is not None:
+                self._hold_locked(msgs)
+                return
+            frames = [ m.frame(self.binary) if isinstance(m, OutMessage) else m for m in msgs ]
+            i = 0
+            if not self._queued and len(frames) <= SENDMSG_MAX_BUFFERS:
+                # nothing waiting: send them all now, only the rest goes in the lanes
+                try:
+                    sent = self.conn.sendmsg(frames) if HAVE_SENDMSG else self.conn.send(frames[0])
+                except OSError:
+                    sent = 0
+                while i < len(frames) and sent >= len(frames[i]):
+                    sent -= len(frames[i])
+                    i += 1
+                if i == len(frames):
+                    return
+                if sent:
+                    self._queue_rest_locked(frames[i], sent, msgs[i])
+                    i += 1
+            now = time.monotonic()
+            lanes = self._lanes
+            for j in range(i, len(frames)):
+                lanes[self._lane(msgs[j])].append((frames[j], now))
+                self._queued += len(frames[j])
+            self._queued_locked()
+
+    def _queue_rest_locked(self, frame, sent, msg):
+        '''the socket took part of frame: the rest must go before anything else'''
+        self._outbuf.append(memoryview(frame)[sent:])
+        self._outmeta.append((time.monotonic(), self._lane(msg)))
+        self._queued += len(frame) - sent
+
+    def _lane(self, msg):
+        '''priority lane of a message (see PRIORITY LANES)'''
+        return LANE_OF.get(message_type(msg), LANE_STATE)
+
+    def _queued_locked(self):
+        '''after messages were queued: hold further ones if too much is, make sure the rest gets sent'''
+        if self._queued > SERVER_OPT['outbuf_high']:
+            self._start_holding()
+        if self._queued and not self._want_write:
+            self._want_write = True
+            request_write(self)
+
+    def _start_holding(self):
+        self._held = dict()
+        self._held_bytes = 0
+        self.slow_since = time.monotonic()
+        queue_stats['slow'] += 1
+        slow_clients.add(self)
+
+    def _hold_locked(self, msgs):
+        '''slow consumer: keep msgs until the outbound queue is down to --outbuf-low, as --slow-policy says'''
+        policy = SERVER_OPT['slow_policy']
+        held = self._held
+        now = time.monotonic()
+        for m in msgs:
+            mtype = message_type(m)
+            if mtype == 'chatmsg' and 'dropchat' in policy:
+                queue_stats['chat-dropped'] += 1
+                continue
+            frame = m.frame(self.binary) if isinstance(m, OutMessage) else m
+            if mtype in CONFLATED_TYPES and 'conflate' in policy:
+                key = (mtype, m.data['stock']) if mtype == 'markettick' else mtype
+                if (old := held.pop(key, None)) is not None:
+                    # goes after anything held since, like it would have
+                    self._held_bytes -= len(old[1])
+                    queue_stats['conflated'] += 1
+            else:
+                self._held_seq += 1
+                key = self._held_seq
+            held[key] = (self._lane(m), frame, now)
+            self._held_bytes += len(frame)
+
+    def _release_locked(self):
+        '''queue the held messages, the client is keeping up again'''
+        held = self._held
+        self._held = None
+        self.slow_since = None
+        for (lane, frame, t) in held.values():
+            self._lanes[lane].append((frame, t))
+        self._queued += self._held_bytes
+        self._held_bytes = 0
+
+    def holding(self):
+        '''True while it is a slow consumer'''
+        return self._held is not None
+
+    def queued_bytes(self):
+        '''bytes queued and held for this client'''
+        return self._queued + self._held_bytes
+
+    def too_slow(self, now):
+        '''why a slow consumer should be disconnected, or None'''
+        if self.queued_bytes() > SERVER_OPT['outbuf_max']:
+            return f'{self.queued_bytes()} bytes queued'
+        slow_since = self.slow_since
+        if 'disconnect' in SERVER_OPT['slow_policy'] and slow_since is not None and now - slow_since > SERVER_OPT['slow_grace']:
+            return f'slow for {now - slow_since:.1f}s'
+        return None
+
+    def flush(self):
+        '''
+        Called from the selector loop when the socket is writable. Returns True
+        if the outbound buffer has been emptied (EVENT_WRITE no longer needed)
+        '''
+        with self._out_lock:
+            self._flush_locked()
+            if self._queued and not self.closed:
+                return False
+            self._want_write = False
+            return True
+
+    def _fill_outbuf_locked(self):
+        '''
+        Take the next frames to send from the lanes, most urgent lane first after
+        some of any that waited --lane-max-wait. Returns False if the lanes are empty
+        '''
+        lanes, outbuf, meta = self._lanes, self._outbuf, self._outmeta
+        budget = WIRE_BATCH_BYTES
+        if lanes[LANE_STATE] or lanes[LANE_CHAT]:
+            overdue = time.monotonic() - SERVER_OPT['lane_max_wait']
+            for lane in (LANE_STATE, LANE_CHAT):
+                q = lanes[lane]
+                while q and q[0][1] < overdue and budget > WIRE_BATCH_BYTES - OVERDUE_BATCH_BYTES:
+                    frame, t = q.popleft()
+                    outbuf.append(frame)
+                    meta.append((t, lane))
+                    budget -= len(frame)
+        for lane, q in enumerate(lanes):
+            while q and budget > 0 and len(outbuf) < SENDMSG_MAX_BUFFERS:
+                frame, t = q.popleft()
+                outbuf.append(frame)
+                meta.append((t, lane))
+                budget -= len(frame)
+        return bool(outbuf)
+
+    def _flush_locked(self):
+        outbuf, meta = self._outbuf, self._outmeta
+        while outbuf or self._fill_outbuf_locked():
+            try:
+                if len(outbuf) > 1 and HAVE_SENDMSG:
+                    # gather write: all queued messages in one system call
+                    sent = self.conn.sendmsg(itertools.islice(outbuf, SENDMSG_MAX_BUFFERS))
+                else:
+                    sent = self.conn.send(outbuf[0])
+            except BlockingIOError:
+                break
+            except OSError as e:
+                # connection is gone. The selector loop will see it on the read side
+                print (f'{self._name} send failed: {e}')
+                self._clear_locked()
+                return
+            if not sent:
+                break
+            self._queued -= sent
+            now = time.monotonic()
+            while outbuf and sent >= len(outbuf[0]):
+                sent -= len(outbuf.popleft())
+                t, lane = meta.popleft()
+                delays = lane_delays[lane]
+                delays[0] += 1
+                delays[1] += now - t
+                if now - t > delays[2]:
+                    delays[2] = now - t
+            if sent:
+                outbuf[0] = memoryview(outbuf[0])[sent:]
+                break # socket buffer is full
+        if self._held is not None and self._queued <= SERVER_OPT['outbuf_low']:
+            self._release_locked()
+
+    def _clear_locked(self):
+        for q in self._lanes:
+            q.clear()
+        self._outbuf.clear()
+        self._outmeta.clear()
+        self._queued = 0
+
+    def backlogged(self):
+        '''True while messages are waiting for the socket to take them'''
+        return bool(self._queued) or self._held is not None
+
+    def close(self):
+        sel.unregister(self.conn)
+        with self._out_lock:
+            self.closed = True
+            self._clear_locked()
+            self._held = None
+            self._held_bytes = 0
+        self.conn.close()
 
     def get_name(self):
         return self._name
@@ -85,6 +554,112 @@ class Client:
         self._player = None
         self._game = None
 
+class AsyncClient(Client):
+    '''
+    Client connected through the asyncio engine. conn is the asyncio transport,
+    which does its own buffering of outbound data. Its write buffer limits are
+    the watermarks: the transport pauses writing (ServerProtocol.pause_writing)
+    over --outbuf-high, and messages are held back until it resumes
+    '''
+    def send(self, msg):
+        self.send_many((msg,))
+
+    def send_many(self, msgs):
+        if self.closed:
+            return
+        if self._held is not None:
+            self._hold_locked(msgs) # only ever called on the event loop thread
+            return
+        self.conn.writelines([ m.frame(self.binary) if isinstance(m, OutMessage) else m for m in msgs ])
+
+    def writing_paused(self):
+        self._start_holding()
+
+    def writing_resumed(self):
+        if self._held is not None and not self.closed:
+            frames = [ frame for (lane, frame, t) in self._held.values() ]
+            self._held = None
+            self._held_bytes = 0
+            self.slow_since = None
+            self.conn.writelines(frames)
+
+    def flush(self):
+        return True
+
+    def backlogged(self):
+        return self.conn.get_write_buffer_size() > 0 or self._held is not None
+
+    def queued_bytes(self):
+        return self.conn.get_write_buffer_size() + self._held_bytes
+
+    def close(self):
+        self.closed = True
+        self.conn.close()
+
+class PendingConnection:
+    '''
+    A new connection that hasn't sent its initconn message yet. It is registered
+    with the selector (non-blocking) like a Client, so a slow or silent connector
+    can't hold up the server. Once initconn arrives it is promoted to a Client,
+    or it is dropped if the deadline passes first (see expire_pending)
+    '''
+    def __init__(self, conn, addr, deadline):
+        self.conn = conn
+        self.addr = addr
+        self.deadline = deadline # time.monotonic() value
+        self.client = None       # set once promoted
+        self.closed = False
+        self.message_receiver = MessageReceiver('pending', conn, self.message_received)
+
+    def message_received(self, message):
+        if self.client is not None:
+            # arrived in the same recv() as initconn
+            process_message(message, self.client.get_name())
+            return
+        if self.closed:
+            return
+        client_name, client_caps = parse_initconn(message)
+        print ("initial msg received from connecting client")
+        del pending[self.conn]
+        if client_name in clients:
+            self.conn.send(bmsg('error', f'Client {client_name} already connected'))
+            print (f'Connection from [{self.addr}] refused, {client_name} already connected')
+            self.close()
+            return
+        client = Client(client_name, self.conn, client_caps, self.message_receiver)
+        self.client = client
+        add_client(client) # add to system
+        sel.modify(self.conn, selectors.EVENT_READ, client)
+        # send list of game names
+        # TODO: only list games that are joinable/not started
+        client.send(bmsg('conn-accept', game_list()))
+        print (f'[{client_name}] has joined. {len(clients)} total clients')
+
+    def close(self):
+        self.closed = True
+        pending.pop(self.conn, None)
+        sel.unregister(self.conn)
+        self.conn.close()
+
+pending = dict() # key = socket. connections waiting for initconn
+# the same connections in the order they arrived, which is also the order of
+# their deadlines. Promoted and closed ones are left in and skipped when they expire
+pending_deadlines = collections.deque()
+
+def add_pending(conn, addr):
+    p = pending[conn] = PendingConnection(conn, addr, time.monotonic() + SERVER_OPT['handshake_sec'])
+    pending_deadlines.append(p)
+    return p
+
+def expire_pending():
+    '''drop connections that haven't completed the handshake in time'''
+    now = time.monotonic()
+    while pending_deadlines and pending_deadlines[0].deadline < now:
+        p = pending_deadlines.popleft()
+        if pending.get(p.conn) is p:
+            print (f'Connection from [{p.addr}] dropped, no initconn received')
+            p.close()
+
 class Player:
     '''
     Tracks the cash and holdings of a Player in a game. All methods that
@@ -97,11 +672,12 @@ class Player:
     if we need to assert game is locked.  (NOTE: this is all just to catch
     bugs)
     '''
-    def __init__(self, client, cash, portfolio):
+    def __init__(self, client, cash, portfolio, slot):
         if client.get_player():
             raise RuntimeError("Cant be a Player in 2 games")
         if not client.game:
             raise RuntimeError("Client should have game property set")
+        self.slot = slot # number of this player in the game (order of joining)
         self.client = client
         self.name = client.get_name()
         self.conn = client.conn # TODO: both Client and Player shouldnt need this
@@ -163,15 +739,66 @@ class Player:
             'portfolio': self.get_portfolio()
         }
 
+class StoredPlayer(Player):
+    '''
+    Player whose cash and portfolio are kept in the game's PlayerStore
+    (--playerstore arrays) rather than on the object
+    '''
+    def __init__(self, store, client, cash, portfolio, slot):
+        self.store = store
+        store.add(slot, self)
+        try:
+            super().__init__(client, cash, portfolio, slot)
+        except:
+            store.remove(slot)
+            raise
+
+    @property
+    def cash(self):
+        return self.store.get_cash(self.slot)
+
+    @cash.setter
+    def cash(self, cash):
+        self.store.set_cash(self.slot, cash)
+
+    @property
+    def _portfolio(self):
+        return list(self.store.get_portfolio(self.slot))
+
+    @_portfolio.setter
+    def _portfolio(self, portfolio):
+        self.store.set_portfolio(self.slot, portfolio)
+
+    def add_shares(self, stock, shares):
+        self.game.assert_locked()
+        if self.store.get_shares(self.slot, stock) + shares < 0:
+            raise ValueError(f'{self.name} Less than zero shares [{stock}]')
+        self.store.set_shares(self.slot, stock, self.store.get_shares(self.slot, stock) + shares)
+
+    def get_portfolio(self, stock=None):
+        self.game.assert_locked()
+        if stock is None:
+            return self.store.get_portfolio(self.slot)
+        else:
+            return self.store.get_shares(self.slot, stock)
+
+    def set_portfolio(self, stock, newval):
+        self.game.assert_locked()
+        self.store.set_shares(self.slot, stock, newval)
+
+    def set_portfolio_all(self, newvals):
+        self.game.assert_locked()
+        self.store.set_portfolio(self.slot, [ int(x) for x in newvals ])
+
 class DiceRollTimer(threading.Thread):
-    def __init__(self, interval, fn_action):
+    def __init__(self, interval, fn_action, channel):
         '''A StockTickerGame will have a DiceRollTime to control when the dice
         get rolled.
 
         Market actions in a game should generally run every <interval> seconds.
         When DiceRollTime is first started, it will pause for interval seconds
         and then execute <fn_action()>. This sequence loops forever in its own
-        thread.
+        thread. Each countdown is announced (actiontime) on the game's <channel>.
 
         If a DiceRollTimer is <pause()>d, action will *not* be executed at
         the end of a countdown, instead it will halt and wait until its <restart()>ed.
@@ -185,6 +812,7 @@ class DiceRollTimer(threading.Thread):
         super().__init__()
         self.interval = interval
         self.action = fn_action
+        self.channel = channel # of the game, for the actiontime countdown
         self.daemon = True # just die when main thread exits
         self.paused = False
         self.running = False # only False before game start and after game end
@@ -193,8 +821,7 @@ class DiceRollTimer(threading.Thread):
     def run(self):
         self.running = True
         while self.running:
-            # TODO Timer shouldn't have direct access to send_all. Add a server call. (works fine, just violates concepts)
-            send_all(bmsg('actiontime', self.interval))
+            self.channel.send(bmsg('actiontime', self.interval))
             time.sleep(self.interval)
             if self.paused:
                 self.restart_event.clear()
@@ -220,6 +847,305 @@ class DiceRollTimer(threading.Thread):
     def set_interval(self, seconds):
         self.interval = seconds
 
+def next_roll_deadline(deadline, interval, now):
+    '''
+    Deadline of the roll after the one that was due at <deadline>: <interval> later.
+    If the action overran that too, rolls missed are skipped, not made up: it is the
+    first deadline on the same schedule that is still ahead of <now>
+    '''
+    following = deadline + interval
+    if following <= now and interval > 0:
+        following += ((now - following) // interval + 1) * interval
+    return following
+
+class RollScheduler(threading.Thread):
+    '''
+    One thread that fires the dice rolls of every game, so hosting N games
+    doesn't take N sleeping DiceRollTimer threads. ScheduledRollTimers are
+    kept in a heap ordered by their next deadline (time.monotonic()).
+
+    Game actions run on this thread one after another, so a slow
+    market_action in one game delays the rolls of other games due at the
+    same moment (but not the deadlines that follow).
+    '''
+    def __init__(self):
+        super().__init__(name='RollScheduler')
+        self.daemon = True
+        self._heap = []  # (deadline, seq, timer)
+        self._seq = 0    # tie breaker so timers themselves are never compared
+        self._cond = threading.Condition()
+
+    def schedule(self, timer, deadline):
+        with self._cond:
+            self._seq += 1
+            heapq.heappush(self._heap, (deadline, self._seq, timer))
+            if self._heap[0][2] is timer:
+                self._cond.notify() # new earliest deadline
+
+    def run(self):
+        while True:
+            with self._cond:
+                while not self._heap:
+                    self._cond.wait()
+                deadline, seq, timer = self._heap[0]
+                wait = deadline - time.monotonic()
+                if wait > 0:
+                    self._cond.wait(wait)
+                    continue # something may have been scheduled earlier meanwhile
+                heapq.heappop(self._heap)
+            try:
+                timer.fire(deadline)
+            except Exception:
+                print (f'ERROR in roll timer action')
+                print (traceback.format_exc())
+
+class ScheduledRollTimer:
+    '''
+    DiceRollTimer that runs on the shared RollScheduler instead of its own
+    thread. Same pause/restart behaviour as DiceRollTimer. Deadlines are
+    absolute: the next roll is due <interval> after the previous deadline,
+    not after the previous action finished, so the game doesn't drift by
+    the time market_action takes (see next_roll_deadline for overruns).
+    actiontime announces the seconds actually left until the deadline.
+    '''
+    def __init__(self, interval, fn_action, channel):
+        self.interval = interval
+        self.action = fn_action
+        self.channel = channel
+        self.paused = False
+        self.running = False
+        self.waiting = False # countdown ended while paused, waiting for restart()
+        self._lock = threading.Lock()
+
+    def start(self):
+        self.running = True
+        self._countdown(time.monotonic() + self.interval)
+
+    def _countdown(self, deadline):
+        self.channel.send(bmsg('actiontime', round(deadline - time.monotonic(), 3)))
+        roll_scheduler.schedule(self, deadline)
+
+    def fire(self, deadline):
+        '''called by the RollScheduler when the deadline is reached'''
+        with self._lock:
+            if not self.running:
+                return
+            if self.paused:
+                self.waiting = True
+                return
+        self.action()
+        if self.running: # skip if game has ended
+            self._countdown(next_roll_deadline(deadline, self.interval, time.monotonic()))
+
+    def pause(self):
+        self.paused = True
+
+    def restart(self):
+        with self._lock:
+            self.paused = False
+            if not self.waiting:
+                return
+            self.waiting = False
+        # NOTE: if paused, assume when unpaused that all players want die roll immediately
+        now = time.monotonic()
+        roll_scheduler.schedule(self, now)
+
+    def stop(self):
+        '''stop() is called at the end of the game to stop the timer'''
+        self.running = False
+
+    def set_interval(self, seconds):
+        self.interval = seconds
+
+class AsyncRollTimer:
+    '''
+    DiceRollTimer for the asyncio engine. Same behaviour (see DiceRollTimer),
+    but the countdown loop is a task on the running event loop instead of
+    a thread, so the action runs on the event loop thread. Like
+    ScheduledRollTimer it counts down to absolute deadlines so it doesn't drift,
+    skips the rolls an overrun missed and announces the seconds actually left.
+    '''
+    def __init__(self, interval, fn_action, channel):
+        self.interval = interval
+        self.action = fn_action
+        self.channel = channel
+        self.paused = False
+        self.running = False
+        self.restart_event = asyncio.Event()
+        self.task = None
+
+    def start(self):
+        self.task = asyncio.get_running_loop().create_task(self.run())
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        self.running = True
+        deadline = loop.time() + self.interval
+        while self.running:
+            self.channel.send(bmsg('actiontime', round(deadline - loop.time(), 3)))
+            await asyncio.sleep(deadline - loop.time())
+            if self.paused:
+                self.restart_event.clear()
+                await self.restart_event.wait()
+                self.paused = False
+                deadline = loop.time()
+            if self.running:
+                self.action()
+            deadline = next_roll_deadline(deadline, self.interval, loop.time())
+
+    def pause(self):
+        self.paused = True
+
+    def restart(self):
+        if self.paused:
+            self.paused = False
+        if not self.restart_event.is_set():
+            self.restart_event.set()
+
+    def stop(self):
+        self.running = False
+
+    def set_interval(self, seconds):
+        self.interval = seconds
+
+class LoopLock:
+    '''
+    Stand-in for a game's threading.Lock when everything runs on one event
+    loop thread. There is nothing to wait for, but locked() is still tracked
+    so assert_locked() keeps catching unsynchronized calls.
+    '''
+    def __init__(self):
+        self._locked = False
+
+    def __enter__(self):
+        if self._locked:
+            raise RuntimeError("LoopLock is not re-entrant")
+        self._locked = True
+
+    def __exit__(self, *exc_info):
+        self._locked = False
+
+    def locked(self):
+        return self._locked
+
+class EncoderThread(threading.Thread):
+    '''
+    Makes, encodes and sends the messages for game events (--encoder thread), so
+    the thread that ran a game action (roll timer, selector loop) is free as soon
+    as the game_lock is released. Jobs run one at a time in the order they were
+    submitted. Games submit while still holding their game_lock, so a game's
+    messages go out in the order its events happened.
+    '''
+    def __init__(self):
+        super().__init__(name='encoder', daemon=True)
+        self._jobs = queue.SimpleQueue()
+
+    def submit(self, fn, *args):
+        self._jobs.put((fn, args))
+
+    def run(self):
+        while True:
+            fn, args = self._jobs.get()
+            try:
+                fn(*args)
+            except Exception:
+                print (traceback.format_exc())
+
+class SpectatorFanout(threading.Thread):
+    '''
+    Sends spectators the latest state of the game they watch (market, leaderboard),
+    at most every interval seconds and only when it changed. A game's tick only
+    replaces its spectator_state. States in between are conflated, and a
+    spectator whose last update is still in its outbound buffer is skipped until
+    it has gone out, so slow spectators never have more than one update queued.
+    '''
+    def __init__(self, interval):
+        super().__init__(name='spectator-fanout', daemon=True)
+        self.interval = interval
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                send_spectator_updates()
+            except Exception:
+                print (traceback.format_exc())
+
+def send_spectator_updates():
+    '''one round of spectator updates, for every game'''
+    for game in list(games.values()):
+        if not game.spectators:
+            continue
+        with game.spectator_lock:
+            spectators = tuple(game.spectators)
+        version, state = game.spectator_state
+        due = [ c for c in spectators if c.spectated_version < version and not c.backlogged() ]
+        if due:
+            for c in due:
+                c.spectated_version = version
+            multicast(due, [ OutMessage('spectate', state) ])
+
+class GameWorkers:
+    '''
+    Pool of threads that run game commands (--gameworkers N). Each game is an
+    actor: its orders, ready signals and die rolls go into the game's inbox and
+    are run one at a time, in the order they arrived, by whichever worker picks
+    the game up. A game is never run by two workers at once, while different
+    games run side by side and the selector loop only does I/O.
+    '''
+    BATCH = 64 # commands a worker runs for one game before letting other games have a turn
+
+    def __init__(self, n_workers):
+        self._ready = queue.SimpleQueue() # games with commands waiting
+        self._threads = [ threading.Thread(target=self._work, name=f'game-worker-{i}', daemon=True)
+                for i in range(n_workers) ]
+
+    def start(self):
+        for t in self._threads:
+            t.start()
+
+    def post(self, game, client, fn, *args):
+        '''queue fn(*args) on game. client (if any) gets an error message if it fails'''
+        with game.inbox_lock:
+            game.inbox.append((client, fn, args))
+            if game.inbox_scheduled:
+                return
+            game.inbox_scheduled = True
+        self._ready.put(game)
+
+    def _work(self):
+        while True:
+            game = self._ready.get()
+            for i in range(GameWorkers.BATCH):
+                with game.inbox_lock:
+                    if not game.inbox:
+                        game.inbox_scheduled = False
+                        break
+                    client, fn, args = game.inbox.popleft()
+                try:
+                    fn(*args)
+                except Exception:
+                    if client:
+                        client.send(bmsg('error', f'Message Processing caused exception: {fn.__name__}'))
+                    print (f'Game command {fn.__name__} in {game.name} caused exception')
+                    print (traceback.format_exc())
+            else:
+                self._ready.put(game) # still has commands, back of the line
+
+# engine specific classes used by StockTickerGame. main() changes these
+roll_timer_class = DiceRollTimer
+game_lock_class = threading.Lock
+roll_scheduler = None # RollScheduler when roll_timer_class is ScheduledRollTimer
+encoder = None # EncoderThread with --encoder thread
+game_workers = None # GameWorkers with --gameworkers N
+tick_feed = None # TickFeed with --tickfeed
+spectator_fanout = None # SpectatorFanout (selectors engine)
+
+# field names of the event records games make while locked, by message type (see StockTickerGame.publish)
+EVENT_FIELDS = { mtype: layout.fields for (mtype, layout) in BINARY_LAYOUTS.items() }
+EVENT_FIELDS['leaderboard'] = ('top', 'players')
+EVENT_FIELDS['approve'] = ('reqid', 'order', 'reject-reason', 'cost', 'approved', 'cash', 'portfolio')
+
 class StockTickerGame():
     '''
     Encapsulates an entire session of Stock Ticker including the market
@@ -236,7 +1162,7 @@ class StockTickerGame():
     STATUS_RUNNING = 1
     STATUS_ENDED = 2
 
-    def __init__(self, gamename):
+    def __init__(self, gamename, gid=None):
         self.INIT_VAL = 100      # stock price for each at game start
         self.OFF_MARKET_VAL = 0  # stock goes off market if <= this price
         self.SPLIT_VAL = 200     # stock will split if >= this price
@@ -249,14 +1175,27 @@ class StockTickerGame():
         self.AMOUNT_DIE = (5, 10, 20)
 
         self.name = gamename
-        self.id = str(uuid.uuid4())
+        self.id = gid or str(uuid.uuid4())
         self.option_ignore_nopay_divrolls = True # skip die rolls that div a non-paying stock
         self.option_gamelen = SERVER_OPT['gamelen']
         self.option_timer_seconds = SERVER_OPT['timersec']
+        self.option_fastforward = SERVER_OPT['fastforward']
+        self.option_leaderboard_rolls = SERVER_OPT['leaderboard_rolls']
+        self.option_leaderboard_top = 10 # players listed in leaderboard messages
+        self.set_seed(SERVER_OPT['seed'])
+        self._fastforward_time = None # game clock while fast forwarding
 
         #self.stock_names = stock_names hmm not needed
         self.market = [ self.INIT_VAL for i in range(len(stock_names)) ]
         self._players = dict()
+        self._slots = dict() # slot: Player
+        self._next_slot = 0
+        self._rolls = 0
+        self._feed_seq = 0 # datagrams sent on the tick feed
+        self.leaderboard = Leaderboard(len(stock_names), self.market)
+        self.store = None # PlayerStore with --playerstore arrays
+        if SERVER_OPT['playerstore'] == 'arrays':
+            self.store = PlayerStore(len(stock_names))
         
         # status flags
         # TODO: implement these
@@ -268,8 +1207,23 @@ class StockTickerGame():
         #self.has_ended = False # True only after the game has ended
 
         #self.roll_timer = threading.Timer(self.option_timer_seconds, self.market_action)
-        self.roll_timer = DiceRollTimer(self.option_timer_seconds, self.market_action)
-        self.game_lock = threading.Lock()
+        self.channel = Channel(f'game-{gamename}') # the players
+        self.roll_timer = roll_timer_class(self.option_timer_seconds, self.roll_action, self.channel)
+        self.spectators = set() # clients watching the game
+        self.spectator_lock = threading.Lock() # for spectators, so the fan-out never waits on the game_lock
+        self.spectator_state = (0, None) # (version, data of the latest spectate message)
+        self.inbox = collections.deque() # commands for this game's worker (--gameworkers)
+        self.inbox_lock = threading.Lock()
+        self.inbox_scheduled = False # True while the game is queued for or held by a worker
+        self.game_lock = game_lock_class()
+        self.journal = None # GameJournal if journaling
+        if SERVER_OPT['journal_dir']:
+            self.journal = GameJournal(os.path.join(SERVER_OPT['journal_dir'], f'{self.name}-{self.id}.stj'))
+            self.journal.header(self)
+        self.marketfeed = None # MarketFeed with --marketfeed
+        if SERVER_OPT['marketfeed']:
+            self.marketfeed = MarketFeed(f"{SERVER_OPT['marketfeed']}-{self.name}", len(stock_names))
+            self.publish_market(None)
         # REMOVE # self.buysell_call_id = None # id of the last buysell_call sent out to players
 
     def add_player(self, client):
@@ -277,21 +1231,43 @@ class StockTickerGame():
             raise RuntimeError(f"{client.get_name()} already in this game")
         with self.game_lock:
             client.game = self
-            p = Player( client, 
-                        self.INIT_CASH,
-                        tuple(0 for s in stock_names))
+            if self.store:
+                p = StoredPlayer(self.store, client, self.INIT_CASH, tuple(0 for s in stock_names), self._next_slot)
+            else:
+                p = Player( client, 
+                            self.INIT_CASH,
+                            tuple(0 for s in stock_names),
+                            self._next_slot)
+            self._next_slot += 1
             self._players[client.get_name()] = p
+            self._slots[p.slot] = p
+            self.leaderboard.add(p.slot, p.cash)
             client.set_player_info(p)
+            if self.journal:
+                self.journal.join(p.slot, p.name)
+        self.channel.subscribe(client)
 
     def remove_player(self, playername):
         with self.game_lock:
             client = self._players[playername].client
+            self.channel.unsubscribe(client)
             client.clear_player_info()
+            if self.journal:
+                self.journal.leave(self._players[playername].slot)
+            slot = self._players[playername].slot
+            if self.store:
+                self.store.remove(slot)
+            self.leaderboard.remove(slot)
+            del self._slots[slot]
             del self._players[playername]
 
     def player(self, name):
         return self._players[name]
 
+    def is_playing(self, player):
+        '''player is still in the game (commands queued before it left are dropped). Must be called with the game_lock on'''
+        return self._players.get(player.name) is player
+
     def players(self):
         with self.game_lock:
             return tuple(self._players.values())
@@ -318,22 +1294,61 @@ class StockTickerGame():
     def start_game(self):
         if self.status == StockTickerGame.STATUS_WAITING_START:
             self.status = StockTickerGame.STATUS_RUNNING
-            self.starttime = datetime.datetime.now(datetime.timezone.utc)
+            self.starttime = self.now()
             self.endtime = self.starttime + datetime.timedelta(minutes=self.option_gamelen)
-            self.roll_timer.start()
+            if self.journal:
+                self.journal.start()
+            if self.marketfeed:
+                with self.game_lock:
+                    self.publish_market(None)
+            if self.spectators:
+                with self.game_lock:
+                    self.update_spectator_state()
+            if not self.option_fastforward:
+                self.roll_timer.start()
         else:
             raise RuntimeError(f"Attempt to start_game not in a waiting state {self.status}")
 
+    def set_seed(self, seed):
+        '''
+        Seed this game's dice. With the same seed (and game name) the game
+        rolls the same sequence every time. None seeds from the system.
+        '''
+        self.rng = random.Random(None if seed is None else f'{seed}-{self.name}')
+
     def die_roll(self):
         ''' Produces a die and returns the result, including a flag to inicate
             if a useless dividend was rolled. Does not act on roll result. '''
+        rng = self.rng
         retval = {
-            'stock': random.choice(self.STOCK_DIE),
-            'action': random.choice(self.ACTION_DIE),
-            'amount': random.choice(self.AMOUNT_DIE)
+            'stock': rng.choice(self.STOCK_DIE),
+            'action': rng.choice(self.ACTION_DIE),
+            'amount': rng.choice(self.AMOUNT_DIE)
         }
         return retval
 
+    def now(self):
+        '''current time on the game clock. Wall clock unless fast forwarding'''
+        if self._fastforward_time is not None:
+            return self._fastforward_time
+        return datetime.datetime.now(datetime.timezone.utc)
+
+    def fast_forward(self):
+        '''
+        Play the rest of a started game without waiting between rolls. The game
+        clock moves ahead option_timer_seconds per roll, so the game ends after
+        the same number of rolls it would have had in real time.
+        Returns the number of rolls.
+        '''
+        self._fastforward_time = self.now()
+        interval = datetime.timedelta(seconds=self.option_timer_seconds)
+        rolls = 0
+        while self.is_running():
+            self._fastforward_time += interval
+            self.market_action()
+            rolls += 1
+        return rolls
+
     def init_game_info(self, playername):
         p = self._players[playername]
         return { 'cash':      p.cash,
@@ -343,15 +1358,14 @@ class StockTickerGame():
     def process_order(self, player, buysell_order):
         ''' Apply the buy/sell order '''
         total_cents_spent = 0
-        approve_data = {
-            'reqid': buysell_order['reqid'],
-            'order': [],
-            'reject-reason': None
-        }
+        order = []
+        reject_reason = None
         with self.game_lock:
+            if not self.is_playing(player):
+                return # left the game while the order was queued
             new_shares_totals = [ x for x in player.get_portfolio() ]
             for i, (shares, expected_price) in enumerate(buysell_order['data']):
-                approve_data['order'].append((shares,self.market[i]))
+                order.append((shares,self.market[i]))
                 total_cents_spent += shares * self.market[i]
                 new_shares_totals[i] += shares
             total_dollars_spent = int(total_cents_spent / 100)
@@ -360,29 +1374,36 @@ class StockTickerGame():
             if bln_enough_cash and bln_enough_shares:
                 player.cash -= total_dollars_spent
                 player.set_portfolio_all(new_shares_totals)
-                approve_data['cost'] = total_dollars_spent
+                self.leaderboard.set_cash(player.slot, player.cash)
+                for i, shares in enumerate(new_shares_totals):
+                    self.leaderboard.set_shares(player.slot, i, shares)
+                self.leaderboard.commit()
+                if self.journal:
+                    self.journal.order(player.slot, total_dollars_spent, [ shares for (shares, price) in buysell_order['data'] ])
+                cost = total_dollars_spent
                 bln_approved = True
             else:
-                approve_data['cost'] = 0
+                cost = 0
                 reasons = []
                 if not bln_enough_cash:
                     reasons.append('not enough cash')
                 if not bln_enough_shares:
                     reasons.append('not enough shares')
                 if reasons:
-                    approve_data['reject-reason'] = '/'.join(reasons)
+                    reject_reason = '/'.join(reasons)
                 else:
-                    approve_data['reject-reason'] = '???'
+                    reject_reason = '???'
                 bln_approved = False
-            approve_data['approved'] = bln_approved
-            approve_data['cash'] = player.cash
-            approve_data['portfolio'] = player.get_portfolio()
-        player.conn.send(bmsg('approve', approve_data))
+            events = [ (player, 'approve', (buysell_order['reqid'], order, reject_reason, cost,
+                        bln_approved, player.cash, player.get_portfolio())) ]
+            events = self._events_done((player,), events)
+        if events:
+            self.publish(*events)
         
     def _process_split(self, i_stock):
         '''
         Stock prices reached max. Process dividend, reset price, adjust affected player
-        portfolios, return messages.
+        portfolios, return event records.
 
         Must be called with the game_lock on.
         '''
@@ -391,56 +1412,72 @@ class StockTickerGame():
             # NOTE: *could* use re-entrant lock but prefer to avoid
             raise RuntimeError("Unsynchronized call")
 
-        player_msgs = []
-        for player in self._players.values():
-            # dividend 20 paid out
-            div_dollars = int(player.get_portfolio(i_stock) * 0.2)
-            player.cash += div_dollars
-            shares_gained = player.get_portfolio(i_stock)
-            player.add_shares(i_stock, shares_gained)
-            split_msg_data = {
-                'stock': i_stock,
-                'newprice': self.INIT_VAL,
-                'div': self.INIT_VAL >= self.DIV_VAL, # always no after split
-                'shares': player.get_portfolio(i_stock),
-                'gained': shares_gained,
-                'divpaid': div_dollars,
-                'playercash': player.cash
-            }
-            player_msgs.append((player, bmsg('split', split_msg_data)))
+        if self.journal:
+            self.journal.split(i_stock)
+        events = []
+        bln_div = self.INIT_VAL >= self.DIV_VAL # always no after split
+        if self.store:
+            players = self.store.players
+            for (slot, gained, divpaid, shares, cash) in zip(*self.store.split(i_stock)):
+                if gained:
+                    self.leaderboard.set_cash(slot, cash)
+                    self.leaderboard.set_shares(slot, i_stock, shares)
+                events.append((players[slot], 'split', (i_stock, self.INIT_VAL, bln_div, shares, gained, divpaid, cash)))
+        else:
+            for player in self._players.values():
+                # dividend 20 paid out
+                div_dollars = int(player.get_portfolio(i_stock) * 0.2)
+                player.cash += div_dollars
+                shares_gained = player.get_portfolio(i_stock)
+                player.add_shares(i_stock, shares_gained)
+                if shares_gained:
+                    self.leaderboard.set_cash(player.slot, player.cash)
+                    self.leaderboard.set_shares(player.slot, i_stock, shares_gained * 2)
+                events.append((player, 'split', (i_stock, self.INIT_VAL, bln_div,
+                        shares_gained * 2, shares_gained, div_dollars, player.cash)))
         self.market[i_stock] = self.INIT_VAL
-        return player_msgs
+        self.leaderboard.set_price(i_stock, self.INIT_VAL)
+        return events
         
     def _process_bust(self, i_stock):
         '''
         Stock prices reached zero. Reset price, adjust affected player
-        portfolios, return generated messages.
+        portfolios, return event records.
 
         Must be called with the game_lock on.
         '''
         self.assert_locked()
-
-        player_msgs = []
-        for player in self._players.values():
-            shares_lost = player.get_portfolio(i_stock)
-            player.set_portfolio(i_stock, 0)
-            bust_msg_data = {
-                'stock': i_stock,
-                'newprice': self.INIT_VAL,
-                'div': self.INIT_VAL >= self.DIV_VAL,
-                'shares': 0,
-                'lost': shares_lost
-            }
-            player_msgs.append((player, bmsg('offmarket', bust_msg_data)))
+        if self.journal:
+            self.journal.bust(i_stock)
+
+        events = []
+        bln_div = self.INIT_VAL >= self.DIV_VAL
+        if self.store:
+            players = self.store.players
+            for (slot, shares_lost) in zip(*self.store.bust(i_stock)):
+                if shares_lost:
+                    self.leaderboard.set_shares(slot, i_stock, 0)
+                events.append((players[slot], 'offmarket', (i_stock, self.INIT_VAL, bln_div, 0, shares_lost)))
+        else:
+            for player in self._players.values():
+                shares_lost = player.get_portfolio(i_stock)
+                player.set_portfolio(i_stock, 0)
+                if shares_lost:
+                    self.leaderboard.set_shares(player.slot, i_stock, 0)
+                events.append((player, 'offmarket', (i_stock, self.INIT_VAL, bln_div, 0, shares_lost)))
         self.market[i_stock] = self.INIT_VAL
-        return player_msgs
+        self.leaderboard.set_price(i_stock, self.INIT_VAL)
+        return events
 
     def market_action(self):
         '''Rolls dice and applies changes to the game (DiceRollTimer's action)
         This is the target of the DiceRollTimer. Also checks the time to see
         if the game has ended'''
         # roll the dice
-        player_msgs = [] # send after lock released
+        # the locked section only records events: (player or None for everyone, mtype, field values).
+        # The messages are made and sent by publish() once the lock is released
+        events = []
+        split_bust = None # message type if the roll split or busted the stock
         with self.game_lock:
             roll = self.die_roll()
             attempts = 1
@@ -451,52 +1488,182 @@ class StockTickerGame():
                         raise RuntimeError(f"Too many no-pay dividend die rolls")
                     attempts += 1
                     roll = self.die_roll()
-            player_msgs.extend((p, bmsg('roll', roll)) for p in self._players.values())
-            price_change_data = None
+            if self.journal:
+                self.journal.roll(roll)
             # simplify reading roll values
             (stock, action, amount) = (roll[x] for x in ['stock', 'action', 'amount'])
+            events.append((None, 'roll', (stock, action, amount)))
             if action in ['UP', 'DOWN']:
                 self.market[stock] += amount if action=='UP' else -amount
-                split_bust_msgs = None
+                self.leaderboard.set_price(stock, self.market[stock])
+                split_bust_events = None
                 if self.market[stock] >= self.SPLIT_VAL:
-                    split_bust_msgs = self._process_split(stock)
+                    split_bust = 'split'
+                    split_bust_events = self._process_split(stock)
                 elif self.market[stock] <= self.OFF_MARKET_VAL:
-                    split_bust_msgs = self._process_bust(stock)
-                price_change_data = {'stock': stock,
-                        'amount': amount,
-                        'newprice': self.market[stock],
-                        'div': self.pays_dividend(stock)
-                    }
-                pc_msg = bmsg('markettick', price_change_data)
+                    split_bust = 'offmarket'
+                    split_bust_events = self._process_bust(stock)
                 # market_tick messages should go before split/bust
-                player_msgs.extend((p, pc_msg) for p in self._players.values())
-                if split_bust_msgs:
-                    player_msgs.extend(split_bust_msgs)
+                events.append((None, 'markettick', (stock, amount, self.market[stock], self.pays_dividend(stock))))
+                if split_bust_events:
+                    events.extend(split_bust_events)
             if action == 'DIV' and self.pays_dividend(stock):
-                for player in self._players.values():
-                    div_dollars = int(player.get_portfolio(stock) * amount/100)
-                    if div_dollars:
-                        player.cash += div_dollars
-                        div_msg_data = {
-                            'stock': stock,
-                            'amount': amount,
-                            'divpaid': div_dollars,
-                            'playercash': player.cash
-                        }
-                        player_msgs.append((player, bmsg('div', div_msg_data)))
+                if self.journal:
+                    self.journal.div(stock, amount)
+                if self.store:
+                    players = self.store.players
+                    for (slot, div_dollars, cash) in zip(*self.store.dividend(stock, amount)):
+                        self.leaderboard.set_cash(slot, cash)
+                        events.append((players[slot], 'div', (stock, amount, div_dollars, cash)))
+                else:
+                    for player in self._players.values():
+                        div_dollars = int(player.get_portfolio(stock) * amount/100)
+                        if div_dollars:
+                            player.cash += div_dollars
+                            self.leaderboard.set_cash(player.slot, player.cash)
+                            events.append((player, 'div', (stock, amount, div_dollars, player.cash)))
+            self.leaderboard.commit()
+            self._rolls += 1
+            if self.option_leaderboard_rolls and self._rolls % self.option_leaderboard_rolls == 0:
+                events.append((None, 'leaderboard', self.leaderboard_info()))
             # check time
-            curtime = datetime.datetime.now(datetime.timezone.utc)
+            curtime = self.now()
             if curtime > self.endtime:
                 # game is over, set status, stop timer while locked
                 self.status = StockTickerGame.STATUS_ENDED
                 self.roll_timer.stop()
-
+                if self.journal:
+                    self.journal.end()
+            if self.marketfeed:
+                self.publish_market((stock, action, amount))
+            if self.spectators:
+                self.update_spectator_state()
+            feed_packet = None
+            if tick_feed:
+                feed_packet = self.tick_feed_packet(events, split_bust)
+            events = self._events_done(tuple(self._players.values()), events)
+            if self.status == StockTickerGame.STATUS_ENDED and encoder:
+                encoder.submit(self.end_game) # after this action's messages
             # end lock
-        for (p, m) in player_msgs:
-            p.conn.send(m)
-        if self.status == StockTickerGame.STATUS_ENDED:
+        if feed_packet:
+            tick_feed.send(feed_packet)
+        if events:
+            self.publish(*events)
+        if self.status == StockTickerGame.STATUS_ENDED and not encoder:
             self.end_game()
 
+    def publish_market(self, roll):
+        '''write the market to the shared memory feed. Must be called with the game_lock on'''
+        self.assert_locked()
+        divmask = sum(1 << i for i in range(len(self.market)) if self.pays_dividend(i))
+        self.marketfeed.publish(self._rolls, self.status, roll, self.market, divmask)
+
+    def tick_feed_packet(self, events, split_bust):
+        '''
+        Tick feed datagram of a market action: its roll and markettick events, the
+        split/bust without player fields. Must be called with the game_lock on
+        '''
+        self.assert_locked()
+        self._feed_seq += 1
+        msgs = [ (mtype, dict(zip(EVENT_FIELDS[mtype], values))) for (player, mtype, values) in events
+                 if mtype in ('roll', 'markettick') ]
+        if split_bust:
+            stock = msgs[0][1]['stock']
+            data = dict.fromkeys(EVENT_FIELDS[split_bust], 0) # no player fields
+            data.update(stock=stock, newprice=self.market[stock], div=self.pays_dividend(stock))
+            msgs.append((split_bust, data))
+        if self.status == StockTickerGame.STATUS_ENDED:
+            msgs.append(('gamestat', 'ENDED'))
+        return tick_feed.packet(self.name, self._feed_seq, self._rolls, msgs)
+
+    def add_spectator(self, client):
+        '''client watches the game. It gets the current state right away, updates from the SpectatorFanout'''
+        with self.game_lock:
+            self.update_spectator_state()
+            version, state = self.spectator_state
+        client.spectating = self
+        client.spectated_version = version
+        with self.spectator_lock:
+            self.spectators.add(client)
+        client.send(OutMessage('spectate', state))
+
+    def remove_spectator(self, client):
+        with self.spectator_lock:
+            self.spectators.discard(client)
+        client.spectating = None
+
+    def update_spectator_state(self):
+        '''
+        Replace the state spectators are sent with the current market and leaderboard.
+        Must be called with the game_lock on
+        '''
+        self.assert_locked()
+        top, n_players = self.leaderboard_info()
+        self.spectator_state = (self.spectator_state[0] + 1, {
+                'tick': self._rolls,
+                'status': self.get_status(),
+                'market': [ (val, val >= self.DIV_VAL) for val in self.market ],
+                'top': top,
+                'players': n_players})
+
+    def snapshot(self):
+        '''the market and the tick feed seq it is up to date with, for a snapshot message'''
+        with self.game_lock:
+            return {'game': self.name,
+                    'seq': self._feed_seq,
+                    'tick': self._rolls,
+                    'market': [ (val, val >= self.DIV_VAL) for val in self.market ]}
+
+    def roll_action(self):
+        '''roll timer action: the market action, run on the game's worker with --gameworkers'''
+        game_command(self, None, self.market_action)
+
+    def _events_done(self, players, events):
+        '''
+        End of a locked section that recorded events. With an encoder thread the
+        events are handed to it here, while still locked, so they are published in
+        the order they happened. Otherwise returns the arguments for publish(),
+        to call once the lock is released.
+        '''
+        if encoder:
+            encoder.submit(self.publish, players, events)
+            return None
+        return (players, events)
+
+    def publish(self, players, events):
+        '''
+        Make and send the messages for event records from a locked section.
+        players: the game's players when the events were recorded (recipients of
+        events for everyone). Runs without the game_lock.
+        '''
+        # everything a player gets from these events goes out in one send. Players
+        # on a gateway get each run of messages for everyone as one multicast
+        msgs_by_player = { p: [] for p in players if p.client.link is None }
+        gateway_clients = [ p.client for p in players if p.client.link is not None ]
+        runs = [] # [(player, [msgs])] for gateway players in event order, player None for everyone
+        for (player, mtype, values) in events:
+            msg = OutMessage(mtype, dict(zip(EVENT_FIELDS[mtype], values)))
+            if player is None:
+                for msgs in msgs_by_player.values():
+                    msgs.append(msg)
+                if not gateway_clients:
+                    continue
+            elif player.client.link is None:
+                msgs_by_player.setdefault(player, []).append(msg)
+                continue
+            if runs and runs[-1][0] is player:
+                runs[-1][1].append(msg)
+            else:
+                runs.append((player, [msg]))
+        for p, msgs in msgs_by_player.items():
+            if msgs:
+                p.client.send_many(msgs)
+        for player, msgs in runs:
+            if player is None:
+                multicast(gateway_clients, msgs)
+            else:
+                player.client.send_many(msgs)
+
     def pays_dividend(self, i_stock):
         self.assert_locked()
         return self.market[i_stock] >= self.DIV_VAL
@@ -517,26 +1684,36 @@ class StockTickerGame():
     def is_running(self):
         return self.status == StockTickerGame.STATUS_RUNNING
 
+    def leaderboard_info(self):
+        '''
+        Top players by net worth and number of players, the fields of a
+        leaderboard message. Must be called with the game_lock on.
+        '''
+        self.assert_locked()
+        return ([ (self._slots[slot].name, networth) for (slot, networth) in self.leaderboard.top(self.option_leaderboard_top) ],
+                len(self.leaderboard))
+
     def end_game(self):
         '''Figure out the winner, send messages'''
-        max_networth = -1
-        winners = []
-        lst_player_data = []
-        for p in self.players():
-            summary = p.summary() 
-            summary['name'] = p.name
-            lst_player_data.append(summary)
-            if summary['networth'] > max_networth:
-                max_networth = summary['networth']
-                winners = [p.name]
-            elif summary['networth'] == max_networth:
-                winners.append(p.name)
+        with self.game_lock:
+            # net worths are kept up to date by the leaderboard, players listed best first
+            winner_slots, max_networth = self.leaderboard.leaders()
+            winners = [ self._slots[slot].name for slot in winner_slots ]
+            lst_player_data = []
+            for (slot, networth) in self.leaderboard.top():
+                p = self._slots[slot]
+                lst_player_data.append({
+                    'cash': p.cash,
+                    'networth': networth,
+                    'portfolio': p.get_portfolio(),
+                    'name': p.name
+                })
         end_game_data = {
             'winner': winners,
             'winner-networth': max_networth,
             'player-info': lst_player_data
         }
-        send_all(bmsg('gameover', end_game_data))
+        self.channel.send(bmsg('gameover', end_game_data))
 
     def get_status(self):
         # NOTE: may add more details (e.g. paused,etc?), so using dictionary even though just 1 item...
@@ -547,28 +1724,32 @@ class StockTickerGame():
             return 'WAITING-START'
         elif self.status == StockTickerGame.STATUS_RUNNING:
             return 'RUNNING'
-        elif self.status == StockTickerGame.STATUS_RUNNING:
+        elif self.status == StockTickerGame.STATUS_ENDED:
             return 'ENDED'
         else:
             raise ValueError(f"Game in bad state: {self.status}")
 
 # -- end class StockTickerGame
 
-# NOTE: any use for supplying data here? Example in python selectors web page did...
-sel.register(serversocket, selectors.EVENT_READ, "listen-new")
-
 # NOTE: One day server will be able to host multiple games so conceptually keeping
 #       the design such that the change will be easier
 games = dict()
 
-def create_game(name):
+def create_game(name, gid=None):
     if name in games:
         raise ValueError(f"game already exists [{name}]")
-    games[name] = StockTickerGame(name)
+    games[name] = StockTickerGame(name, gid)
+
+# with --workers, every game of the server: name: (id, control socket of the worker
+# hosting it, None for games in this process)
+game_directory = None
+
+def game_list():
+    '''(name, id) of every game a client can join, for conn-accept'''
+    if game_directory is not None:
+        return tuple((name, gid) for (name, (gid, owner)) in game_directory.items())
+    return tuple((g.name,g.id) for g in games.values())
 
-# Until clients can create games, make one
-create_game('default-game')
-game = StockTickerGame('default-game')
 clients = dict()  # key = player name. *all* players in system
 
 # simple message object/dictionary
@@ -589,71 +1770,140 @@ def bmsg(str_type, data):
 def process_join_request(client, gamename, gid):
     ''' client message: join-game 
         return True if successful'''
-    if client.get_player():
+    if client.get_player() or client.spectating:
         return (False, 'already in a game')
     if not gamename in games:
         return (False, 'game not found')
     game = games[gamename]
     if gid != game.id:
         return (False, 'wrong game id')
+    lobby_channel.unsubscribe(client)
     game.add_player(client)
     return (True, None)
 
+def process_spectate_request(client, gamename, gid):
+    ''' client message: spectate. Watch a game without playing
+        return True if successful'''
+    if client.get_player() or client.spectating:
+        return (False, 'already in a game')
+    if not gamename in games:
+        return (False, 'game not found')
+    game = games[gamename]
+    if gid != game.id:
+        return (False, 'wrong game id')
+    global_channel.unsubscribe(client) # spectators only get their game's state
+    lobby_channel.unsubscribe(client)
+    game.add_spectator(client)
+    return (True, None)
+
+CHAT_MAX = 4096 # characters of a chat message, the rest is cut off (it also goes to the other processes)
+
+def chat_text(data):
+    '''the message of a chat (msg) from a client as text of at most CHAT_MAX characters'''
+    return (data if isinstance(data, str) else json.dumps(data))[:CHAT_MAX]
+
 # process a message recieved from a client
 #def process_message(msgobj, name):
 def process_message(message, clientname):
     mtype, mdata = message['TYPE'], message['DATA']
-    client = clients[clientname]
+    client = clients.get(clientname)
+    if client is None:
+        return # handed over to another worker, which got this message with the socket
     player = client.get_player()
     game = client.get_game()
     try:
         if message['TYPE'] == 'msg':
             # incoming chat message
-            chat_msg = message['DATA']
+            chat_msg = chat_text(message['DATA'])
             #send_all(bmsg('chatmsg', f'[{datetime.datetime.now()}] {clientname}: {chat_msg}'))
-            send_all(bmsg('chatmsg', {'time': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            chat_data = {'time': datetime.datetime.now(datetime.timezone.utc).isoformat(),
                         'playername': clientname,
-                        'message': chat_msg}))
+                        'message': chat_msg}
+            send_all(bmsg('chatmsg', chat_data))
+            for control in control_channels:
+                control_send(control, 'chat', chat_data) # players in other processes/the lobby
+
         elif message['TYPE'] == 'exit':
             print (f'exit message recieved from {clientname}')
             disconnect_client(client)
         elif message['TYPE'] == 'join-game':
             gamename, gid = mdata
+            if game_directory and game_directory.get(gamename, (None, None))[1] and not player:
+                hand_over_client(client, game_directory[gamename][1], mdata)
+                return
             bln_success, fail_reason = process_join_request(client, gamename, gid)
             if bln_success:
                 # success - send game info
                 game = games[gamename]
                 player = game.player(client.get_name())
-                client.conn.send(bmsg('initgame', game.init_game_info(player.name)))
-                client.conn.send(bmsg('gamestat', game.get_status()))
-                send_all(bmsg('joined', {'newplayer': player.name, 'all': game.playernames()}))
-                client.conn.send(bmsg('playerlist', game.playernames()))
+                client.send(bmsg('initgame', game.init_game_info(player.name)))
+                client.send(bmsg('gamestat', game.get_status()))
+                joined = bmsg('joined', {'newplayer': player.name, 'all': game.playernames()})
+                game.channel.send(joined)
+                lobby_channel.send(joined) # clients that haven't picked a game yet
+                client.send(bmsg('playerlist', game.playernames()))
             else:
                 # fail
-                client.conn.send(bsmg('joinfail', {'reason': fail_reason}))
+                client.send(bmsg('joinfail', {'reason': fail_reason}))
                 
+        elif message['TYPE'] == 'spectate':
+            gamename, gid = mdata
+            if game_directory and game_directory.get(gamename, (None, None))[1] and not player:
+                hand_over_client(client, game_directory[gamename][1], mdata, 'spectate')
+                return
+            bln_success, fail_reason = process_spectate_request(client, gamename, gid)
+            if not bln_success:
+                client.send(bmsg('joinfail', {'reason': fail_reason}))
         elif message['TYPE'] == 'readystart':
-            if not player.ready_start:
-                player.ready_start = True
-                send_all(bmsg('servermsg', f'{player.name} is ready to start'))
-            if game.all_players_ready():
-                game.start_game()
-                send_all(bmsg('gamestart', {
-                        'gamelen': game.option_gamelen, 
-                        'stoptime': game.endtime.isoformat()}))
-                send_all(bmsg('gamestat', game.get_status()))
+            game_command(game, client, process_ready, game, player)
+        elif message['TYPE'] == 'snapshot':
+            # market of a game, for tick feed receivers that missed datagrams
+            if mdata in games:
+                client.send(bmsg('snapshot', games[mdata].snapshot()))
+            else:
+                client.send(bmsg('error', f'Snapshot of unknown game: {mdata}'))
+        elif message['TYPE'] == 'queuestats':
+            client.send(bmsg('queuestats', queue_metrics()))
         elif message['TYPE'] == 'buysell':
-            game.process_order(player, message['DATA'])
+            game_command(game, client, game.process_order, player, message['DATA'])
         else:
             # ERROR
-            client.conn.send(bmsg('error', f'Unrecognized message type: {message["DATA"]}'))
+            client.send(bmsg('error', f'Unrecognized message type: {message["DATA"]}'))
             print (f"Got bad message type {message['TYPE']} from {clientname}")
     except:
-        client.conn.send(bmsg('error', f'Message Processing caused exception: {mtype} | {mdata}'))
+        client.send(bmsg('error', f'Message Processing caused exception: {mtype} | {mdata}'))
         print (f'Message from {clientname} caused exception: {mtype} | {mdata}')
         print(traceback.format_exc())
     
 
+def process_ready(game, player):
+    ''' client message: readystart. Starts the game once all its players are ready '''
+    with game.game_lock:
+        if not game.is_playing(player):
+            return # left the game while the command was queued
+    if not player.ready_start:
+        player.ready_start = True
+        game.channel.send(bmsg('servermsg', f'{player.name} is ready to start'))
+    if game.all_players_ready():
+        game.start_game()
+        game.channel.send(bmsg('gamestart', {
+                'gamelen': game.option_gamelen, 
+                'stoptime': game.endtime.isoformat()}))
+        game.channel.send(bmsg('gamestat', game.get_status()))
+        if game.option_fastforward:
+            game.fast_forward()
+
+def game_command(game, client, fn, *args):
+    '''
+    Run a command that changes game state (fn(*args)): queued for the game's
+    worker with --gameworkers, otherwise right here. client (if any) is sent
+    an error message if the command fails
+    '''
+    if game_workers:
+        game_workers.post(game, client, fn, *args)
+    else:
+        fn(*args)
+
 # NOTE: not used in the current version of the game. Could be a future option
 def buysell_call(game):
     '''
@@ -665,7 +1915,7 @@ def buysell_call(game):
         raise RuntimeError("buysell_call issued with one already active")
     call_id = uuid.uuid4()
     game.buysell_call_id = call_id
-    send_all(bmsg('buysell', {'reqid': call_id}))
+    game.channel.send(bmsg('buysell', {'reqid': call_id}))
 
 def disconnect_client(client):
     name = client.get_name()
@@ -673,22 +1923,114 @@ def disconnect_client(client):
     #del client_conns[oClient.conn]
     if game := client.get_game():
         game.remove_player(name) # call is sync'd
-        send_all_game(game, bmsg('disconnect', name))
-        send_all_game(game, bmsg('playerlist', game.playernames()))
+        game.channel.send(bmsg('disconnect', name))
+        game.channel.send(bmsg('playerlist', game.playernames()))
         print (f'Removed {name} from game "{game.name}"')
-    sel.unregister(client.conn)
-    client.conn.close()
-    del clients[name]
+    if client.spectating:
+        client.spectating.remove_spectator(client)
+    client.close()
+    remove_client(client)
+    for control in control_channels:
+        control_send(control, 'gone', name) # name can be used again
     print (f'{name} has disconnected')
 
+def multicast(to_clients, msgs, everyone=False):
+    '''
+    Send msgs (OutMessages or message bytes) to all of to_clients. Clients of a
+    gateway get them as one packet per gateway (and encoding), which the gateway
+    sends on to each of them. everyone: to_clients is every client of the server
+    '''
+    plain = not any(isinstance(m, OutMessage) for m in msgs) # same bytes for json and binary clients
+    groups = dict() # (link, binary): [connection ids]
+    for client in to_clients:
+        if client.link is None:
+            client.send_many(msgs)
+        else:
+            groups.setdefault((client.link, None if plain else client.binary), []).append(client.conn_id)
+    for (link, binary), conn_ids in groups.items():
+        frames = msgs if plain else [ m.frame(binary) if isinstance(m, OutMessage) else m for m in msgs ]
+        size = sum(len(f) for f in frames)
+        if everyone and plain:
+            link.send_many([ link_header(LINK_BROADCAST, 0, size) ] + frames)
+        else:
+            link.send_many([ multicast_header(conn_ids, size) ] + frames)
+
+# ------------------------------------------------------------------------------
+#                                   CHANNELS
+# ------------------------------------------------------------------------------
+# A message for many clients is sent to a channel, which keeps the list of its
+# subscribers, so sending costs the number of clients that should get it, not
+# the number connected:
+#   global_channel  every client except spectators: chat, server-exit
+#   lobby_channel   clients that haven't joined or picked a game to watch yet
+#   game.channel    the players of a game: joins, ready, countdown, start, game over
+# Clients are subscribed to global and lobby when they connect (add_client),
+# move from the lobby to their game's channel when they join, and are removed
+# from all of them when they leave (remove_client). The die roll messages of a
+# game go to its players with StockTickerGame.publish.
+
+class Channel:
+    '''
+    Subscribers of one topic. Sending uses a tuple of them that is only rebuilt
+    after the subscribers changed, so it never holds the lock while sending
+    '''
+    def __init__(self, name, everyone=False):
+        '''everyone: channel of every client, it can use gateway broadcasts while it has them all'''
+        self.name = name
+        self.everyone = everyone
+        self._subscribers = dict() # name: Client
+        self._members = ()
+        self._changed = False
+        self._lock = threading.Lock()
+
+    def subscribe(self, client):
+        with self._lock:
+            self._subscribers[client.get_name()] = client
+            self._changed = True
+        client.channels.add(self)
+
+    def unsubscribe(self, client):
+        with self._lock:
+            if self._subscribers.get(client.get_name()) is client:
+                del self._subscribers[client.get_name()]
+                self._changed = True
+        client.channels.discard(self)
+
+    def members(self):
+        with self._lock:
+            if self._changed:
+                self._members = tuple(self._subscribers.values())
+                self._changed = False
+            return self._members
+
+    def send(self, msgobj):
+        '''msgobj: an OutMessage or the bytes of a message'''
+        self.send_many([msgobj])
+
+    def send_many(self, msgs):
+        members = self.members()
+        if members:
+            multicast(members, msgs, everyone=self.everyone and len(members) == len(clients))
+
+global_channel = Channel('global', everyone=True)
+lobby_channel = Channel('lobby')
+
+def add_client(client):
+    '''new connection has done its handshake'''
+    clients[client.get_name()] = client
+    global_channel.subscribe(client)
+    lobby_channel.subscribe(client)
+
+def remove_client(client):
+    '''connection is gone (or handed over to another process)'''
+    for channel in tuple(client.channels):
+        channel.unsubscribe(client)
+    del clients[client.get_name()]
+
 # msgobj: bytes of json message to send
 def send_all(msgobj):
-    for client in clients.values():
-        client.conn.send(msgobj)
-
-def send_all_game(game, msgobj):
-    for player in game.players():
-        player.conn.send(msgobj)
+    '''send to every client except spectators, they only get their game's state (SpectatorFanout)'''
+    global_channel.send(msgobj)
 
 def send_others_game(player, msgobj):
     if player.game is None:
@@ -696,75 +2038,909 @@ def send_others_game(player, msgobj):
         print (f"ERROR! send_others_game for {player.name}. Not in game")
     for o_player in player.game.players():
         if o_player.name != player.name:
-            player.conn.send(msgobj)
+            o_player.client.send(msgobj)
 
-running = True
-while running:
-    try:
-        # if timeout expires, select() returns empty list
-        # if we don't set timeout, select() blocks and on Windows, CTRL-C doesn't even break it
-        events = sel.select(timeout=5.0)
-        for key, mask in events:
-            if key.data == "listen-new":
-                # this is a new connection, get name and register with selector
-                conn, addr = key.fileobj.accept()
-                validconnection = True # true if client provides expected and valid initial message
-                try:
-                    #NOTE: first MessageReceiver uses get_message, the next one uses a handler
-                    msgrec = MessageReceiver('client', conn)
-                    msgrec.add_bytes(conn.recv(1024))
-                    init_msg = msgrec.get_message()  # blocks
-                    if init_msg['TYPE'] != 'initconn':
-                        # TODO: something more meaningful here
-                        print (f'Bad message type [{init_msg["TYPE"]}] from [{addr}]')
-                    else:
-                        print ("initial msg received from connecting client")
-                    client_name = init_msg['DATA']
-                    if client_name:
-                        if client_name in clients:
-                            conn.send(bmsg('error', f'Client {client_name} already connected'))
-                            print (f'Connection from [{addr}] refused, {client_name} already connected')
-                            validconnection = False
-                except Exception:
-                    print(traceback.format_exc())
-                    validconnection = False
-                if validconnection:
+def serve_selectors(port, controls=(), reuse_port=False, gateway_port=None):
+    '''
+    Run the server: one selector loop for all connections, a DiceRollTimer thread per game
+    port: None in a shard process (--shards), clients are all handed over by the acceptor
+    controls: control sockets to the acceptor (--shards) or the other workers (--workers)
+    reuse_port: bind with SO_REUSEPORT so other workers can listen on the same port
+    gateway_port: also accept links from gateways (st_gateway.py) on this port
+    '''
+    serversocket = None
+    if port is not None:
+        serversocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if reuse_port:
+            serversocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        serversocket.bind(('localhost', port))
+        serversocket.listen(SERVER_OPT['backlog']) # become a server socket
+        # NOTE: any use for supplying data here? Example in python selectors web page did...
+        sel.register(serversocket, selectors.EVENT_READ, "listen-new")
+    gatewaysocket = None
+    if gateway_port is not None:
+        gatewaysocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        gatewaysocket.bind(('localhost', gateway_port))
+        gatewaysocket.listen()
+        sel.register(gatewaysocket, selectors.EVENT_READ, "gateway-new")
+    for control in controls:
+        control.setblocking(False) # see control_send
+        sel.register(control, selectors.EVENT_READ, "control")
+    sel.register(wakeup_recv, selectors.EVENT_READ, "wakeup")
+
+    running = True
+    while running:
+        try:
+            # if timeout expires, select() returns empty list
+            # if we don't set timeout, select() blocks and on Windows, CTRL-C doesn't even break it
+            events = sel.select(timeout=1.0)
+            for key, mask in events:
+                if key.data == "listen-new":
+                    # this is a new connection. It becomes a Client once its initconn arrives
+                    conn, addr = key.fileobj.accept()
                     conn.setblocking(False)
-                    client = Client(client_name, conn)
-                    clients[client_name] = client # add to system
-                    # MOVE THIS: game.add_player(player)       # add to game
-                    sel.register(conn, selectors.EVENT_READ, clients[client_name])
-                    # send list of game names
-                    # TODO: only list games that are joinable/not started
-                    conn.send(bmsg('conn-accept', tuple((g.name,g.id) for g in games.values())))
-                    print (f'[{client_name}] has joined. {len(clients)} total clients')
-                else:
-                    conn.close()
-            else:
-                # HMM: when would selectors.EVENT_WRITE ever be used??
-                # this is an incoming message from a connected client
-                client = key.data
-                conn = key.fileobj
-                if mask & selectors.EVENT_READ:
-                    msgrec = client.message_receiver
+                    if SERVER_OPT['sndbuf']:
+                        conn.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SERVER_OPT['sndbuf'])
+                    sel.register(conn, selectors.EVENT_READ, add_pending(conn, addr))
+                elif key.data == "gateway-new":
+                    conn, addr = key.fileobj.accept()
+                    conn.setblocking(False)
+                    conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1) # carries every player's orders
+                    link = GatewayLink(conn, addr)
+                    gateway_links.append(link)
+                    sel.register(conn, selectors.EVENT_READ, link)
+                    print (f'{link.get_name()} connected')
+                elif isinstance(key.data, PendingConnection):
+                    # initconn (hopefully) arriving from a new connection
+                    try:
+                        n = key.data.message_receiver.recv()
+                    except Exception:
+                        # bad initconn, connection reset, etc
+                        print (f'Handshake from [{key.data.addr}] failed')
+                        print(traceback.format_exc())
+                        n = 0
+                    if not n and key.data.client is None and not key.data.closed:
+                        key.data.close()
+                elif key.data == "control":
+                    # handover or cross-process message from the acceptor or another worker
+                    if mask & selectors.EVENT_WRITE:
+                        control_flush(key.fileobj)
+                    if mask & selectors.EVENT_READ and not control_received(key.fileobj):
+                        control_closed(key.fileobj)
+                        control_channels.remove(key.fileobj)
+                        running = serversocket is not None # a shard can't go on without its acceptor
+                elif key.data == "wakeup":
+                    # some client(s) have outbound data the socket wouldn't take
                     try:
-                        b = conn.recv(1024)
-                    except Exception as e:
-                        # ConnectionResetError?
-                        print (f'conn.recv Exc: {e}')
-                        b = None
-                    if b:
-                        msgrec.add_bytes(b)
-                    else:
-                        # disconnected
-                        disconnect_client(client)
+                        while wakeup_recv.recv(1024):
+                            pass
+                    except BlockingIOError:
+                        pass
+                    while not write_requests.empty():
+                        client = write_requests.get()
+                        if not client.closed and client.handoff is None:
+                            sel.modify(client.conn, selectors.EVENT_READ | selectors.EVENT_WRITE, client)
+                else:
+                    # this is an incoming message from a connected client, or
+                    # a client socket that can take more of its outbound buffer
+                    client = key.data
+                    conn = key.fileobj
+                    if mask & selectors.EVENT_WRITE and not client.closed:
+                        if client.flush():
+                            if client.handoff:
+                                finish_handoff(client)
+                            else:
+                                sel.modify(conn, selectors.EVENT_READ, client)
+                    if mask & selectors.EVENT_READ and not client.closed:
+                        msgrec = client.message_receiver
+                        try:
+                            n = msgrec.recv() # messages are processed in here
+                        except (OSError, ValueError) as e:
+                            # ConnectionResetError? or a message that is too big or can't be decoded
+                            print (f'conn.recv Exc: {e}')
+                            n = 0
+                        if not n:
+                            # disconnected
+                            if isinstance(client, GatewayLink):
+                                client.link_lost()
+                            else:
+                                disconnect_client(client)
+            if pending_deadlines:
+                expire_pending()
+            if slow_clients:
+                expire_slow()
+            if handoffs:
+                expire_handoffs()
+        except KeyboardInterrupt:
+            print ('#keyboard interrupt')
+            running = False
+        except Exception as e:
+            print (f'ERROR in main loop: {e}')
+            print (traceback.format_exc())
+    send_all(bmsg('server-exit', None))
+    for client in list(clients.values()) + gateway_links:
+        client.flush() # best effort, anything the socket won't take is lost
+    if serversocket:
+        serversocket.close()
+    if gatewaysocket:
+        gatewaysocket.close()
+
+class ServerProtocol(asyncio.BufferedProtocol):
+    '''
+    One connection in the asyncio engine. The event loop receives straight into
+    the connection's MessageReceiver buffer. The first message must be initconn,
+    after that messages go to process_message like in the selectors engine.
+    '''
+    def connection_made(self, transport):
+        self.transport = transport
+        self.client = None
+        self.msgrec = MessageReceiver('client', None, self.message_received)
+        asyncio.get_running_loop().call_later(SERVER_OPT['handshake_sec'], self.handshake_expired)
+
+    def handshake_expired(self):
+        if self.client is None and not self.transport.is_closing():
+            print (f'Connection from [{self.transport.get_extra_info("peername")}] dropped, no initconn received')
+            self.transport.close()
+
+    def get_buffer(self, sizehint):
+        return self.msgrec.get_buffer(sizehint)
+
+    def buffer_updated(self, nbytes):
+        try:
+            self.msgrec.buffer_updated(nbytes)
+        except ValueError as e:
+            # too big or can't be decoded
+            print (f'Connection from [{self.transport.get_extra_info("peername")}] dropped: {e}')
+            self.transport.close()
+
+    def message_received(self, message):
+        if self.client is not None:
+            process_message(message, self.client.get_name())
+            return
+        try:
+            client_name, client_caps = parse_initconn(message)
+        except Exception:
+            print(traceback.format_exc())
+            self.transport.close()
+            return
+        if client_name in clients:
+            self.transport.write(bmsg('error', f'Client {client_name} already connected'))
+            print (f'Connection from [{self.transport.get_extra_info("peername")}] refused, {client_name} already connected')
+            self.transport.close()
+            return
+        self.client = AsyncClient(client_name, self.transport, client_caps, self.msgrec)
+        self.transport.set_write_buffer_limits(high=SERVER_OPT['outbuf_high'], low=SERVER_OPT['outbuf_low'])
+        if SERVER_OPT['sndbuf']:
+            self.transport.get_extra_info('socket').setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SERVER_OPT['sndbuf'])
+        add_client(self.client)
+        self.client.send(bmsg('conn-accept', tuple((g.name,g.id) for g in games.values())))
+        print (f'[{client_name}] has joined. {len(clients)} total clients')
+
+    def pause_writing(self):
+        if self.client is not None:
+            self.client.writing_paused()
+
+    def resume_writing(self):
+        if self.client is not None:
+            self.client.writing_resumed()
+
+    def connection_lost(self, exc):
+        if self.client is not None and not self.client.closed:
+            disconnect_client(self.client)
+
+async def spectator_updates():
+    '''the SpectatorFanout of the asyncio engine, on the event loop'''
+    while True:
+        await asyncio.sleep(SERVER_OPT['spectator_sec'])
+        send_spectator_updates()
+
+async def slow_consumer_checks():
+    '''expire_slow for the asyncio engine'''
+    while True:
+        await asyncio.sleep(1.0)
+        if slow_clients:
+            expire_slow()
+
+async def serve_asyncio_main(port):
+    loop = asyncio.get_running_loop()
+    server = await loop.create_server(ServerProtocol, 'localhost', port, backlog=SERVER_OPT['backlog'])
+    updates = loop.create_task(spectator_updates())
+    checks = loop.create_task(slow_consumer_checks())
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        updates.cancel()
+        checks.cancel()
+        send_all(bmsg('server-exit', None))
+
+def serve_asyncio(port):
+    '''
+    Run the server on one asyncio event loop: connections are ServerProtocol
+    instances and every game's roll timer is a task on the same loop
+    '''
+    try:
+        asyncio.run(serve_asyncio_main(port))
     except KeyboardInterrupt:
         print ('#keyboard interrupt')
-        running = False
-    except Exception as e:
-        print (f'ERROR in main loop: {e}')
-        print (traceback.format_exc())
-send_all(bmsg('server-exit', None))
-serversocket.close()
 
+# ------------------------------------------------------------------------------
+#                              GATEWAYS (--gateway-port)
+# ------------------------------------------------------------------------------
+# A gateway (st_gateway.py) accepts client connections, does the framing and the
+# initconn handshake for them and passes their messages on over one link to the
+# server (see GATEWAY LINK in st_common). Here the link is a GatewayLink in the
+# selector loop and every client behind it is a GatewayClient without a socket of
+# its own. A message for many clients (send_all, the events of a die roll) is one
+# packet per gateway, sent on to each client by the gateway (see multicast).
+
+gateway_links = [] # GatewayLinks of the connected gateways
+
+class GatewayLink(Client):
+    '''
+    The connection from a gateway. Its outbound buffer works like any Client's,
+    the packets received are connections opening/closing and their messages
+    '''
+    def __init__(self, conn, addr):
+        super().__init__(f'gateway-{addr}', conn, message_receiver=LinkReceiver('gateway', conn, self.packet_received))
+        self.addr = addr
+        self.clients = dict() # connection id: GatewayClient
+
+    def _start_holding(self):
+        pass # never a slow consumer, link packets can't be dropped or reordered. The gateway limits its connections
+
+    def _lane(self, msg):
+        return LANE_CRITICAL # one lane: a packet is a link header and the frames after it
+
+    def packet_received(self, packet):
+        kind, conn_id, payload = packet
+        try:
+            if kind == LINK_DATA:
+                client = self.clients.get(conn_id)
+                if client is not None:
+                    process_message(decode_message(payload), client.get_name())
+            elif kind == LINK_OPEN:
+                self.open(conn_id, payload)
+            elif kind == LINK_CLOSE:
+                client = self.clients.get(conn_id)
+                if client is not None:
+                    disconnect_client(client)
+        except Exception:
+            # only this connection goes, the rest of the packets are for other clients
+            print (f'Bad packet from {self.get_name()} for connection {conn_id}')
+            print (traceback.format_exc())
+            client = self.clients.get(conn_id)
+            if client is not None:
+                disconnect_client(client) # closes it on the gateway too
+            else:
+                self.send(encode_link(LINK_CLOSE, conn_id))
+
+    def open(self, conn_id, initconn):
+        '''new connection on the gateway, initconn: body of its initconn message'''
+        try:
+            client_name, client_caps = parse_initconn(decode_message(initconn))
+        except Exception:
+            print (f'Bad initconn from {self.get_name()}')
+            print(traceback.format_exc())
+            self.send(encode_link(LINK_CLOSE, conn_id))
+            return
+        if client_name in clients:
+            self.send_many([encode_link(LINK_DATA, conn_id, bmsg('error', f'Client {client_name} already connected')),
+                            encode_link(LINK_CLOSE, conn_id)])
+            print (f'Connection through {self.get_name()} refused, {client_name} already connected')
+            return
+        client = GatewayClient(client_name, self, conn_id, client_caps)
+        self.clients[conn_id] = client
+        add_client(client)
+        # in one send, so no broadcast can get to the connection before conn-accept
+        self.send_many([encode_link(LINK_OPEN, conn_id),
+                        encode_link(LINK_DATA, conn_id, bmsg('conn-accept', game_list()))])
+        print (f'[{client_name}] has joined through {self.get_name()}. {len(clients)} total clients')
+
+    def link_lost(self):
+        '''the gateway is gone, and with it all its clients'''
+        print (f'{self.get_name()} has disconnected')
+        self.close()
+        for client in list(self.clients.values()):
+            disconnect_client(client)
+        gateway_links.remove(self)
+
+class GatewayClient(Client):
+    '''
+    A client connected through a gateway. Its messages go over the gateway's
+    link with its connection id, the gateway has its socket
+    '''
+    def __init__(self, name, link, conn_id, caps=()):
+        super().__init__(name, None, caps, link.message_receiver)
+        self.link = link
+        self.conn_id = conn_id
+
+    def send(self, msg):
+        if isinstance(msg, OutMessage):
+            msg = msg.frame(self.binary)
+        if not self.closed:
+            self.link.send_many([ link_header(LINK_DATA, self.conn_id, len(msg)), msg ])
+
+    def send_many(self, msgs):
+        frames = [ m.frame(self.binary) if isinstance(m, OutMessage) else m for m in msgs ]
+        if not self.closed and frames:
+            self.link.send_many([ link_header(LINK_DATA, self.conn_id, sum(len(f) for f in frames)) ] + frames)
+
+    def flush(self):
+        return True
 
+    def queued_bytes(self):
+        return 0 # queued on the gateway
+
+    def close(self):
+        self.closed = True
+        if self.link.clients.pop(self.conn_id, None) is not None:
+            self.link.send(encode_link(LINK_CLOSE, self.conn_id))
+
+# ------------------------------------------------------------------------------
+#                              SHARDS (--shards N)
+# ------------------------------------------------------------------------------
+# The games are split between N shard processes (game i goes to shard i % N), so
+# the server isn't limited to the one core a CPython process can use. The main
+# process is the acceptor: it does the initconn handshake, lists the games of all
+# shards and lets connections chat in the lobby. When a connection joins a game,
+# its socket is passed to the shard hosting that game (SCM_RIGHTS over a unix
+# socket) together with any bytes already received after the join-game message.
+# The shard then serves it like any other client.
+#
+# Each shard has one SOCK_SEQPACKET control socket to the acceptor. A packet is a
+# framed json message (like a client message), followed by the received bytes
+# for a handoff:
+#   shard -> acceptor:  games [(name, id),...]  chat {chatmsg data}  gone name
+#   acceptor -> shard:  handoff {name, caps, join, mtype} + socket  chat {chatmsg data}
+# (mtype is join-game, or spectate for a connection that watches the game)
+
+#
+# The control sockets are non-blocking. Two processes sending to each other
+# (chat between workers) must not wait for each other, so packets a control
+# socket won't take are queued and sent when it is writable (control_flush),
+# like a client's outbound messages. A queued handoff keeps a duplicate of the
+# socket's fd. Chat is dropped rather than queued beyond CONTROL_QUEUE_MAX.
+
+CONTROL_MAX = 1 << 18 # largest control packet
+CONTROL_QUEUE_MAX = 1 << 22 # bytes queued for a control socket before chat is dropped
+
+control_channels = [] # control sockets to the acceptor (shard) or the other workers (--workers)
+control_queues = dict() # control socket: deque of (packet, fds) it hasn't taken yet
+control_queued = collections.Counter() # control socket: bytes in its queue
+
+def control_send(control, mtype, data, raw=b'', fds=()):
+    '''
+    Send a control packet, or queue it if the socket won't take it now. Only from
+    the selector loop. Returns False if it can't be sent: too big, or the other side is gone
+    '''
+    packet = bmsg(mtype, data) + raw
+    if len(packet) > CONTROL_MAX:
+        print (f'control packet {mtype} of {len(packet)} bytes is too big')
+        return False
+    pending = control_queues.get(control)
+    if pending is None:
+        try:
+            control_write(control, packet, fds)
+            return True
+        except BlockingIOError:
+            pending = control_queues[control] = collections.deque()
+            sel.modify(control, selectors.EVENT_READ | selectors.EVENT_WRITE, "control")
+        except OSError as e:
+            print (f'control send failed: {e}')
+            return False
+    elif mtype == 'chat' and control_queued[control] > CONTROL_QUEUE_MAX:
+        return True # the other side isn't keeping up. Chat can go, the rest can't
+    pending.append((packet, [ os.dup(fd) for fd in fds ]))
+    control_queued[control] += len(packet)
+    return True
+
+def control_write(control, packet, fds):
+    if fds:
+        socket.send_fds(control, [packet], fds)
+    else:
+        control.send(packet)
+
+def control_flush(control):
+    '''control socket is writable: send what is queued for it'''
+    pending = control_queues.get(control, ())
+    while pending:
+        packet, fds = pending[0]
+        try:
+            control_write(control, packet, fds)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            print (f'control send failed: {e}') # the other side is gone, reading will tell
+            break
+        pending.popleft()
+        control_queued[control] -= len(packet)
+        for fd in fds:
+            os.close(fd)
+    drop_control_queue(control)
+    sel.modify(control, selectors.EVENT_READ, "control")
+
+def drop_control_queue(control):
+    for packet, fds in control_queues.pop(control, ()):
+        for fd in fds:
+            os.close(fd)
+    control_queued.pop(control, None)
+
+def control_closed(control):
+    '''the other side of a control socket is gone: stop watching it, drop what is queued'''
+    sel.unregister(control)
+    drop_control_queue(control)
+
+def control_recv(control):
+    '''(message, raw bytes, fds) of the next control packet. message is None if the other side is gone'''
+    data, fds, flags, addr = socket.recv_fds(control, CONTROL_MAX, 1)
+    if not data:
+        return None, b'', fds
+    sz = struct.unpack_from('I', data)[0]
+    return json.loads(data[4:4+sz]), data[4+sz:], fds
+
+def control_received(control):
+    '''control packet arrived from the acceptor or another worker. Returns False when it is gone'''
+    message, raw, fds = control_recv(control)
+    if message is None:
+        print ('control channel closed')
+        return False
+    mtype, mdata = message['TYPE'], message['DATA']
+    if mtype == 'handoff':
+        conn = socket.socket(fileno=fds[0])
+        conn.setblocking(False)
+        name = mdata['name']
+        if name in clients:
+            # only possible with --workers, names are only checked per worker
+            conn.send(bmsg('error', f'Client {name} already connected'))
+            conn.close()
+            return True
+        client = Client(name, conn, mdata['caps'])
+        add_client(client)
+        sel.register(conn, selectors.EVENT_READ, client)
+        print (f'[{name}] handed over. {len(clients)} total clients')
+        process_message({'TYPE': mdata.get('mtype', 'join-game'), 'DATA': mdata['join']}, name)
+        if raw:
+            client.message_receiver.add_bytes(raw) # sent after join-game, before the handoff
+    elif mtype == 'chat':
+        send_all(bmsg('chatmsg', mdata))
+    return True
+
+handoffs = dict() # client: time.monotonic() deadline. Draining their outbound queue before a handoff
+
+def hand_over_client(client, control, join, mtype='join-game'):
+    '''
+    (--workers) client wants to join (mtype join-game) or watch (spectate) a game hosted
+    by another worker. Pass its socket, and anything received after that message, to that worker.
+    Anything queued for it must arrive before the other worker's messages, so if the socket
+    hasn't taken it all yet, the client stops being read and gets nothing new until the
+    selector loop has sent it (finish_handoff). It is dropped if that takes --slow-grace seconds
+    '''
+    name = client.get_name()
+    remove_client(client)
+    if client.spectating:
+        client.spectating.remove_spectator(client)
+    slow_clients.discard(client)
+    client.handoff = (control,
+            {'name': name, 'caps': [CAP_BINARY] if client.binary else [], 'join': join, 'mtype': mtype},
+            client.message_receiver.unprocessed())
+    if client.flush():
+        finish_handoff(client)
+    else:
+        handoffs[client] = time.monotonic() + SERVER_OPT['slow_grace']
+        sel.modify(client.conn, selectors.EVENT_WRITE, client) # the rest of its input goes to the other worker
+
+def finish_handoff(client):
+    '''the client's outbound queue is empty, pass its socket on'''
+    control, data, raw = client.handoff
+    handoffs.pop(client, None)
+    if control_send(control, 'handoff', data, raw=raw, fds=[client.conn.fileno()]):
+        print (f'[{data["name"]}] handed over to the worker hosting {data["join"][0]}')
+    else:
+        print (f'[{data["name"]}] dropped, handoff to the worker hosting {data["join"][0]} failed')
+    client.close()
+
+def expire_handoffs():
+    '''drop clients that didn't read what was queued for them before their handoff in time'''
+    now = time.monotonic()
+    for client in [ c for (c, deadline) in handoffs.items() if deadline < now ]:
+        name = client.get_name()
+        print (f'[{name}] dropped, outbound queue not drained for its handoff')
+        del handoffs[client]
+        client.close()
+        for control in control_channels:
+            control_send(control, 'gone', name)
+
+def serve_shard(args, index, control):
+    '''body of shard process index: host its share of the games, take clients from the acceptor'''
+    setup(args)
+    control_channels.append(control)
+    for i, name in enumerate(game_names(args.games)):
+        if i % args.shards == index:
+            create_game(name)
+    control_send(control, 'games', [ (g.name, g.id) for g in games.values() ])
+    serve_selectors(None, control_channels)
+    close_games()
+
+class LobbyConnection:
+    '''
+    A connection to the acceptor (--shards) that hasn't joined a game yet. It sends
+    initconn, gets the games of all shards, can chat, and is handed over to the
+    shard hosting the game it joins
+    '''
+    def __init__(self, lobby, conn, addr, deadline):
+        self.lobby = lobby
+        self.conn = conn
+        self.addr = addr
+        self.deadline = deadline # for initconn (then for a handoff), time.monotonic() value
+        self.name = None
+        self.caps = ()
+        self.closed = False
+        self.handed_over = False
+        self.handoff = None      # (shard, handoff data, raw) while _outbuf drains before the handoff
+        self._outbuf = bytearray()
+        self.message_receiver = MessageReceiver('lobby', conn, self.message_received)
+
+    def send(self, msgbytes):
+        if self.closed:
+            return
+        self._outbuf += msgbytes
+        if len(self._outbuf) > self.lobby.outbuf_max:
+            print (f'Disconnecting [{self.name or self.addr}] from the lobby: {len(self._outbuf)} bytes queued')
+            self.close()
+            return
+        self.flush()
+
+    def flush(self):
+        '''send what the socket will take. Returns True once nothing is left'''
+        if self._outbuf and not self.closed:
+            try:
+                del self._outbuf[:self.conn.send(self._outbuf)]
+            except BlockingIOError:
+                pass
+            except OSError:
+                self._outbuf.clear()
+        if not self.closed and self.handoff is None: # a handoff stays registered for writing only
+            events = selectors.EVENT_READ | (selectors.EVENT_WRITE if self._outbuf else 0)
+            if sel.get_key(self.conn).events != events:
+                sel.modify(self.conn, events, self)
+        return not self._outbuf
+
+    def message_received(self, message):
+        if self.closed or self.handed_over:
+            return # anything after join-game goes to the shard with the socket
+        mtype, mdata = message['TYPE'], message['DATA']
+        if self.name is None:
+            name, caps = parse_initconn(message)
+            if name in self.lobby.names:
+                self.send(bmsg('error', f'Client {name} already connected'))
+                print (f'Connection from [{self.addr}] refused, {name} already connected')
+                self.close()
+                return
+            self.name, self.caps = name, caps
+            self.lobby.names.add(name)
+            self.send(bmsg('conn-accept', self.lobby.game_list))
+            print (f'[{name}] is in the lobby')
+        elif mtype in ('join-game', 'spectate'):
+            gamename, gid = mdata
+            shard = self.lobby.game_shard.get(gamename)
+            if shard is None or dict(self.lobby.game_list)[gamename] != gid:
+                self.send(bmsg('joinfail', {'reason': 'game not found' if shard is None else 'wrong game id'}))
+            else:
+                self.lobby.hand_over(self, shard, mdata, mtype)
+        elif mtype == 'msg':
+            self.lobby.chat({'time': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                    'playername': self.name,
+                    'message': chat_text(mdata)})
+        elif mtype == 'exit':
+            self.close()
+        else:
+            self.send(bmsg('error', f'Join a game first: {mtype}'))
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.name and not self.handed_over:
+            self.lobby.names.discard(self.name)
+        self.lobby.connections.pop(self.conn, None)
+        sel.unregister(self.conn)
+        self.conn.close()
+
+class Lobby:
+    '''The acceptor process of --shards: connections until they join a game, and the shard processes'''
+    def __init__(self, args):
+        self.connections = dict() # socket: LobbyConnection
+        self.names = set()        # names in use by lobby connections and players in shards
+        self.shards = []          # control sockets
+        self.game_list = []       # [(name, id),...] of all games, in game_names order
+        self.game_shard = dict()  # game name: control socket of its shard
+        self.processes = []
+        self.outbuf_max = args.outbuf_max    # a lobby connection with more queued is disconnected
+        self.handoff_grace = args.slow_grace # seconds for a connection to take what is queued before its handoff
+        ctx = multiprocessing.get_context('spawn') # fresh process, no selector/threads from this one
+        for i in range(args.shards):
+            mine, theirs = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+            proc = ctx.Process(target=serve_shard, args=(args, i, theirs), name=f'shard-{i}', daemon=True)
+            proc.start()
+            theirs.close()
+            self.shards.append(mine)
+            self.processes.append(proc)
+        game_ids = dict()
+        for control in self.shards:
+            message, raw, fds = control_recv(control)
+            for (name, gid) in message['DATA']:
+                game_ids[name] = gid
+                self.game_shard[name] = control
+        self.game_list = [ (name, game_ids[name]) for name in game_names(args.games) ]
+
+    def hand_over(self, lobby_conn, shard, join, mtype='join-game'):
+        '''
+        pass the connection's socket and anything received after join-game (or spectate) to shard.
+        What is queued for it must arrive before anything from the shard, so until the socket has
+        taken it the connection isn't read and gets nothing new (finish_handoff)
+        '''
+        lobby_conn.handed_over = True
+        lobby_conn.handoff = (shard,
+                {'name': lobby_conn.name, 'caps': list(lobby_conn.caps), 'join': join, 'mtype': mtype},
+                lobby_conn.message_receiver.unprocessed())
+        if lobby_conn.flush():
+            self.finish_handoff(lobby_conn)
+        else:
+            lobby_conn.deadline = time.monotonic() + self.handoff_grace
+            sel.modify(lobby_conn.conn, selectors.EVENT_WRITE, lobby_conn)
+
+    def finish_handoff(self, lobby_conn):
+        shard, data, raw = lobby_conn.handoff
+        if control_send(shard, 'handoff', data, raw=raw, fds=[lobby_conn.conn.fileno()]):
+            print (f'[{lobby_conn.name}] handed over to shard {self.shards.index(shard)}')
+        else:
+            print (f'[{lobby_conn.name}] dropped, handoff to shard {self.shards.index(shard)} failed')
+            self.names.discard(lobby_conn.name)
+        lobby_conn.close()
+
+    def chat(self, chat_data, from_shard=None):
+        msgbytes = bmsg('chatmsg', chat_data)
+        for lobby_conn in list(self.connections.values()):
+            if lobby_conn.name and not lobby_conn.handed_over:
+                lobby_conn.send(msgbytes)
+        for control in self.shards:
+            if control is not from_shard:
+                control_send(control, 'chat', chat_data)
+
+    def control_received(self, control):
+        message, raw, fds = control_recv(control)
+        if message is None:
+            print (f'shard {self.shards.index(control)} has stopped')
+            control_closed(control)
+            return
+        if message['TYPE'] == 'chat':
+            self.chat(message['DATA'], control)
+        elif message['TYPE'] == 'gone':
+            self.names.discard(message['DATA'])
+
+def serve_sharded(args):
+    '''Run the acceptor process of --shards (see SHARDS above)'''
+    lobby = Lobby(args)
+    serversocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    serversocket.bind(('localhost', args.port))
+    serversocket.listen(args.backlog)
+    sel.register(serversocket, selectors.EVENT_READ, "listen-new")
+    for control in lobby.shards:
+        control.setblocking(False) # see control_send
+        sel.register(control, selectors.EVENT_READ, "control")
+    print (f'{len(lobby.shards)} shards hosting {len(lobby.game_list)} games')
+
+    running = True
+    while running:
+        try:
+            for key, mask in sel.select(timeout=1.0):
+                if key.data == "listen-new":
+                    conn, addr = key.fileobj.accept()
+                    conn.setblocking(False)
+                    if args.sndbuf:
+                        conn.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, args.sndbuf) # kept when handed to a shard
+                    lobby.connections[conn] = LobbyConnection(lobby, conn, addr, time.monotonic() + args.handshake_sec)
+                    sel.register(conn, selectors.EVENT_READ, lobby.connections[conn])
+                elif key.data == "control":
+                    if mask & selectors.EVENT_WRITE:
+                        control_flush(key.fileobj)
+                    if mask & selectors.EVENT_READ:
+                        lobby.control_received(key.fileobj)
+                else:
+                    lobby_conn = key.data
+                    if mask & selectors.EVENT_WRITE and not lobby_conn.closed:
+                        if lobby_conn.flush() and lobby_conn.handoff:
+                            lobby.finish_handoff(lobby_conn)
+                    if mask & selectors.EVENT_READ and not lobby_conn.closed:
+                        try:
+                            n = lobby_conn.message_receiver.recv()
+                        except Exception:
+                            print (f'Connection from [{lobby_conn.addr}] failed')
+                            print (traceback.format_exc())
+                            n = 0
+                        if not n:
+                            lobby_conn.close()
+            now = time.monotonic()
+            for lobby_conn in [ c for c in lobby.connections.values() if c.name is None and c.deadline < now ]:
+                print (f'Connection from [{lobby_conn.addr}] dropped, no initconn received')
+                lobby_conn.close()
+            for lobby_conn in [ c for c in lobby.connections.values() if c.handoff and c.deadline < now ]:
+                print (f'[{lobby_conn.name}] dropped, outbound queue not drained for its handoff')
+                lobby.names.discard(lobby_conn.name) # never reached the shard
+                lobby_conn.close()
+        except KeyboardInterrupt:
+            print ('#keyboard interrupt')
+            running = False
+        except Exception as e:
+            print (f'ERROR in acceptor loop: {e}')
+            print (traceback.format_exc())
+    serversocket.close()
+    for control in lobby.shards:
+        control.close() # shards stop when their control socket closes
+    for proc in lobby.processes:
+        proc.join(5)
+
+# ------------------------------------------------------------------------------
+#                              WORKERS (--workers N)
+# ------------------------------------------------------------------------------
+# N full servers in their own processes, all listening on the same port with
+# SO_REUSEPORT so the OS spreads new connections between them and a burst of
+# connections is accepted N at a time. Games are split between the workers like
+# --shards (game i on worker i % N). The game ids are made up front, so every
+# worker has the same game directory (game_directory) and lists all the games.
+# A client joining a game of another worker is handed over to it on a control
+# socket (see SHARDS). Each pair of workers has one, and chat goes over them too.
+
+def serve_worker(args, index, peers, directory):
+    '''body of worker process index. peers: control sockets to the other workers'''
+    global game_directory
+    signal.signal(signal.SIGTERM, signal.default_int_handler) # from serve_workers: shut down like on an interrupt
+    setup(args)
+    control_channels.extend(peers.values())
+    game_directory = { name: (gid, peers.get(owner)) for (name, gid, owner) in directory }
+    for (name, gid, owner) in directory:
+        if owner == index:
+            create_game(name, gid)
+    serve_selectors(args.port, control_channels, reuse_port=True)
+    close_games()
+
+def serve_workers(args):
+    '''start the --workers processes and wait for them'''
+    directory = [ (name, str(uuid.uuid4()), i % args.workers) for (i, name) in enumerate(game_names(args.games)) ]
+    peers = [ dict() for i in range(args.workers) ] # per worker, {other worker: control socket}
+    for i, j in itertools.combinations(range(args.workers), 2):
+        peers[i][j], peers[j][i] = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    ctx = multiprocessing.get_context('spawn')
+    processes = [ ctx.Process(target=serve_worker, args=(args, i, peers[i], directory), name=f'worker-{i}')
+            for i in range(args.workers) ]
+    for proc in processes:
+        proc.start()
+    for control in itertools.chain.from_iterable(p.values() for p in peers):
+        control.close() # the workers have their own copies
+    print (f'{args.workers} workers listening on port {args.port}, hosting {len(directory)} games')
+
+    def stop_workers(signum, frame):
+        # terminated (e.g. by a service manager): the workers only hear about it from here
+        for proc in processes:
+            proc.terminate()
+        raise KeyboardInterrupt
+    signal.signal(signal.SIGTERM, stop_workers)
+    try:
+        for proc in processes:
+            proc.join()
+    except KeyboardInterrupt:
+        # the workers got the interrupt too (same process group), or SIGTERM from stop_workers, and are shutting down
+        print ('#keyboard interrupt')
+        try:
+            for proc in processes:
+                proc.join(5)
+        except KeyboardInterrupt:
+            pass
+        for proc in processes:
+            if proc.is_alive():
+                proc.kill() # SIGTERM only asks it to shut down
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+def setup(args):
+    '''set SERVER_OPT and the engine globals from the command line arguments'''
+    global roll_timer_class
+    global game_lock_class
+    global roll_scheduler
+    global encoder
+    global game_workers
+    global tick_feed
+    global spectator_fanout
+
+    SERVER_OPT['timersec'] = args.timersec
+    SERVER_OPT['gamelen'] = args.gamelen
+    SERVER_OPT['handshake_sec'] = args.handshake_sec
+    SERVER_OPT['seed'] = args.seed
+    SERVER_OPT['fastforward'] = args.fastforward
+    SERVER_OPT['journal_dir'] = args.journal
+    SERVER_OPT['playerstore'] = args.playerstore
+    SERVER_OPT['leaderboard_rolls'] = args.leaderboard_rolls
+    SERVER_OPT['marketfeed'] = args.marketfeed
+    SERVER_OPT['spectator_sec'] = args.spectator_sec
+    SERVER_OPT['backlog'] = args.backlog
+    SERVER_OPT['outbuf_high'] = args.outbuf_high
+    SERVER_OPT['outbuf_low'] = args.outbuf_low
+    SERVER_OPT['outbuf_max'] = args.outbuf_max
+    SERVER_OPT['slow_policy'] = frozenset(p for p in args.slow_policy.split(',') if p)
+    SERVER_OPT['slow_grace'] = args.slow_grace
+    SERVER_OPT['sndbuf'] = args.sndbuf
+    SERVER_OPT['lane_max_wait'] = args.lane_max_wait
+    if args.engine == 'asyncio':
+        roll_timer_class = AsyncRollTimer
+        game_lock_class = LoopLock
+    elif args.rolltimer == 'shared':
+        roll_scheduler = RollScheduler()
+        roll_scheduler.start()
+        roll_timer_class = ScheduledRollTimer
+
+    if args.encoder == 'thread':
+        if args.engine == 'asyncio':
+            parser.error('--encoder thread only works with the selectors engine')
+        encoder = EncoderThread()
+        encoder.start()
+
+    if args.engine != 'asyncio':
+        spectator_fanout = SpectatorFanout(args.spectator_sec)
+        spectator_fanout.start()
+
+    if args.tickfeed:
+        group, port = parse_group(args.tickfeed)
+        tick_feed = TickFeed(group, port, args.tickfeed_ttl, args.tickfeed_if)
+
+    if args.gameworkers:
+        if args.engine == 'asyncio':
+            parser.error('--gameworkers only works with the selectors engine')
+        game_workers = GameWorkers(args.gameworkers)
+        game_workers.start()
+
+def close_games():
+    '''close the journals and market feeds of this process's games'''
+    for game in games.values():
+        if game.journal:
+            game.journal.close()
+        if game.marketfeed:
+            game.marketfeed.close()
+
+def game_names(n_games):
+    '''names of the games the server hosts'''
+    return ['default-game'] + [ f'game-{i}' for i in range(2, n_games+1) ]
+
+def main():
+    args = parser.parse_args() 
+    if not set(p for p in args.slow_policy.split(',') if p) <= {'conflate', 'dropchat', 'disconnect'}:
+        parser.error(f'unknown --slow-policy: {args.slow_policy}')
+    if not args.outbuf_low <= args.outbuf_high <= args.outbuf_max:
+        parser.error('--outbuf-low, --outbuf-high and --outbuf-max must be in increasing order')
+    if args.gateway_port is not None and (args.engine == 'asyncio' or args.shards or args.workers):
+        parser.error('--gateway-port only works with the selectors engine, without --shards/--workers')
+    if args.shards:
+        if args.engine == 'asyncio':
+            parser.error('--shards only works with the selectors engine')
+        serve_sharded(args)
+        return
+    if args.workers:
+        if args.engine == 'asyncio':
+            parser.error('--workers only works with the selectors engine')
+        if not hasattr(socket, 'SO_REUSEPORT'):
+            parser.error('--workers needs SO_REUSEPORT, not available on this platform')
+        serve_workers(args)
+        return
+    setup(args)
+
+    # Until clients can create games, make them
+    for name in game_names(args.games):
+        create_game(name)
+
+    if args.engine == 'asyncio':
+        serve_asyncio(args.port)
+    else:
+        serve_selectors(args.port, gateway_port=args.gateway_port)
+    close_games()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,188 @@
+'''st_tickfeed.py
+UDP multicast feed of the market of every game (st_server.py --tickfeed
+GROUP:PORT), for spectators that only follow the prices. The server sends one
+datagram per die roll whatever the number of receivers, and a receiver is just
+a socket that joined the group, on the same machine or anywhere on the LAN.
+
+A datagram is HEADER (magic b'STTF', version, seq, tick, length of the game
+name), the game name (utf-8), then framed messages in their binary layouts
+where they have one (see st_common):
+
+    roll        the die roll
+    markettick  the price change of an UP/DOWN roll
+    split       / offmarket if the roll split or busted the stock. The player
+                fields (shares, gained, divpaid, playercash, lost) are 0
+    gamestat    'ENDED' in the datagram of the last roll
+
+seq counts the datagrams of a game, so a receiver knows it missed some when seq
+jumps. It then asks the server for the game's market with a 'snapshot' message
+over TCP (after its initconn, no need to join the game). The reply carries the
+seq of the last datagram the snapshot includes:
+
+    snapshot    {game: name, seq: n, tick: rolls so far, market: [(price, div),...]}
+
+    $ python st_tickfeed.py 239.255.42.1:8095 --game default-game --port 8089
+'''
+
+import argparse
+import os
+import socket
+import struct
+from st_common import MessageReceiver, FRAME_HEADER, encode_message, decode_message
+
+MAGIC = b'STTF'
+VERSION = 1
+HEADER = struct.Struct('<4sBQQB') # magic, version, seq, tick, length of game name
+MAX_DATAGRAM = 1 << 16
+
+def parse_group(group):
+    '''(address, port) from GROUP:PORT'''
+    addr, port = group.rsplit(':', 1)
+    return addr, int(port)
+
+class TickFeed:
+    '''
+    Sending side, one socket for all the games of a server. packet() can be made
+    with a game's lock on (it has the seq), send() after
+    '''
+    def __init__(self, group, port, ttl=1, interface=None):
+        '''ttl 1 keeps datagrams on the local network. interface: address of the interface to send on'''
+        self.addr = (group, port)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, ttl)
+        self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1) # receivers on this machine too
+        if interface:
+            self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(interface))
+        self.sock.setblocking(False)
+        self.dropped = 0 # datagrams the socket wouldn't take. Receivers see the gap
+
+    def packet(self, gamename, seq, tick, msgs):
+        '''datagram for msgs [(mtype, data),...]'''
+        name = gamename.encode('utf-8')
+        return (HEADER.pack(MAGIC, VERSION, seq, tick, len(name)) + name
+                + b''.join(encode_message(mtype, data, True) for (mtype, data) in msgs))
+
+    def send(self, packet):
+        try:
+            self.sock.sendto(packet, self.addr)
+        except OSError:
+            self.dropped += 1
+
+    def close(self):
+        self.sock.close()
+
+def decode_packet(data):
+    '''(game name, seq, tick, [messages]) of a datagram'''
+    magic, version, seq, tick, name_len = HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError('not a tick feed datagram')
+    view = memoryview(data)
+    pos = HEADER.size + name_len
+    gamename = str(view[HEADER.size:pos], 'utf-8')
+    msgs = []
+    while pos < len(data):
+        sz = FRAME_HEADER.unpack_from(data, pos)[0]
+        pos += FRAME_HEADER.size
+        msgs.append(decode_message(view[pos:pos+sz]))
+        pos += sz
+    return gamename, seq, tick, msgs
+
+class TickReceiver:
+    '''
+    Receiving side. Joins the group and keeps the market of one game up to date,
+    asking the server for a snapshot whenever datagrams were missed
+    '''
+    def __init__(self, group, port, gamename, server, server_port, interface='0.0.0.0', name=None):
+        self.gamename = gamename
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1) # more than one receiver per machine
+        self.sock.bind(('', port))
+        mreq = struct.pack('4s4s', socket.inet_aton(group), socket.inet_aton(interface))
+        self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
+        # TCP connection to the server, for snapshots only
+        self.conn = socket.create_connection((server, server_port))
+        self.msgrec = MessageReceiver('tickfeed', self.conn)
+        self.conn.sendall(encode_message('initconn', {'name': name or f'tickfeed-{os.getpid()}', 'caps': []}))
+        reply = self.next_reply()
+        if reply['TYPE'] != 'conn-accept':
+            raise ConnectionError(f'server refused the connection: {reply["DATA"]}')
+        self.seq = None    # seq of the last datagram applied
+        self.tick = 0
+        self.market = None # [[price, div],...]
+        self.gaps = 0      # times datagrams were missed
+        self.snapshot()
+
+    def next_reply(self):
+        '''next reply from the server, skipping chat and other messages for everyone'''
+        while True:
+            while self.msgrec.queue.empty():
+                if not self.msgrec.recv():
+                    raise ConnectionError('server closed the connection')
+            message = self.msgrec.get_message()
+            if message['TYPE'] in ('conn-accept', 'snapshot', 'error'):
+                return message
+
+    def snapshot(self):
+        '''get the game's market from the server'''
+        self.conn.sendall(encode_message('snapshot', self.gamename))
+        reply = self.next_reply()
+        if reply['TYPE'] != 'snapshot':
+            raise ValueError(f'no snapshot of {self.gamename}: {reply["DATA"]}')
+        snap = reply['DATA']
+        self.seq, self.tick = snap['seq'], snap['tick']
+        self.market = [ list(m) for m in snap['market'] ]
+
+    def receive(self):
+        '''
+        Wait for the next datagram of the game and apply it. Returns its messages,
+        or None if datagrams were missed and the market was reloaded instead
+        '''
+        while True:
+            gamename, seq, tick, msgs = decode_packet(self.sock.recv(MAX_DATAGRAM))
+            if gamename != self.gamename or seq <= self.seq:
+                continue # another game, or already in the snapshot
+            if seq != self.seq + 1:
+                # missed some. The snapshot includes this datagram (its seq was taken first)
+                self.gaps += 1
+                self.snapshot()
+                return None
+            self.seq, self.tick = seq, tick
+            for m in msgs:
+                if m['TYPE'] in ('markettick', 'split', 'offmarket'):
+                    self.market[m['DATA']['stock']] = [m['DATA']['newprice'], m['DATA']['div']]
+            return msgs
+
+    def close(self):
+        self.sock.close()
+        self.conn.close()
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("group", help="Multicast GROUP:PORT of the feed (st_server.py --tickfeed)")
+    parser.add_argument("-g", "--game", default='default-game', help="Game to follow")
+    parser.add_argument("-s", "--server", default='localhost', help="IP/URL of the game server, for snapshots")
+    parser.add_argument("-p", "--port", type=int, default=8089, help="Port of the game server")
+    parser.add_argument("--interface", default='0.0.0.0', help="Address of the interface to receive on")
+    args = parser.parse_args()
+
+    group, port = parse_group(args.group)
+    feed = TickReceiver(group, port, args.game, args.server, args.port, args.interface)
+    print (f'{args.game} at seq {feed.seq}, tick {feed.tick}: {feed.market}')
+    try:
+        while True:
+            msgs = feed.receive()
+            prices = '  '.join(f'{p:4d}{"*" if div else " "}' for (p, div) in feed.market)
+            if msgs is None:
+                print (f'{feed.tick:5d} (missed datagrams, reloaded)  {prices}')
+                continue
+            roll = next((m['DATA'] for m in msgs if m['TYPE'] == 'roll'), None)
+            roll = f'{roll["stock"]} {roll["action"]:<4} {roll["amount"]:2d}' if roll else '-'
+            print (f'{feed.tick:5d} {roll:<10} {prices}')
+            if any(m['TYPE'] == 'gamestat' for m in msgs):
+                break
+    except KeyboardInterrupt:
+        pass
+    feed.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+'''binary game messages (st_common.BINARY_LAYOUTS) and their negotiation (CAP_BINARY)'''
+
+import selectors
+import socket
+import pytest
+
+import st_server
+from st_common import (BINARY_LAYOUTS, CAP_BINARY, JSON_START, FRAME_HEADER, MessageReceiver, OutMessage,
+                       encode_message, decode_message, parse_initconn)
+
+SAMPLES = {
+    'roll': [ {'stock': 0, 'action': 'UP', 'amount': 5}, {'stock': 5, 'action': 'DIV', 'amount': 20} ],
+    'markettick': [ {'stock': 2, 'amount': 10, 'newprice': 110, 'div': True}, {'stock': 1, 'amount': 20, 'newprice': -5, 'div': False} ],
+    'div': [ {'stock': 3, 'amount': 10, 'divpaid': 1200, 'playercash': 6200} ],
+    'split': [ {'stock': 4, 'newprice': 100, 'div': True, 'shares': 4000, 'gained': 2000, 'divpaid': 0, 'playercash': 5000} ],
+    'offmarket': [ {'stock': 0, 'newprice': 100, 'div': False, 'shares': 0, 'lost': 1500} ],
+}
+
+def test_every_layout_has_samples():
+    assert set(SAMPLES) == set(BINARY_LAYOUTS)
+
+@pytest.mark.parametrize('mtype', sorted(SAMPLES))
+def test_round_trip(mtype):
+    for data in SAMPLES[mtype]:
+        frame = encode_message(mtype, data, binary=True)
+        (size,) = FRAME_HEADER.unpack_from(frame)
+        body = frame[FRAME_HEADER.size:]
+        assert size == len(body) == BINARY_LAYOUTS[mtype].struct.size
+        assert body[0] != JSON_START
+        assert decode_message(memoryview(body)) == {'TYPE': mtype, 'DATA': data}
+        # the same as the json encoding decodes to
+        assert decode_message(encode_message(mtype, data)[FRAME_HEADER.size:]) == decode_message(body)
+
+def test_mixed_stream():
+    msgs = [ ('roll', SAMPLES['roll'][0], True), ('chatmsg', 'hi', True), ('div', SAMPLES['div'][0], False),
+             ('split', SAMPLES['split'][0], True) ]
+    received = []
+    msgrec = MessageReceiver('test', None, received.append)
+    msgrec.add_bytes(b''.join(encode_message(*m) for m in msgs))
+    assert received == [ {'TYPE': mtype, 'DATA': data} for (mtype, data, binary) in msgs ]
+
+def test_out_message_frames():
+    msg = OutMessage('markettick', SAMPLES['markettick'][0])
+    binary, json = msg.frame(True), msg.frame(False)
+    assert binary == encode_message('markettick', msg.data, binary=True)
+    assert json == encode_message('markettick', msg.data)
+    assert msg.frame(True) is binary and msg.frame() is json # encoded once each
+    # no binary layout: json for everyone
+    chat = OutMessage('chatmsg', {'playername': 'a', 'message': 'b'})
+    assert chat.frame(True) == chat.frame(False) == encode_message('chatmsg', chat.data)
+
+def test_parse_initconn():
+    assert parse_initconn({'TYPE': 'initconn', 'DATA': 'old'}) == ('old', ())
+    assert parse_initconn({'TYPE': 'initconn', 'DATA': {'name': 'new', 'caps': [CAP_BINARY]}}) == ('new', [CAP_BINARY])
+    with pytest.raises(ValueError):
+        parse_initconn({'TYPE': 'msg', 'DATA': 'x'})
+
+@pytest.mark.parametrize('caps', [ [CAP_BINARY], [] ])
+def test_negotiation(caps):
+    conn, peer = socket.socketpair()
+    conn.setblocking(False)
+    pending = st_server.add_pending(conn, ('test', 1))
+    st_server.sel.register(conn, selectors.EVENT_READ, pending)
+    try:
+        pending.message_received({'TYPE': 'initconn', 'DATA': {'name': 'codec', 'caps': caps}})
+        client = pending.client
+        assert client.binary == bool(caps)
+        roll = OutMessage('roll', SAMPLES['roll'][0])
+        client.send(roll)
+        bodies = []
+        receiver = MessageReceiver('peer', peer, bodies.append)
+        receiver.decode = bytes # keep the message bodies as they arrived
+        while len(bodies) < 2:
+            receiver.recv()
+        accept, body = bodies
+        assert decode_message(accept)['TYPE'] == 'conn-accept'
+        assert (body[0] != JSON_START) == bool(caps)
+        assert body == roll.frame(bool(caps))[FRAME_HEADER.size:]
+        assert decode_message(body) == {'TYPE': 'roll', 'DATA': SAMPLES['roll'][0]}
+    finally:
+        if pending.client:
+            st_server.disconnect_client(pending.client)
+        else:
+            pending.close()
+        st_server.pending_deadlines.clear()
+        peer.close()
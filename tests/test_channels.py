@@ -0,0 +1,83 @@
+'''routing of messages for many clients through st_server's channels (see CHANNELS in st_server.py)'''
+
+import selectors
+import socket
+import pytest
+
+import st_server
+from st_server import Client, add_client, disconnect_client, send_all, global_channel, lobby_channel, bmsg
+from st_common import MessageReceiver
+
+@pytest.fixture
+def connect():
+    '''connect(name): a Client that has done its handshake. Its peer socket is client.peer'''
+    connected = []
+    def connect(name):
+        conn, peer = socket.socketpair()
+        conn.setblocking(False)
+        client = Client(name, conn)
+        client.peer = peer
+        add_client(client)
+        st_server.sel.register(conn, selectors.EVENT_READ, client)
+        connected.append(client)
+        return client
+    yield connect
+    for client in connected:
+        if not client.closed:
+            disconnect_client(client)
+        client.peer.close()
+
+@pytest.fixture
+def game(monkeypatch):
+    game = st_server.StockTickerGame('routed')
+    monkeypatch.setitem(st_server.games, game.name, game)
+    return game
+
+def received(client):
+    '''types (and chat text) of the messages client got since the last call'''
+    messages = []
+    receiver = MessageReceiver('peer', client.peer, messages.append)
+    client.peer.setblocking(False)
+    try:
+        while receiver.recv():
+            pass
+    except BlockingIOError:
+        pass
+    return [ m['DATA'] if m['TYPE'] == 'chatmsg' else m['TYPE'] for m in messages ]
+
+def test_routing(connect, game):
+    alice, bob, carol, dave = [ connect(name) for name in ('alice', 'bob', 'carol', 'dave') ]
+    assert set(global_channel.members()) == set(lobby_channel.members()) == { alice, bob, carol, dave }
+    assert st_server.process_join_request(alice, game.name, game.id) == (True, None)
+    assert st_server.process_join_request(bob, game.name, game.id) == (True, None)
+    assert st_server.process_spectate_request(dave, game.name, game.id) == (True, None)
+    for c in (alice, bob, carol, dave):
+        received(c)
+
+    send_all(bmsg('chatmsg', 'everyone'))
+    lobby_channel.send(bmsg('chatmsg', 'lobby'))
+    game.channel.send(bmsg('chatmsg', 'players'))
+    assert received(alice) == received(bob) == [ 'everyone', 'players' ]
+    assert received(carol) == [ 'everyone', 'lobby' ]
+    assert received(dave) == [] # spectators only get their game's state
+
+    disconnect_client(bob)
+    assert received(alice) == [ 'disconnect', 'playerlist' ]
+    assert not bob.channels
+    assert bob not in global_channel.members() and bob not in game.channel.members()
+    send_all(bmsg('chatmsg', 'bye'))
+    assert received(alice) == received(carol) == [ 'bye' ]
+
+def test_members_rebuilt_only_after_change(connect):
+    alice = connect('alice')
+    members = lobby_channel.members()
+    assert lobby_channel.members() is members
+    carol = connect('carol')
+    assert set(lobby_channel.members()) == { alice, carol }
+
+def test_unsubscribe_keeps_newer_client_of_same_name(connect):
+    old = connect('alice')
+    disconnect_client(old)
+    new = connect('alice')
+    lobby_channel.unsubscribe(old) # late, e.g. from the old connection's cleanup
+    assert new in lobby_channel.members()
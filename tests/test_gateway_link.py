@@ -0,0 +1,52 @@
+'''packets from a gateway (st_server.GatewayLink)'''
+
+import json
+import socket
+import pytest
+
+import st_server
+from st_server import GatewayLink
+from st_common import LinkReceiver, encode_link, LINK_OPEN, LINK_DATA, LINK_CLOSE, LINK_BROADCAST
+
+@pytest.fixture
+def link():
+    '''a GatewayLink on one end of a socket pair, link.peer is the gateway's end'''
+    conn, peer = socket.socketpair()
+    conn.setblocking(False)
+    link = GatewayLink(conn, ('gateway', 1))
+    link.peer = peer
+    yield link
+    for client in list(link.clients.values()):
+        st_server.disconnect_client(client)
+    conn.close()
+    peer.close()
+
+def body(mtype, data):
+    return json.dumps({'TYPE': mtype, 'DATA': data}).encode('utf-8')
+
+def packets(link):
+    '''(kind, connection id, payload) of the packets the link sent so far'''
+    received = []
+    receiver = LinkReceiver('gateway', link.peer, received.append)
+    link.peer.setblocking(False)
+    try:
+        while receiver.recv():
+            pass
+    except BlockingIOError:
+        pass
+    return received
+
+def test_bad_packet_closes_only_its_connection(link):
+    link.message_receiver.add_bytes(encode_link(LINK_OPEN, 1, body('initconn', 'alice'))
+                                    + encode_link(LINK_OPEN, 2, body('initconn', 'bob')))
+    assert [ c.get_name() for c in link.clients.values() ] == [ 'alice', 'bob' ]
+    packets(link)
+
+    # alice's packet isn't json. bob's chat after it, in the same read, still gets through
+    link.message_receiver.add_bytes(encode_link(LINK_DATA, 1, b'{"TYPE": "msg", "DA')
+                                    + encode_link(LINK_DATA, 2, body('msg', 'hello')))
+    assert 'alice' not in st_server.clients and 'bob' in st_server.clients
+    sent = packets(link)
+    assert (LINK_CLOSE, 1, b'') in sent
+    chats = [ json.loads(payload[4:]) for (kind, conn_id, payload) in sent if kind in (LINK_DATA, LINK_BROADCAST) ]
+    assert [ c['DATA']['message'] for c in chats if c['TYPE'] == 'chatmsg' ] == [ 'hello' ]
@@ -0,0 +1,116 @@
+'''journal a game with st_server's StockTickerGame and rebuild it with st_journal.replay'''
+
+import glob
+import os
+import pytest
+
+import st_server
+from st_journal import replay, RECORD, NAME_RECORD
+
+class RecordingClient:
+    '''just enough of a Client for a game that is played from the test'''
+    link = None
+    binary = False
+    conn = None
+
+    def __init__(self, name):
+        self._name = name
+        self._player = None
+        self.game = None
+        self.channels = set()
+        self.sent = []
+
+    def get_name(self):
+        return self._name
+
+    def get_player(self):
+        return self._player
+
+    def set_player_info(self, player):
+        self._player = player
+
+    def clear_player_info(self):
+        self._player = None
+
+    def send(self, msg):
+        self.sent.append(msg)
+
+    def send_many(self, msgs):
+        self.sent.extend(msgs)
+
+@pytest.fixture
+def journal_dir(tmp_path, monkeypatch):
+    monkeypatch.setitem(st_server.SERVER_OPT, 'journal_dir', str(tmp_path))
+    return tmp_path
+
+def test_records_same_size():
+    assert RECORD.size == NAME_RECORD.size
+
+def test_replay_more_than_256_players(journal_dir):
+    game = st_server.StockTickerGame('journaled')
+    game.set_seed(1)
+    clients = [ RecordingClient(f'p{i}') for i in range(300) ]
+    for c in clients:
+        game.add_player(c)
+    assert game.player('p299').slot == 299
+
+    # players past slot 255 buy, so their orders are journaled
+    for c in clients[250:]:
+        player = game.player(c.get_name())
+        game.process_order(player, {'reqid': c.get_name(), 'data': [ (100, 100) ] + [ (0, 100) ] * 5})
+        approve = c.sent[-1]
+        assert approve.mtype == 'approve' and approve.data['approved']
+        assert player.get_portfolio() == (100, 0, 0, 0, 0, 0)
+
+    game.start_game()
+    game.fast_forward()
+    game.journal.close()
+
+    (path,) = glob.glob(os.path.join(journal_dir, 'journaled-*.stj'))
+    with open(path, 'rb') as f:
+        replayed = replay(f.read())
+    assert replayed.ended is not None
+    assert replayed.market == game.market
+    assert len(replayed.players) == 300
+    for slot, (name, cash, shares) in replayed.players.items():
+        player = game.player(name)
+        assert player.slot == slot
+        assert (cash, shares) == (player.cash, list(player.get_portfolio()))
+
+def test_order_queued_before_leaving_is_dropped(journal_dir):
+    game = st_server.StockTickerGame('leaver')
+    game.set_seed(1)
+    stays, leaves = RecordingClient('stays'), RecordingClient('leaves')
+    game.add_player(stays)
+    game.add_player(leaves)
+    player = game.player('leaves')
+
+    # with --gameworkers the order runs after the selector loop removed the player
+    game.remove_player('leaves')
+    game.process_order(player, {'reqid': 'late', 'data': [ (100, 100) ] + [ (0, 100) ] * 5})
+    st_server.process_ready(game, player)
+    assert not leaves.sent
+    assert game.playernames() == ('stays',)
+
+    game.start_game()
+    game.fast_forward()
+    game.journal.close()
+
+    (path,) = glob.glob(os.path.join(journal_dir, 'leaver-*.stj'))
+    with open(path, 'rb') as f:
+        replayed = replay(f.read())
+    assert [ name for (name, cash, shares) in replayed.players.values() ] == [ 'stays' ]
+
+def test_long_non_ascii_name(journal_dir):
+    game = st_server.StockTickerGame('unicode')
+    name = 'Zoë-' + 'é' * 20 + '€' * 5 # byte 32 is in the middle of an 'é'
+    assert len(name.encode('utf-8')) > 32
+    game.add_player(RecordingClient(name))
+    game.journal.close()
+
+    (path,) = glob.glob(os.path.join(journal_dir, 'unicode-*.stj'))
+    with open(path, 'rb') as f:
+        replayed = replay(f.read())
+    ((replayed_name, cash, shares),) = replayed.players.values()
+    assert name.startswith(replayed_name)
+    assert 30 < len(replayed_name.encode('utf-8')) <= 32
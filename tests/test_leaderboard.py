@@ -0,0 +1,77 @@
+'''ranking of st_leaderboard.Leaderboard'''
+
+import random
+
+from st_leaderboard import Leaderboard
+
+def networths(cash, shares, prices):
+    return { slot: cash[slot] + sum(n * p for n, p in zip(shares[slot], prices)) // 100 for slot in cash }
+
+def test_ranking_order():
+    board = Leaderboard(2, [100, 100])
+    for slot, cash in enumerate([5000, 7000, 6000]):
+        board.add(slot, cash)
+    assert board.top() == [ (1, 7000), (2, 6000), (0, 5000) ]
+
+    board.set_cash(0, 4000)
+    board.set_shares(0, 1, 5000) # 5000 shares at $1: 9000
+    board.commit()
+    assert board.top(2) == [ (0, 9000), (1, 7000) ]
+    assert [ board.rank(slot) for slot in (0, 1, 2) ] == [ 1, 2, 3 ]
+
+    board.set_price(1, 60) # 3000 in shares now
+    board.commit()
+    assert board.top() == [ (0, 7000), (1, 7000), (2, 6000) ] # ties by slot
+    assert board.leaders() == ([ 0, 1 ], 7000)
+    assert board.rank(0) == board.rank(1) == 1 and board.rank(2) == 3
+
+def test_removal():
+    board = Leaderboard(1, [100])
+    for slot in range(4):
+        board.add(slot, 1000 * (slot + 1))
+    board.set_shares(2, 0, 10000)
+    board.remove(2) # with a change not committed yet
+    board.commit()
+    assert board.top() == [ (3, 4000), (1, 2000), (0, 1000) ]
+    assert len(board) == 3
+
+    # changes for a player that has left are ignored, later commits still work
+    board.set_cash(2, 99999)
+    board.set_shares(2, 0, 5)
+    board.remove(2)
+    board.set_cash(0, 3000)
+    board.commit()
+    assert board.top() == [ (3, 4000), (0, 3000), (1, 2000) ]
+    assert 2 not in dict(board.top())
+
+def test_matches_recalculation():
+    rng = random.Random(1)
+    prices = [ 100 ] * 3
+    board = Leaderboard(3, prices)
+    cash, shares = {}, {}
+    for slot in range(200):
+        cash[slot], shares[slot] = 5000, [ 0, 0, 0 ]
+        board.add(slot, 5000)
+    for step in range(500):
+        slot = rng.choice(list(cash))
+        what = rng.random()
+        if what < 0.4:
+            stock = rng.randrange(3)
+            shares[slot][stock] = rng.randrange(0, 5000, 100)
+            cash[slot] = rng.randrange(10000)
+            board.set_shares(slot, stock, shares[slot][stock])
+            board.set_cash(slot, cash[slot])
+        elif what < 0.8:
+            stock = rng.randrange(3)
+            prices[stock] = max(5, prices[stock] + rng.choice((-20, -10, 10, 20)))
+            board.set_price(stock, prices[stock])
+        elif what < 0.9:
+            del cash[slot], shares[slot]
+            board.remove(slot)
+        else:
+            slot = max(cash) + 1
+            cash[slot], shares[slot] = 5000, [ 0, 0, 0 ]
+            board.add(slot, 5000)
+        board.commit()
+        expected = networths(cash, shares, prices)
+        assert board.top() == sorted(expected.items(), key=lambda e: (-e[1], e[0]))
@@ -0,0 +1,44 @@
+'''framing of st_common.MessageReceiver'''
+
+import struct
+import pytest
+
+from st_common import MessageReceiver, encode_message, FRAME_HEADER
+
+def receiver():
+    received = []
+    return MessageReceiver('test', None, received.append), received
+
+def test_messages_split_anywhere():
+    msgs = [ ('chatmsg', 'x' * n) for n in (0, 10, 3000, 100000) ]
+    stream = b''.join(encode_message(*m) for m in msgs)
+    for chunk in (1, 7, 4096):
+        msgrec, received = receiver()
+        for i in range(0, len(stream), chunk):
+            msgrec.add_bytes(stream[i:i+chunk])
+        assert [ (m['TYPE'], m['DATA']) for m in received ] == msgs
+
+def test_oversized_header_refused():
+    msgrec, received = receiver()
+    with pytest.raises(ValueError):
+        msgrec.add_bytes(FRAME_HEADER.pack(0xFFFFFFFF) + b'{"TYPE"')
+    assert len(msgrec._buf) == MessageReceiver.BUFSIZE
+    msgrec, received = receiver()
+    with pytest.raises(ValueError):
+        msgrec.add_bytes(FRAME_HEADER.pack(MessageReceiver.MAX_MESSAGE + 1))
+
+def test_buffer_grows_with_the_bytes_received():
+    # the header claims almost MAX_MESSAGE, only 100 KB of it arrives
+    msgrec, received = receiver()
+    size = MessageReceiver.MAX_MESSAGE
+    msgrec.add_bytes(FRAME_HEADER.pack(size) + b'x' * 100000)
+    assert len(msgrec._buf) <= 2 * (100000 + MessageReceiver.BUFSIZE)
+    assert not received
+
+def test_message_at_the_limit(monkeypatch):
+    monkeypatch.setattr(MessageReceiver, 'MAX_MESSAGE', 300000)
+    msgrec, received = receiver()
+    frame = encode_message('chatmsg', 'x' * (300000 - 32))
+    assert struct.unpack_from('I', frame)[0] <= 300000
+    msgrec.add_bytes(frame)
+    assert received[0]['DATA'] == 'x' * (300000 - 32)
@@ -0,0 +1,37 @@
+'''handshake deadlines of st_server.PendingConnection (expire_pending)'''
+
+import selectors
+import socket
+import pytest
+
+import st_server
+from st_server import add_pending, expire_pending, pending, pending_deadlines
+
+@pytest.fixture
+def connect():
+    '''connect(): a new pending connection, like the selector loop makes on accept'''
+    peers = []
+    def connect():
+        conn, peer = socket.socketpair()
+        conn.setblocking(False)
+        peers.append(peer)
+        p = add_pending(conn, ('test', len(peers)))
+        st_server.sel.register(conn, selectors.EVENT_READ, p)
+        return p
+    yield connect
+    for p in list(pending.values()):
+        p.close()
+    pending_deadlines.clear()
+    for peer in peers:
+        peer.close()
+
+def test_only_expired_head_is_dropped(connect):
+    first, second, third = connect(), connect(), connect()
+    first.deadline -= 60
+    second.deadline -= 60
+    second.close() # e.g. it sent initconn, it is no longer pending
+    expire_pending()
+    assert first.closed
+    assert list(pending.values()) == [ third ] and list(pending_deadlines) == [ third ]
+    expire_pending()
+    assert not third.closed
@@ -0,0 +1,82 @@
+'''st_playerstore.PlayerStore: the NumPy and array.array versions give the same results'''
+
+import random
+import pytest
+
+import st_playerstore
+from st_playerstore import PlayerStore
+
+N_STOCKS = 3
+
+def play(seed):
+    '''
+    Random joins, leaves, orders, splits, busts and dividends on a PlayerStore,
+    checked against plain dicts. Returns everything the store returned
+    '''
+    rng = random.Random(seed)
+    store = PlayerStore(N_STOCKS, capacity=4) # small, so it has to grow
+    cash, shares = {}, {} # slot: expected cash / [shares per stock]
+    results = []
+    for step in range(400):
+        what = rng.random()
+        if what < 0.15 or not cash:
+            slot = len(store.players)
+            store.add(slot, f'p{slot}')
+            store.set_cash(slot, 5000)
+            cash[slot], shares[slot] = 5000, [ 0 ] * N_STOCKS
+        elif what < 0.2:
+            slot = rng.choice(list(cash))
+            store.remove(slot)
+            del cash[slot], shares[slot]
+        elif what < 0.55:
+            slot = rng.choice(list(cash))
+            portfolio = [ rng.randrange(0, 3000, 100) for i in range(N_STOCKS) ]
+            cash[slot] = rng.randrange(10000)
+            store.set_cash(slot, cash[slot])
+            store.set_portfolio(slot, portfolio)
+            shares[slot] = portfolio
+        elif what < 0.7:
+            stock = rng.randrange(N_STOCKS)
+            result = store.split(stock)
+            slots = sorted(cash)
+            gained = [ shares[s][stock] for s in slots ]
+            divpaid = [ int(g * 0.2) for g in gained ]
+            for s, div in zip(slots, divpaid):
+                cash[s] += div
+                shares[s][stock] *= 2
+            assert [ list(r) for r in result ] == [ slots, gained, divpaid, [ shares[s][stock] for s in slots ],
+                                                   [ cash[s] for s in slots ] ]
+            results.append(('split', [ list(r) for r in result ]))
+        elif what < 0.8:
+            stock = rng.randrange(N_STOCKS)
+            result = store.bust(stock)
+            slots = sorted(cash)
+            assert [ list(r) for r in result ] == [ slots, [ shares[s][stock] for s in slots ] ]
+            for s in slots:
+                shares[s][stock] = 0
+            results.append(('bust', [ list(r) for r in result ]))
+        else:
+            stock, amount = rng.randrange(N_STOCKS), rng.choice((5, 10, 20))
+            result = store.dividend(stock, amount)
+            slots = [ s for s in sorted(cash) if int(shares[s][stock] * amount / 100) ]
+            divpaid = [ int(shares[s][stock] * amount / 100) for s in slots ]
+            for s, div in zip(slots, divpaid):
+                cash[s] += div
+            assert [ list(r) for r in result ] == [ slots, divpaid, [ cash[s] for s in slots ] ]
+            results.append(('dividend', [ list(r) for r in result ]))
+        for slot in cash:
+            assert store.get_cash(slot) == cash[slot]
+            assert store.get_portfolio(slot) == tuple(shares[slot])
+    return results
+
+@pytest.mark.parametrize('seed', [ 1, 2, 3 ])
+def test_array_store(monkeypatch, seed):
+    monkeypatch.setattr(st_playerstore, 'np', None)
+    assert play(seed)
+
+@pytest.mark.parametrize('seed', [ 1, 2, 3 ])
+def test_numpy_matches_array(monkeypatch, seed):
+    pytest.importorskip('numpy')
+    with_numpy = play(seed)
+    monkeypatch.setattr(st_playerstore, 'np', None)
+    assert play(seed) == with_numpy
@@ -0,0 +1,44 @@
+'''roll deadlines of st_server.ScheduledRollTimer when a market action overruns'''
+
+import json
+import time
+import pytest
+
+import st_server
+from st_server import next_roll_deadline, ScheduledRollTimer
+
+def test_next_deadline_on_time():
+    assert next_roll_deadline(10.0, 3, 11.0) == 13.0
+
+def test_next_deadline_skips_missed_rolls():
+    # overran two deadlines (13, 16): the next one is 19, not now
+    assert next_roll_deadline(10.0, 3, 17.5) == 19.0
+    assert next_roll_deadline(10.0, 3, 13.0) == 16.0
+
+class Recorder:
+    def __init__(self):
+        self.sent = []
+        self.scheduled = []
+
+    def send(self, msgbytes):
+        self.sent.append(json.loads(msgbytes[4:]))
+
+    def schedule(self, timer, deadline):
+        self.scheduled.append(deadline)
+
+@pytest.fixture
+def recorder(monkeypatch):
+    recorder = Recorder()
+    monkeypatch.setattr(st_server, 'roll_scheduler', recorder)
+    return recorder
+
+def test_overrun_announces_real_countdown(recorder):
+    timer = ScheduledRollTimer(1, lambda: None, recorder)
+    timer.running = True
+    now = time.monotonic()
+    timer.fire(now - 2.5) # the action made it miss two deadlines
+    (deadline,) = recorder.scheduled
+    assert deadline == pytest.approx(now + 0.5, abs=0.05)
+    (actiontime,) = recorder.sent
+    assert actiontime['TYPE'] == 'actiontime'
+    assert actiontime['DATA'] == pytest.approx(0.5, abs=0.05)
@@ -0,0 +1,153 @@
+'''slow consumer handling of st_server.Client (see SLOW CONSUMERS in st_server.py)'''
+
+import selectors
+import socket
+import pytest
+
+import st_server
+from st_server import SERVER_OPT, Client, OutMessage, EVENT_FIELDS, bmsg, expire_slow, queue_stats
+from st_common import MessageReceiver
+
+@pytest.fixture
+def client(monkeypatch):
+    '''a Client on one end of a socket pair. Nothing reads the other end (client.peer) until drain()'''
+    for opt, val in {'outbuf_low': 4096, 'outbuf_high': 16384, 'outbuf_max': 1 << 20,
+                     'slow_policy': frozenset(), 'slow_grace': 5, 'lane_max_wait': 0.25}.items():
+        monkeypatch.setitem(SERVER_OPT, opt, val)
+    conn, peer = socket.socketpair()
+    conn.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+    peer.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+    conn.setblocking(False)
+    client = Client('slowpoke', conn)
+    client.peer = peer
+    st_server.add_client(client)
+    st_server.sel.register(conn, selectors.EVENT_READ, client)
+    yield client
+    if not client.closed:
+        st_server.disconnect_client(client)
+    st_server.slow_clients.discard(client)
+    while not st_server.write_requests.empty():
+        st_server.write_requests.get()
+    peer.close()
+
+def event(mtype, *values):
+    return OutMessage(mtype, dict(zip(EVENT_FIELDS[mtype], values)))
+
+def fill(client):
+    '''queue messages until it is a slow consumer. Returns how many'''
+    n = 0
+    while not client.holding():
+        client.send(bmsg('gamestat', {'filler': n, 'pad': 'x' * 1000}))
+        n += 1
+    return n
+
+def drain(client, flush=None):
+    '''
+    the client catches up: read everything, flushing (client.flush, or flush()) as
+    the selector loop would. Returns the messages
+    '''
+    received = []
+    receiver = MessageReceiver('peer', client.peer, received.append)
+    client.peer.setblocking(False)
+    while True:
+        done = (flush or client.flush)() and not client.holding()
+        try:
+            while receiver.recv():
+                pass
+        except BlockingIOError:
+            pass
+        if done:
+            return received
+
+def not_filler(messages):
+    return [ m for m in messages if not (m['TYPE'] == 'gamestat' and 'filler' in m['DATA']) ]
+
+def test_conflate_replaces_held_market_data(client):
+    SERVER_OPT['slow_policy'] = frozenset(['conflate'])
+    fill(client)
+    conflated = queue_stats['conflated']
+    client.send_many([ event('roll', 0, 'UP', 5), event('markettick', 0, 5, 105, False),
+                       event('leaderboard', 10, ['a']) ])
+    client.send_many([ event('roll', 1, 'DOWN', 10), event('markettick', 1, 10, 90, False),
+                       event('leaderboard', 10, ['b']) ])
+    client.send_many([ event('roll', 0, 'UP', 20), event('markettick', 0, 20, 125, True),
+                       event('leaderboard', 10, ['c']) ])
+    assert queue_stats['conflated'] - conflated == 5
+    got = not_filler(drain(client))
+    assert [ m['DATA'] for m in got if m['TYPE'] == 'roll' ] == [ {'stock': 0, 'action': 'UP', 'amount': 20} ]
+    # one per stock, the latest
+    assert [ (m['DATA']['stock'], m['DATA']['newprice']) for m in got if m['TYPE'] == 'markettick' ] == [ (1, 90), (0, 125) ]
+    assert [ m['DATA']['players'] for m in got if m['TYPE'] == 'leaderboard' ] == [ ['c'] ]
+
+def test_market_data_kept_without_conflate(client):
+    fill(client)
+    for price in (105, 110, 115):
+        client.send(event('markettick', 0, 5, price, False))
+    got = not_filler(drain(client))
+    assert [ m['DATA']['newprice'] for m in got ] == [ 105, 110, 115 ]
+
+def test_dropchat_keeps_player_messages(client):
+    SERVER_OPT['slow_policy'] = frozenset(['dropchat'])
+    fill(client)
+    dropped = queue_stats['chat-dropped']
+    client.send(bmsg('chatmsg', {'playername': 'other', 'message': 'hi'}))
+    client.send(event('approve', 'r1', [], None, 100, True, 4900, (1, 0, 0, 0, 0, 0)))
+    client.send(bmsg('chatmsg', {'playername': 'other', 'message': 'anyone?'}))
+    client.send_many([ event('div', 2, 10, 50, 4950), event('approve', 'r2', [], 'not enough cash', 0, False, 4950, (1, 0, 0, 0, 0, 0)) ])
+    assert queue_stats['chat-dropped'] - dropped == 2
+    got = not_filler(drain(client))
+    assert [ m['TYPE'] for m in got ] == [ 'approve', 'div', 'approve' ]
+    assert [ m['DATA']['reqid'] for m in got if m['TYPE'] == 'approve' ] == [ 'r1', 'r2' ]
+
+def test_disconnect_after_grace(client):
+    SERVER_OPT['slow_policy'] = frozenset(['disconnect'])
+    fill(client)
+    expire_slow()
+    assert not client.closed
+    client.slow_since -= SERVER_OPT['slow_grace'] + 1
+    expire_slow()
+    assert client.closed
+    assert 'slowpoke' not in st_server.clients
+
+def test_no_disconnect_policy_waits(client):
+    fill(client)
+    client.slow_since -= SERVER_OPT['slow_grace'] + 1
+    expire_slow()
+    assert not client.closed
+
+@pytest.mark.parametrize('policy', [ (), ('conflate', 'dropchat') ])
+def test_outbuf_max_disconnects(client, policy):
+    SERVER_OPT['slow_policy'] = frozenset(policy)
+    SERVER_OPT['outbuf_max'] = 65536
+    fill(client)
+    reqid = 0
+    while client.queued_bytes() <= SERVER_OPT['outbuf_max']:
+        client.send(event('approve', f'r{reqid}', [], None, 1, True, 5000, (0, 0, 0, 0, 0, 0)))
+        reqid += 1
+    expire_slow()
+    assert client.closed
+    assert 'slowpoke' not in st_server.clients
+
+def test_release_in_order_below_low_watermark(client):
+    n_filler = fill(client)
+    for i in range(50):
+        client.send(bmsg('playerlist', [ f'p{i}' ]))
+    client.send_many([ event('approve', f'r{i}', [], None, 1, True, 5000, (0, 0, 0, 0, 0, 0)) for i in range(10) ])
+
+    left_at_release = [] # bytes still queued (not counting the held ones) when they were released
+    def flush():
+        held_bytes = client._held_bytes if client.holding() else None
+        done = client.flush()
+        if held_bytes is not None and not client.holding():
+            left_at_release.append(client._queued - held_bytes)
+        return done
+    got = drain(client, flush)
+    assert len(left_at_release) == 1 and left_at_release[0] <= SERVER_OPT['outbuf_low']
+    assert len(got) == n_filler + 60
+    held = not_filler(got)
+    assert [ m['DATA'] for m in held if m['TYPE'] == 'playerlist' ] == [ [ f'p{i}' ] for i in range(50) ]
+    assert [ m['DATA']['reqid'] for m in held if m['TYPE'] == 'approve' ] == [ f'r{i}' for i in range(10) ]
+    # everything held goes after what was queued before it in the same lane
+    fillers = [ i for i, m in enumerate(got) if m not in held ]
+    first_playerlist = next(i for i, m in enumerate(got) if m['TYPE'] == 'playerlist')
+    assert fillers and max(fillers) < first_playerlist